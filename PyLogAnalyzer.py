@@ -20,7 +20,6 @@
 ## Netfarm Mail Archiver [loganalyzer]
 
 ## TODO
-## - handle db disconnection
 ## - close fd when damonize
 
 from sys import stdin, stdout
@@ -29,7 +28,7 @@ from traceback import format_exc
 from types import StringType
 from rfc822 import parseaddr
 from mx.DateTime.Parser import DateTimeFromString
-from psycopg2 import connect
+from pgpool import PGPool, PoolError
 import re
 
 DBDSN = 'host=localhost dbname=mail user=archiver password=archiver'
@@ -151,10 +150,10 @@ class PyLogAnalyzer:
         self.log = log
         self.skiplist = skiplist
 
-        try:
-            self.dbConn = connect(DBDSN)
-            self.dbCursor = self.dbConn.cursor()
-        except:
+        ## A single connection, reopened in background if lost
+        self.pool = PGPool(DBDSN, minsize=1, maxsize=1, log=self.pool_log)
+        if self.pool.down:
+            self.pool.close()
             raise Exception, 'Cannot connect to DB'
 
         try:
@@ -165,10 +164,12 @@ class PyLogAnalyzer:
         except:
             raise Exception, 'Cannot open log file'
 
+    def pool_log(self, text):
+        log(E_ERR, '[DB Pool] ' + text)
+
     def __del__(self):
         try:
-            self.dbCursor.close()
-            self.dbConn.close()
+            self.pool.close()
         except:
             pass
 
@@ -184,25 +185,31 @@ class PyLogAnalyzer:
         qs = query % info
 
         try:
-            self.dbCursor.execute(qs)
-            self.dbConn.commit()
+            conn = self.pool.get()
+        except PoolError, val:
+            log(E_ERR, '[DB Query Error] %s' % val)
+            return False
+
+        try:
+            conn.cursor.execute(qs)
+            conn.connection.commit()
+            if fetch:
+                res = conn.cursor.fetchone()
+            else:
+                res = True
         except KeyboardInterrupt:
+            self.pool.discard(conn)
             raise KeyboardInterrupt
         except:
             log(E_ERR, '-----------\n[DB Query Error]')
             log(E_ERR, format_exc().strip())
             log(E_ERR, '\n[Query]\n' + qs)
             log(E_ERR, '-----------')
-            try:
-                self.dbConn.rollback()
-            except:
-                pass
+            self.pool.release(conn)
             return False
 
-        if fetch:
-            return self.dbCursor.fetchone()
-        else:
-            return True
+        self.pool.put(conn)
+        return res
 
     def mainLoop(self):
         self.log(E_ALWAYS, '[PyLogAnalyzer] Starting...')
@@ -34,28 +34,33 @@ __all__ = [ 'BackendBase',
 
 from sys import platform, hexversion
 if platform != 'win32':
-    from signal import signal, SIGTERM, SIGINT, SIGHUP, SIG_IGN
+    from signal import signal, SIGTERM, SIGINT, SIGHUP
     from stat import ST_MTIME
+    from signal import SIG_DFL, SIG_IGN
     from os import stat, fork, kill, seteuid, setegid, getuid, chdir
+    from os import waitpid, _exit
+    from errno import ECHILD, EINTR
     from pwd import getpwnam, getpwuid
-from mtplib import MTPServer
+from mtplib import MTPServer, LMTPServer
 from time import strftime, time, localtime, sleep, mktime
 from sys import argv, exc_info, stdin, stdout, stderr
 from sys import exit as sys_exit
 from os import unlink, chmod, access, F_OK, R_OK
 from os import close, dup, getpid
-from mimetools import Message
-from multifile import MultiFile
-from smtplib import SMTP, SMTPRecipientsRefused, SMTPSenderRefused
+from smtplib import SMTPRecipientsRefused, SMTPSenderRefused
 from ConfigParser import ConfigParser
-from threading import Thread, Lock, RLock, Event
-from cStringIO import StringIO
+from threading import Thread, Lock, Event
 from getopt import getopt
 from types import IntType, DictType, StringType
 from random import sample as random_sample
 from string import ascii_letters
 from utils import mime_decode_header, unquote, split_hdr
-from utils import parse_message, dupe_check, safe_parseaddr, hash_headers
+from utils import dupe_check, safe_parseaddr, hash_headers
+from smtppool import SMTPPool, StreamSMTP, IDLETIMEOUT, MAXAGE, CHECKIDLE
+from mimescan import ScannedMessage, Segments
+from policy import Policy, read_entries
+from hashdb import DedupStore, DedupServer, DedupClient, listener
+from hashdb import BATCH, WINDOW, TTL, GENERATIONS, MAXKEYS
 
 try:
 	from bsddb3 import hashopen
@@ -85,8 +90,11 @@ NL          = '\n'
 AID         = 'X-Archiver-ID'
 STARTOFBODY = NL + NL
 GRANULARITY = 10
+RESPAWNDELAY = 1
+DRAINTIMEOUT = 60
 BACKEND_OK  = (1, 200, 'Ok')
 MINSIZE     = 8
+SPOOLSIZE   = 1024 * 1024
 
 ### Globals
 LOG        = None
@@ -96,13 +104,17 @@ isRunning  = False
 main_svc   = False
 serverPoll = []
 runas      = None
+cfgfile    = None
+workerid   = None
+children   = {}
+dedupaddrs = {}
+dedupservers = {}
 ##
 
 re_aid = re.compile(r'^(X-Archiver-ID: .*?)[\r|\n]', re.IGNORECASE | re.MULTILINE)
-whitelist = []
-subjpattern = None
-input_classes  = { 'smtp': MTPServer }
-output_classes = { 'smtp': SMTP }
+policy = Policy()
+input_classes  = { 'smtp': MTPServer, 'lmtp': LMTPServer }
+output_classes = { 'smtp': StreamSMTP }
 
 class StorageTypeNotSupported(Exception):
     """StorageTypeNotSupported The storage type is not supported"""
@@ -133,6 +145,9 @@ class BackendBase:
 
         This class should be derived to make a specialized Backend class"""
 
+    ## process is called one message at time, unless the Backend sets it True
+    threadsafe = False
+
     def process(self, data):
         """method to process data
 
@@ -244,11 +259,41 @@ def StageHandler(config, stage_type):
             except:
                 timeout = None
 
+            ## Number of worker threads processing messages, 0 means in the loop
+            try:
+                poolsize = config.getint(stage_type, 'poolsize')
+            except:
+                poolsize = 0
+
+            ## Message data bigger than spoolsize is received in a temporary file, 0 disables
+            try:
+                spoolsize = config.getint(stage_type, 'spoolsize')
+            except:
+                spoolsize = SPOOLSIZE
+            if spoolsize <= 0:
+                spoolsize = None
+            try:
+                spooldir = config.get(stage_type, 'spooldir')
+            except:
+                spooldir = None
+
+            ## Max message size in bytes, advertised with SIZE, 0 means no limit
+            try:
+                maxsize = config.getint(stage_type, 'maxsize')
+            except:
+                maxsize = 0
+
             Thread.__init__(self)
             ## Init MTPServer Class
-            Class.__init__(self, self.address, self.del_hook, timeout=timeout)
-            self.lock = RLock()
+            ## Prefork workers share the port
+            Class.__init__(self, self.address, timeout=timeout, poolsize=poolsize,
+                           spoolsize=spoolsize, spooldir=spooldir, hostname=get_hostname(config),
+                           maxsize=maxsize, reuseport=workerid is not None)
+            ## Backends are not thread safe, workers must share them
+            self.backend_lock = Lock()
             self.type = stage_type
+            ## Storage stage for the archive passthrough, see set_storage()
+            self.storage = None
 
             ## Setup handle_accept Hook
             self._handle_accept = self.handle_accept
@@ -275,6 +320,11 @@ def StageHandler(config, stage_type):
             except:
                 self.nowait = False
 
+            try:
+                self.draintimeout = config.getfloat('global', 'draintimeout')
+            except:
+                self.draintimeout = DRAINTIMEOUT
+
             try:
                 self.datefromemail = config.getboolean('global', 'datefromemail')
             except:
@@ -282,7 +332,11 @@ def StageHandler(config, stage_type):
 
             ## Init Hashdb to avoid re-archiving
             try:
-                self.hashdb = hashopen(config.get(self.type, 'hashdb'), 'c')
+                if dedupaddrs.has_key(self.type):
+                    ## Prefork workers share the one of the hashdb server process
+                    self.hashdb = DedupClient(dedupaddrs[self.type])
+                else:
+                    self.hashdb = get_hashdb(config, self.type)
             except:
                 LOG(E_TRACE, '%s: Cannot open hashdb file' % self.type)
                 raise Exception, 'Cannot open hashdb file'
@@ -310,6 +364,22 @@ def StageHandler(config, stage_type):
             except:
                 raise BadStageOutput, self.output
 
+            ## Keep-alive connections to the next hop, 0 disables
+            try:
+                outputpool = config.getint(stage_type, 'outputpool')
+            except:
+                outputpool = 0
+            try:
+                outputidle = config.getfloat(stage_type, 'outputidle')
+            except:
+                outputidle = IDLETIMEOUT
+            try:
+                outputmaxage = config.getfloat(stage_type, 'outputmaxage')
+            except:
+                outputmaxage = MAXAGE
+            self.outpool = SMTPPool(self.output, self.output_address, self.output_port,
+                                    outputpool, outputidle, outputmaxage, CHECKIDLE)
+
             ## Backend factory
             self.config = config
             backend_type = self.config.get(stage_type, 'backend')
@@ -323,34 +393,65 @@ def StageHandler(config, stage_type):
 
             self.backend = backend(self.config, stage_type, globals())
             self.shutdown_backend = self.backend.shutdown
+            if poolsize > 0:
+                LOG(E_ALWAYS, '%s: Processing messages with %d workers' % (self.type, poolsize))
+
+        def reload(self, config):
+            """reloads the settings that can change at runtime"""
+            self.set_fqdn(get_hostname(config))
+            LOG(E_ALWAYS, '%s: Using hostname %s' % (self.type, self.fqdn))
 
         def run(self):
             self.setName(self.type)
             LOG(E_ALWAYS, '[%d] Starting Stage Handler %s: %s %s' % (getpid(), self.type, self.proto, self.address))
             self.loop(self.granularity, self.usepoll, self.map)
 
-        ## Hooks to gracefully stop threads
         def accept_hook(self):
             """hook called when the server accepts an incoming connection"""
-            LOG(E_TRACE, '%s: I got a connection: Acquiring lock' % self.type)
-            self.lock.acquire()
+            LOG(E_TRACE, '%s: I got a connection' % self.type)
             return self._handle_accept()
 
-        def del_hook(self):
-            """hook called when a connection is terminated"""
-            LOG(E_TRACE, '%s: Connection closed: Releasing lock' % self.type)
-            try:
-                self.lock.release()
-            except:
-                pass
-
         def finish(self, force=True):
             """shutdown the Archiver system waiting for unterminated jobs"""
             if not self.nowait and not force:
-                LOG(E_TRACE, '%s: Waiting thread job...' % self.getName())
-                self.lock.acquire()
-                LOG(E_TRACE, '%s: Done' % self.getName())
+                ## Stop accepting, sessions in progress can still complete
+                self.del_channel(self.map)
+                LOG(E_TRACE, '%s: Waiting %d running jobs...' % (self.getName(), self.jobs.running))
+                left = self.jobs.wait(self.draintimeout)
+                if left:
+                    LOG(E_ERR, '%s: %d jobs still running, closing anyway' % (self.getName(), left))
+                else:
+                    LOG(E_TRACE, '%s: Done' % self.getName())
             self.close_all()
+            self.outpool.close()
+            self.hashdb.close()
+
+        ## Shared resources, workers run these concurrently
+        def process_backend(self, args):
+            """calls the backend, one message at time if it's not threadsafe"""
+            if self.backend.threadsafe:
+                return self.backend.process(args)
+            self.backend_lock.acquire()
+            try:
+                return self.backend.process(args)
+            finally:
+                self.backend_lock.release()
+
+        def hashdb_get(self, hash):
+            """returns the archiver id stored for hash or None"""
+            return self.hashdb.get(hash)
+
+        def hashdb_put(self, hash, aid):
+            """stores the archiver id for hash"""
+            self.hashdb[hash] = aid
+
+        def hashdb_del(self, hash):
+            """removes hash from hashdb, returns True if it was there"""
+            try:
+                del self.hashdb[hash]
+            except:
+                return False
+            return True
 
         ## low entropy message id generator, fake because it's not changed in the msg
         def new_mid(self):
@@ -364,7 +465,7 @@ def StageHandler(config, stage_type):
                 return self.do_exit(443, 'Internal server error')
 
             try:
-                server = self.output(self.output_address, self.output_port)
+                server = self.outpool.get()
             except:
                 t, val, tb = exc_info()
                 del tb
@@ -385,39 +486,59 @@ def StageHandler(config, stage_type):
 
             ## Mail options is disabled for now
             try:
-                try:
-                    server_reply = server.sendmail(m_from, m_to, msg, mail_options=[], rcpt_options=rcpt_options)
-                except (SMTPRecipientsRefused, SMTPSenderRefused):
-                    LOG(E_ERR, '%s-sendmail: Server refused sender or recipients' % (self.type))
-                    return self.do_exit(550, 'Server refused sender or recipients')
-                except:
-                    t, v, tb = exc_info()
-                    LOG(E_ERR, '%s-sendmail: sent failed: %s: %s' % (self.type, t, v))
-                    return self.do_exit(443, 'Delivery failed to next hop')
+                server_reply = self.outpool.sendmail(server, m_from, m_to, msg, mail_options=[], rcpt_options=rcpt_options)
+            except SMTPRecipientsRefused, error:
+                LOG(E_ERR, '%s-sendmail: Server refused recipients' % (self.type))
+                if self.lmtp:
+                    return self.rcpt_replies(m_to, error.recipients, None)
+                return self.do_exit(550, 'Server refused sender or recipients')
+            except SMTPSenderRefused:
+                LOG(E_ERR, '%s-sendmail: Server refused sender' % (self.type))
+                return self.do_exit(550, 'Server refused sender or recipients')
+            except:
+                t, v, tb = exc_info()
+                LOG(E_ERR, '%s-sendmail: sent failed: %s: %s' % (self.type, t, v))
+                return self.do_exit(443, 'Delivery failed to next hop')
+            else:
+                okmsg = 'Sendmail Ok'
+                if aid: okmsg = 'Archived as: ' + str(aid)
+                if server_reply != {}:
+                    LOG(E_ERR, '%s-sendmail: ok but not all recipients where accepted %s' % (self.type, server_reply))
+
+                ## The next hop retries the refused recipients, they must get the same AID
+                if hash is not None and server_reply == {}:
+                    if self.hashdb_del(hash):
+                        LOG(E_TRACE, '%s-sendmail: expunged msg %s from hashdb' % (self.type, aid))
+                    if self.storage is not None:
+                        self.storage.hashdb_del(hash)
+                if self.lmtp and server_reply != {}:
+                    return self.rcpt_replies(m_to, server_reply, self.do_exit(250, okmsg, 200))
+                return self.do_exit(250, okmsg, 200)
+
+        def check_sender(self, mailfrom, size):
+            """Sender quota check at MAIL FROM time with the declared size"""
+            if self.type != 'archive' or dbchecker is None or not size:
+                return None
+            sender = safe_parseaddr(mailfrom)
+            if sender is not None and dbchecker.quota_check(sender, size >> 10):
+                return self.do_exit(422, 'Sender quota execeded')
+            return None
+
+        def rcpt_replies(self, m_to, refused, ok):
+            """LMTP replies for each recipient, the next hop reply for the refused ones"""
+            replies = []
+            for rcpt in m_to:
+                if refused.has_key(rcpt):
+                    code, msg = refused[rcpt]
+                    replies.append('%d %s' % (code, msg.replace('\n', ' ')))
                 else:
-                    okmsg = 'Sendmail Ok'
-                    if aid: okmsg = 'Archived as: ' + str(aid)
-                    if server_reply != {}:
-                        LOG(E_ERR, '%s-sendmail: ok but not all recipients where accepted %s' % (self.type, server_reply))
-
-                    if hash is not None and self.hashdb.has_key(hash):
-                        LOG(E_TRACE, '%s-sendmail: expunging msg %s from hashdb' % (self.type, aid))
-                        try:
-                            del self.hashdb[hash]
-                            self.hashdb.sync()
-                        except:
-                            pass
-                    return self.do_exit(250, okmsg, 200)
-            finally:
-                try:
-                    server.close()
-                except: pass
+                    replies.append(ok)
+            return replies
 
         def do_exit(self, code, msg='', extcode=None):
             """Exit function
 
             @returns: exit code and messages"""
-            self.del_channel()
             if not extcode:
                 extcode = code
             excode = '.'.join([x for x in str(extcode)])
@@ -428,23 +549,45 @@ def StageHandler(config, stage_type):
             size = len(data)
             if size < MINSIZE:
                 return self.do_exit(550, 'Invalid Mail')
+            if not isinstance(data, StringType):
+                ## Spooled data, scanned in place
+                data = data.mapped()
 
-            if not data.endswith(NL):
-                data = data + NL
-
-            stream = StringIO(data)
-            msg = Message(stream)
+            ## Only the headers are scanned
+            msg = ScannedMessage(data)
             aid = msg.get(AID, None)
+            mail = with_newline(Segments(data), data)
 
             ## Check if I have msgid in my cache
             mid = msg.get('message-id', self.new_mid())
             LOG(E_TRACE, '%s: Message-id: %s' % (self.type, mid))
             hash = hash_headers(msg.get)
-            if self.hashdb.has_key(hash):
-                aid = self.hashdb[hash]
+            hashed_aid = self.hashdb_get(hash)
+            if hashed_aid is not None:
+                aid = hashed_aid
                 LOG(E_ERR, '%s: Message already processed' % self.type)
-                return self.sendmail(sender, mail_options, recips, rcptopts, data, aid, hash)
+                return self.sendmail(sender, mail_options, recips, rcptopts, mail, aid, hash)
+
+            ## Mail needs to be processed
+            if aid:
+                error = self.store_message(mail, msg, aid, mid, hash)
+                if error is not None:
+                    return error
+            else:
+                ## Mail in whitelist - not processed
+                LOG(E_TRACE, '%s: X-Archiver-ID header not found in mail [whitelist]' % self.type)
+            del msg
+
+            ## Next hop
+            LOG(E_TRACE, '%s: passing data to nexthop: %s:%s' % (self.type, self.output_address, self.output_port))
+            return self.sendmail(sender, mail_options, recips, rcptopts, mail, aid, hash)
+
+        def store_message(self, mail, msg, aid, mid, hash):
+            """Stores the mail using the storage Backend
 
+            Shared by process_storage and the archive stage passthrough
+            @param mail: the mail as Segments
+            @return: None or the error reply"""
             ## Date extraction
             m_date = None
             if self.datefromemail:
@@ -457,40 +600,54 @@ def StageHandler(config, stage_type):
             if m_date is None:
                 m_date = localtime(time())
 
-            del msg, stream
+            try:
+                year, pid = aid.split('-', 1)
+                year = int(year)
+                pid = int(pid)
+            except:
+                t, val, tb = exc_info()
+                del tb
+                LOG(E_ERR, '%s: Invalid X-Archiver-ID header [%s]' % (self.type, str(val)))
+                return self.do_exit(550, 'Invalid X-Archiver-ID header')
 
-            ## Mail needs to be processed
-            if aid:
-                try:
-                    year, pid = aid.split('-', 1)
-                    year = int(year)
-                    pid = int(pid)
-                except:
-                    t, val, tb = exc_info()
-                    del tb
-                    LOG(E_ERR, '%s: Invalid X-Archiver-ID header [%s]' % (self.type, str(val)))
-                    return self.do_exit(550, 'Invalid X-Archiver-ID header')
-
-                args = dict(mail=data, year=year, pid=pid, date=m_date, mid=mid, hash=hash)
-                LOG(E_TRACE, '%s: year is %d - pid is %d (%s)' % (self.type, year, pid, mid))
-                status, code, msg = self.backend.process(args)
-                if status == 0:
-                    LOG(E_ERR, '%s: process failed %s' % (self.type, msg))
-                    return self.do_exit(code, msg)
-
-                ## Inserting in hashdb
-                LOG(E_TRACE, '%s: inserting %s msg in hashdb' % (self.type, aid))
-                self.hashdb[hash] = aid
-                self.hashdb.sync()
-                LOG(E_TRACE, '%s: backend worked fine' % self.type)
-            else:
-                ## Mail in whitelist - not processed
-                LOG(E_TRACE, '%s: X-Archiver-ID header not found in mail [whitelist]' % self.type)
-            ## Next hop
-            LOG(E_TRACE, '%s: passing data to nexthop: %s:%s' % (self.type, self.output_address, self.output_port))
-            return self.sendmail(sender, mail_options, recips, rcptopts, data, aid, hash)
+            args = dict(mail=mail, year=year, pid=pid, date=m_date, mid=mid, hash=hash)
+            LOG(E_TRACE, '%s: year is %d - pid is %d (%s)' % (self.type, year, pid, mid))
+            status, code, msg = self.process_backend(args)
+            if status == 0:
+                LOG(E_ERR, '%s: process failed %s' % (self.type, msg))
+                return self.do_exit(code, msg)
+
+            ## Inserting in hashdb
+            LOG(E_TRACE, '%s: inserting %s msg in hashdb' % (self.type, aid))
+            self.hashdb_put(hash, aid)
+            LOG(E_TRACE, '%s: backend worked fine' % self.type)
+            return None
+
+        def set_storage(self, storage):
+            """Archive stage passthrough: archived mails are stored by the
+            storage stage of this process and then sent to its next hop"""
+            self.storage = storage
+            self.outpool.close()
+            self.outpool = storage.outpool
+            self.output_address = storage.output_address
+            self.output_port = storage.output_port
+            LOG(E_ALWAYS, '%s: Passing archived mails to %s stage' % (self.type, storage.type))
+
+        def passthrough(self, mail, msg, aid, mid, hash, hit):
+            """Stores an archived mail with the storage stage
+
+            @param hit: the mail was already in the archive hashdb, so it may have
+                        been stored too, else the storage hashdb lookup is skipped
+            @return: None or the error reply"""
+            if hit and self.storage.hashdb_get(hash) is not None:
+                LOG(E_TRACE, '%s: Message already stored' % self.type)
+                return None
+            return self.storage.store_message(mail, msg, aid, mid, hash)
 
         def add_aid(self, data, msg, aid):
+            """Adds or overwrites the X-Archiver-ID header
+
+            @return: the mail as Segments, the body is not copied, or None"""
             archiverid = '%s: %s' % (AID, aid)
             LOG(E_INFO, '%s: %s' % (self.type, archiverid))
             archiverid = archiverid + NL
@@ -499,28 +656,31 @@ def StageHandler(config, stage_type):
                 LOG(E_TRACE, '%s: Warning overwriting X-Archiver-ID header' % self.type)
                 ## Overwrite existing header
                 try:
-                    data = re_aid.sub(archiverid, headers, 1).strip() + STARTOFBODY + data[msg.startofbody:]
+                    headers = re_aid.sub(archiverid, headers, 1).strip() + STARTOFBODY
                 except:
                     t, val, tb = exc_info()
                     del tb
-                    LOG(E_ERR, '%: Error overwriting X-Archiver-ID header: %s' % (self.type, str(val)))
+                    LOG(E_ERR, '%s: Error overwriting X-Archiver-ID header: %s' % (self.type, str(val)))
                     return None
             else:
-                data = headers.strip() + NL + archiverid + STARTOFBODY + data[msg.startofbody:]
+                headers = headers.strip() + NL + archiverid + NL
 
-            return data
+            return with_newline(msg.withheaders(headers), data)
 
         def remove_aid(self, data, msg):
+            """Removes the X-Archiver-ID header
+
+            @return: the mail as Segments"""
             if msg.get(AID, None):
                 LOG(E_TRACE, '%s: This mail should not have X-Archiver-ID header, removing it' % self.type)
                 try:
                     headers = data[:msg.startofbody]
-                    data = re_aid.sub('', headers, 1).strip() + STARTOFBODY + data[msg.startofbody:]
+                    return with_newline(msg.withheaders(re_aid.sub('', headers, 1).strip() + STARTOFBODY), data)
                 except:
                     t, val, tb = exc_info()
                     del tb
                     LOG(E_ERR, '%s: Error removing X-Archiver-ID header: %s' % (self.type, str(val)))
-            return data
+            return with_newline(Segments(data), data)
 
         def process_archive(self, peer, sender, mail_options, recips, rcptopts, data):
 
@@ -530,28 +690,32 @@ def StageHandler(config, stage_type):
             size = len(data)
             if size < MINSIZE:
                 return self.do_exit(550, 'Invalid Mail')
-
-            if not data.endswith(NL):
-                data = data + NL
+            if not isinstance(data, StringType):
+                ## Spooled data, scanned in place
+                data = data.mapped()
 
             args = {}
             aid = None
             mid = None
-            stream = StringIO(data)
-            msg = Message(stream)
+            msg = ScannedMessage(data)
 
             if sender == '':
                 LOG(E_INFO, '%s: Null return path mail, not archived' % (self.type))
-                return self.sendmail('<>', mail_options, recips, rcptopts, data, aid)
+                return self.sendmail('<>', mail_options, recips, rcptopts, with_newline(Segments(data), data), aid)
 
             ## Check if I have msgid in my cache
             mid = msg.get('message-id', self.new_mid())
             hash = hash_headers(msg.get)
-            if self.hashdb.has_key(hash):
+            aid = self.hashdb_get(hash)
+            if aid is not None:
                 LOG(E_TRACE, '%s: Message-id: %s' % (self.type, mid))
-                aid = self.hashdb[hash]
                 LOG(E_TRACE, '%s: Message already has year/pid pair, only adding header' % self.type)
-                return self.sendmail(sender, mail_options, recips, rcptopts, self.add_aid(data, msg, aid), aid, hash)
+                mail = self.add_aid(data, msg, aid)
+                if self.storage is not None and mail is not None:
+                    error = self.passthrough(mail, msg, aid, mid, hash, True)
+                    if error is not None:
+                        return error
+                return self.sendmail(sender, mail_options, recips, rcptopts, mail, aid, hash)
             args['m_mid'] = mid
             args['hash'] = hash
 
@@ -612,7 +776,7 @@ def StageHandler(config, stage_type):
 
             ## Extract 'Subject' field
             m_sub = mime_decode_header(msg.get('Subject', 'No Subject'))
-            if subjpattern is not None and m_sub.find(subjpattern) != -1:
+            if policy.subject(m_sub):
                 LOG(E_INFO, '%s: Subject pattern matched, not archived' % self.type)
                 return self.sendmail(sender, mail_options, recips, rcptopts, self.remove_aid(data, msg))
             args['m_sub'] = m_sub
@@ -623,10 +787,10 @@ def StageHandler(config, stage_type):
             if ss is not None:
                 checklist.append(ss)
 
-            for check in checklist:
-                if check.split('@', 1)[0] in whitelist:
-                    LOG(E_INFO, '%s: Mail to: %s in whitelist, not archived' % (self.type, check))
-                    return self.sendmail(sender, mail_options, recips, rcptopts, self.remove_aid(data, msg))
+            check = policy.whitelisted(checklist)
+            if check is not None:
+                LOG(E_INFO, '%s: Mail to: %s in whitelist, not archived' % (self.type, check))
+                return self.sendmail(sender, mail_options, recips, rcptopts, self.remove_aid(data, msg))
 
             ## Sender size limit check - in kb
             if dbchecker is not None and dbchecker.quota_check(m_from, size >> 10):
@@ -646,22 +810,7 @@ def StageHandler(config, stage_type):
                 m_date = localtime(time())
             args['m_date'] = m_date
 
-            m_attach = []
-            if msg.maintype != 'multipart':
-                m_parse = parse_message(msg)
-                if m_parse is not None:
-                    m_attach.append(m_parse)
-            else:
-                filepart = MultiFile(stream)
-                filepart.push(msg.getparam('boundary'))
-                try:
-                    while filepart.next():
-                        submsg = Message(filepart)
-                        subpart = parse_message(submsg)
-                        if subpart is not None:
-                            m_attach.append(subpart)
-                except:
-                    LOG(E_ERR, '%s: Error in multipart splitting' % self.type)
+            m_attach = msg.attachments()
             args['m_attach'] = m_attach
 
             if dbchecker is not None:
@@ -673,22 +822,27 @@ def StageHandler(config, stage_type):
             else:
                 args['m_mboxes'] = []
 
-            year, pid, error = self.backend.process(args)
+            year, pid, error = self.process_backend(args)
             if year == 0:
                 LOG(E_ERR, '%s: Backend Error: %s' % (self.type, error))
                 return self.do_exit(pid, error)
 
             ## Adding X-Archiver-ID: header
             aid = '%d-%d' % (year, pid)
-            data = self.add_aid(data, msg, aid)
+            mail = self.add_aid(data, msg, aid)
             LOG(E_TRACE, '%s: inserting %s msg in hashdb' % (self.type, aid))
-            self.hashdb[hash] = aid
-            self.hashdb.sync()
+            self.hashdb_put(hash, aid)
+
+            ## Storage in this process, new mail so it can't be already stored
+            if self.storage is not None and mail is not None:
+                error = self.passthrough(mail, msg, aid, mid, hash, False)
+                if error is not None:
+                    return error
 
             ## Next hop
             LOG(E_TRACE, '%s: backend worked fine' % self.type)
             LOG(E_TRACE, '%s: passing data to nexthop: %s:%s' % (self.type, self.output_address, self.output_port))
-            return self.sendmail(sender, mail_options, recips, rcptopts, data, aid, hash)
+            return self.sendmail(sender, mail_options, recips, rcptopts, mail, aid, hash)
 ##### Class Wrapper - End
     return apply(StageHandler, (input_classes[input_class], config, stage_type))
 
@@ -791,6 +945,93 @@ class DBChecker(Thread):
         self.lock.release()
         return res
 
+def with_newline(mail, data):
+    """appends the missing newline at the end of the mail as its own segment
+
+    @param mail: the mail as Segments, ending with the end of data"""
+    if data[-1:] != NL:
+        mail.append(NL)
+    return mail
+
+def get_hashdb(config, stage):
+    """opens the hashdb of stage, the store of the mails already processed"""
+    try:
+        hashdbsync = config.get(stage, 'hashdbsync').lower()
+    except:
+        hashdbsync = 'batch'
+    try:
+        hashdbbatch = config.getint(stage, 'hashdbbatch')
+    except:
+        hashdbbatch = BATCH
+    try:
+        hashdbwindow = config.getfloat(stage, 'hashdbwindow')
+    except:
+        hashdbwindow = WINDOW
+    try:
+        hashdbttl = config.getint(stage, 'hashdbttl')
+    except:
+        hashdbttl = TTL
+    try:
+        hashdbgenerations = config.getint(stage, 'hashdbgenerations')
+    except:
+        hashdbgenerations = GENERATIONS
+    try:
+        hashdbmaxkeys = config.getint(stage, 'hashdbmaxkeys')
+    except:
+        hashdbmaxkeys = MAXKEYS
+    return DedupStore(config.get(stage, 'hashdb'), hashdbttl, hashdbgenerations,
+                      hashdbmaxkeys, hashdbsync, hashdbbatch, hashdbwindow)
+
+def get_hostname(config):
+    """hostname to use in smtp replies, None to resolve the local fqdn"""
+    try:
+        return config.get('global', 'hostname')
+    except:
+        return None
+
+def get_passthrough(config, stages):
+    """True if the archive stage passes archived mails to the storage stage in process"""
+    try:
+        passthrough = config.getboolean('archive', 'passthrough')
+    except:
+        return False
+    if passthrough and 'storage' not in stages:
+        LOG(E_ERR, '[Main] passthrough needs the storage stage, disabled')
+        return False
+    return passthrough
+
+def get_policy(config):
+    """whitelist and subject patterns from the global section
+
+    whitelist is a comma separated list, whitelistfile a file with an
+    entry for each line, subjpattern has a rule for each line"""
+    whitelist = []
+    try:
+        whitelist = config.get('global', 'whitelist').split(',')
+    except:
+        pass
+    try:
+        whitelist = whitelist + read_entries(config.get('global', 'whitelistfile'))
+    except:
+        t, val, tb = exc_info()
+        del tb
+        if config.has_option('global', 'whitelistfile'):
+            LOG(E_ERR, '[Main] Cannot read whitelist file: %s' % str(val))
+
+    subjects = []
+    try:
+        subjects = [ rule.strip() for rule in config.get('global', 'subjpattern').split(NL) ]
+    except:
+        pass
+
+    try:
+        newpolicy = Policy(whitelist, subjects)
+    except re.error, val:
+        LOG(E_ERR, '[Main] Invalid subject pattern: %s' % str(val))
+        newpolicy = Policy(whitelist)
+    LOG(E_TRACE, '[Main] Whitelist has %d entries, %d subject patterns' % (newpolicy.count, newpolicy.rules))
+    return newpolicy
+
 def multiplex(objs, function, *args):
     """Generic method multiplexer
 
@@ -813,10 +1054,22 @@ def sig_int_term(signum, frame):
 
     if len(serverPoll):
         LOG(E_ALWAYS, '[Main] Shutting down stages')
-        multiplex(serverPoll, 'finish')
+        multiplex(serverPoll, 'finish', False)
         multiplex(serverPoll, 'shutdown_backend')
         multiplex(serverPoll, 'stop')
 
+def sig_hup(signum, frame):
+    """Handler for SIGHUP signal
+
+    Reloads the configuration file and passes it to the StageHandler threads"""
+    global policy
+    del signum, frame # Not needed avoid pychecker warning
+    LOG(E_ALWAYS, '[Main] Got SIGHUP, reloading configuration')
+    config = ConfigParser()
+    config.read(cfgfile)
+    policy = get_policy(config)
+    multiplex(serverPoll, 'reload', config)
+
 def do_shutdown(res = 0):
     """Archiver system shutdown"""
 
@@ -913,8 +1166,9 @@ def win32_startup():
 ## Start the Archiver Service
 def ServiceStartup(configfile, user=None, debug=False, service_main=False):
     """ Archiver Service Main """
-    global LOG, main_svc, dbchecker, runas, whitelist, subjpattern, isRunning
+    global LOG, main_svc, runas, policy, cfgfile
     main_svc = service_main
+    cfgfile = configfile
     if not access(configfile, F_OK | R_OK):
         print 'Cannot read configuration file', configfile
         return -3
@@ -930,13 +1184,14 @@ def ServiceStartup(configfile, user=None, debug=False, service_main=False):
         runas, mypid = unix_startup(config, user, debug)
 
     ### Quota and Mailbox lookup stuff
+    dbfiles = {}
+    sleeptime = None
     if platform != 'win32':
         try:
             sleeptime = float(config.get('global', 'sleeptime'))
         except:
             sleeptime = 60.0
 
-        dbfiles = {}
         try:
             dbfiles['quota'] = { 'file': config.get('global', 'quotafile'), 'timestamp': 0, 'db': None }
             LOG(E_ALWAYS, '[Main] QuotaCheck Enabled')
@@ -951,33 +1206,38 @@ def ServiceStartup(configfile, user=None, debug=False, service_main=False):
         except:
             pass
 
-    ## Whitelist
-    try:
-        whitelist = config.get('global', 'whitelist').split(',')
-        LOG(E_TRACE, '[Main] My whitelist is ' + ','.join(whitelist))
-    except:
-        pass
-
-    ## Subject pattern
-    try:
-        subjpattern = config.get('global', 'subjpattern')
-    except:
-        pass
+    ## Whitelist and subject patterns
+    policy = get_policy(config)
 
     ## Starting up
     LOG(E_INFO, '[Main] Running as user %s pid %s' % (runas, mypid))
 
-    ## Creating stage sockets
-    sections = config.sections()
-    if 'archive' in sections:
-        serverPoll.append(StageHandler(config, 'archive'))
-    if 'storage' in sections:
-        serverPoll.append(StageHandler(config, 'storage'))
-
-    if len(serverPoll) == 0:
+    stages = [ stage for stage in ('archive', 'storage') if stage in config.sections() ]
+    if len(stages) == 0:
         LOG(E_ALWAYS, '[Main] No stages configured, Aborting...')
         return do_shutdown(-7)
 
+    ## Prefork mode if a stage has workers
+    if platform != 'win32':
+        workers = stage_workers(config, stages)
+        if max(workers.values()) > 0:
+            return supervise(config, workers, dbfiles, sleeptime)
+
+    return run_stages(config, stages, dbfiles, sleeptime)
+
+def run_stages(config, stages, dbfiles, sleeptime):
+    """Runs the stages in this process until SIGINT/SIGTERM"""
+    global dbchecker, isRunning
+
+    ## Creating stage sockets
+    handlers = {}
+    for stage in stages:
+        handlers[stage] = StageHandler(config, stage)
+        serverPoll.append(handlers[stage])
+
+    if get_passthrough(config, stages):
+        handlers['archive'].set_storage(handlers['storage'])
+
     if platform != 'win32' and len(dbfiles):
         dbchecker = DBChecker(dbfiles, sleeptime)
         serverPoll.append(dbchecker)
@@ -995,7 +1255,7 @@ def ServiceStartup(configfile, user=None, debug=False, service_main=False):
         LOG(E_TRACE, '[Main] Installing signal handlers')
         signal(SIGINT,  sig_int_term)
         signal(SIGTERM, sig_int_term)
-        signal(SIGHUP,  SIG_IGN)
+        signal(SIGHUP,  sig_hup)
 
     while isRunning:
         try:
@@ -1007,6 +1267,182 @@ def ServiceStartup(configfile, user=None, debug=False, service_main=False):
     ## Shutdown
     return do_shutdown(0)
 
+#### Prefork mode - unix only
+def unix_input(config, stage):
+    """True if the stage listens on a unix socket"""
+    return config.get(stage, 'input').split(':', 2)[1] == 'unix'
+
+def stage_workers(config, stages):
+    """returns the number of worker processes for each stage, 0 means in process"""
+    workers = {}
+    for stage in stages:
+        try:
+            workers[stage] = config.getint(stage, 'workers')
+        except:
+            workers[stage] = 0
+        if workers[stage] > 1 and unix_input(config, stage):
+            LOG(E_ERR, '[Main] %s: unix sockets cannot be shared, using one worker' % stage)
+            workers[stage] = 1
+    ## With passthrough the storage stage listens in each archive worker
+    if workers.get('archive', 0) > 1 and get_passthrough(config, stages) and unix_input(config, 'storage'):
+        LOG(E_ERR, '[Main] storage: unix sockets cannot be shared, using one archive worker')
+        workers['archive'] = 1
+    return workers
+
+def spawn(config, stages, index, dbfiles, sleeptime):
+    """forks a worker process running the stages"""
+    global workerid, pidfile
+    stage = '+'.join(stages)
+    pid = fork()
+    if pid:
+        children[pid] = (stages, index)
+        LOG(E_ALWAYS, '[Main] Started %s worker %d pid %d' % (stage, index, pid))
+        return
+    ## Worker process, never returns to the supervisor
+    res = -8
+    try:
+        try:
+            signal(SIGTERM, SIG_DFL)
+            signal(SIGINT, SIG_DFL)
+            signal(SIGHUP, SIG_IGN)
+            workerid = index
+            pidfile = None
+            children.clear()
+            for name, sock in dedupservers.values():
+                sock.close()
+            dedupservers.clear()
+            res = run_stages(config, stages, dbfiles, sleeptime)
+        except SystemExit, e:
+            res = e.code
+        except:
+            t, val, tb = exc_info()
+            del tb
+            LOG(E_ERR, '[Main] %s worker %d failed: %s' % (stage, index, str(val)))
+    finally:
+        _exit(res or 0)
+
+def spawn_dedup(config, stage, sock):
+    """forks the process owning the hashdb of stage, shared by its workers
+
+    @param sock: the listening socket, it outlives the process"""
+    pid = fork()
+    if pid:
+        dedupservers[pid] = (stage, sock)
+        LOG(E_ALWAYS, '[Main] Started %s hashdb server pid %d' % (stage, pid))
+        return
+    ## Server process, never returns to the supervisor
+    res = -9
+    try:
+        try:
+            ## Stopped by the supervisor when the workers are gone
+            signal(SIGINT, SIG_IGN)
+            signal(SIGHUP, SIG_IGN)
+            server = DedupServer(get_hashdb(config, stage), sock)
+            signal(SIGTERM, lambda signum, frame: server.stop())
+            server.serve()
+            res = 0
+        except:
+            t, val, tb = exc_info()
+            del tb
+            LOG(E_ERR, '[Main] %s hashdb server failed: %s' % (stage, str(val)))
+    finally:
+        _exit(res)
+
+def sig_supervisor(signum, frame):
+    """Handler for SIGINT and SIGTERM signals in the supervisor"""
+    global isRunning
+    del frame # Not needed avoid pychecker warning
+    if not isRunning: return # already called
+    LOG(E_ALWAYS, '[Main] Got SIGINT/SIGTERM, stopping workers')
+    isRunning = False
+    for pid in children.keys():
+        try:
+            kill(pid, SIGTERM)
+        except: pass
+
+def sig_hup_supervisor(signum, frame):
+    """Handler for SIGHUP signal in the supervisor, passed to the workers"""
+    del frame # Not needed avoid pychecker warning
+    LOG(E_ALWAYS, '[Main] Got SIGHUP, passing to workers')
+    for pid in children.keys():
+        try:
+            kill(pid, SIGHUP)
+        except: pass
+
+def supervise(config, workers, dbfiles, sleeptime):
+    """Forks the stage workers and restarts them when they die
+
+    The hashdb of a stage with more than one worker is owned by a server
+    process: a retried mail can reach any of the workers, they must all
+    see the mails already processed"""
+    global isRunning
+    isRunning = True
+    ## With passthrough the storage stage runs in the archive workers
+    groups = {}
+    for stage in workers.keys():
+        groups[stage] = [ stage ]
+    if get_passthrough(config, workers.keys()):
+        groups['archive'].append('storage')
+        del groups['storage']
+    for stage in groups.keys():
+        if workers[stage] < 2:
+            continue
+        for member in groups[stage]:
+            dedupaddrs[member] = config.get(member, 'hashdb') + '.sock'
+            spawn_dedup(config, member, listener(dedupaddrs[member]))
+    for stage in groups.keys():
+        for index in range(max(workers[stage], 1)):
+            spawn(config, groups[stage], index, dbfiles, sleeptime)
+
+    signal(SIGINT,  sig_supervisor)
+    signal(SIGTERM, sig_supervisor)
+    signal(SIGHUP,  sig_hup_supervisor)
+
+    while children:
+        try:
+            pid, status = waitpid(-1, 0)
+        except OSError, e:
+            if e.errno == ECHILD:
+                LOG(E_ERR, '[Main] No worker processes left')
+                break
+            ## Interrupted by a signal
+            continue
+        if dedupservers.has_key(pid):
+            stage, sock = dedupservers[pid]
+            del dedupservers[pid]
+            if isRunning:
+                LOG(E_ERR, '[Main] %s hashdb server pid %d died with status %d, restarting' % (stage, pid, status))
+                sleep(RESPAWNDELAY)
+                spawn_dedup(config, stage, sock)
+            continue
+        if not children.has_key(pid):
+            continue
+        stages, index = children[pid]
+        del children[pid]
+        if isRunning:
+            LOG(E_ERR, '[Main] %s worker %d pid %d died with status %d, restarting' % ('+'.join(stages), index, pid, status))
+            sleep(RESPAWNDELAY)
+            spawn(config, stages, index, dbfiles, sleeptime)
+
+    ## The workers are gone, the hashdb servers can flush and exit
+    for pid, (stage, sock) in dedupservers.items():
+        try:
+            kill(pid, SIGTERM)
+        except OSError: pass
+        while 1:
+            try:
+                waitpid(pid, 0)
+            except OSError, e:
+                if e.errno == EINTR:
+                    continue
+            break
+        sock.close()
+        try:
+            unlink(dedupaddrs[stage])
+        except: pass
+
+    return do_shutdown(0)
+
 ## Main
 if __name__ == '__main__':
     if platform == 'win32':
@@ -21,18 +21,51 @@
 
 __doc__ = '''Netfarm Archiver - release 2.1.0 - Filesystem backend'''
 __version__ = '2.1.0'
-__all__ = [ 'Backend' ]
+__all__ = [ 'Backend', 'DirCache' ]
 
 from archiver import *
 from sys import exc_info
 from os import path, access, makedirs, F_OK, R_OK, W_OK
 from compress import CompressedFile, compressors
+from mimescan import Segments
 
 ##
 class BadStorageDir(Exception):
     """BadStorageDir Bad Storage directory in config file"""
     pass
 
+class DirCache:
+    """Storage directories known to exist
+
+    A year/month directory changes once a month, it's checked and made
+    the first time and then remembered. A directory is forgotten when a
+    write in it fails, it's checked again with the next mail"""
+    def __init__(self):
+        self.dirs = {}
+
+    def check(self, mailpath):
+        """makes mailpath if needed
+
+        @return: None or the error message"""
+        if self.dirs.has_key(mailpath):
+            return None
+        if not access(mailpath, F_OK | R_OK | W_OK):
+            try:
+                makedirs(mailpath, 0700)
+            except:
+                t, val, tb = exc_info()
+                del tb
+                return '%s: %s' % (t, val)
+        self.dirs[mailpath] = True
+        return None
+
+    def forget(self, mailpath=None):
+        """forgets mailpath, or all the directories"""
+        if mailpath is None:
+            self.dirs.clear()
+        elif self.dirs.has_key(mailpath):
+            del self.dirs[mailpath]
+
 class Backend(BackendBase):
     """Filesystem Backend Class
 
@@ -72,6 +105,7 @@ class Backend(BackendBase):
             self.LOG(E_ERR, 'Invalid compression option: %s' % self.compression)
             raise BadConfig, 'Invalid compression option'
 
+        self.dirs = DirCache()
         self.LOG(E_ALWAYS, 'Filesystem Backend (%s) at %s ' % (self.type, self.storagedir))
 
     ## Gets mailpath and filename
@@ -86,31 +120,21 @@ class Backend(BackendBase):
         mailpath, filename = self.get_paths(data)
 
         ## First check integrity
-        error = None
-        if not access(mailpath, F_OK | R_OK | W_OK):
-            error = 'No access to mailpath'
-            try:
-                makedirs(mailpath, 0700)
-                error = None
-            except:
-                t, val, tb = exc_info()
-                del tb
-                error = '%s: %s' % (t, val)
-                self.LOG(E_ERR, 'Filesystem Backend: Cannot create storage directory: ' + str(val))
-
+        error = self.dirs.check(mailpath)
         if error is not None:
+            self.LOG(E_ERR, 'Filesystem Backend: Cannot create storage directory: ' + error)
             return 0, 443, error
 
         if self.compression is not None:
             name = '%d-%d.eml' % (data['year'], data['pid'])
             comp = CompressedFile(compressor=self.compression[0], ratio=self.compression[1], name=name)
-            comp.write(data['mail'])
-            data['mail'] = comp.getdata()
+            comp.write(str(data['mail']))
+            data['mail'] = Segments(comp.getdata())
             comp.close()
 
         try:
             fd = open(filename, 'wb')
-            fd.write(data['mail'])
+            data['mail'].writeto(fd)
             fd.flush()
             fd.close()
             self.LOG(E_TRACE, 'Filesystem Backend: wrote ' + filename)
@@ -118,6 +142,7 @@ class Backend(BackendBase):
         except:
             t, val, tb = exc_info()
             del tb
+            self.dirs.forget(mailpath)
             self.LOG(E_ERR, 'Filesystem Backend: Cannot write mail file: ' + str(val))
             return 0, 443, '%s: %s' % (t, val)
 
@@ -25,12 +25,17 @@ __all__ = [ 'Backend' ]
 
 from archiver import *
 from sys import exc_info
-from time import asctime
-from types import StringType
-from base64 import encodestring
-from psycopg2 import connect as db_connect
+from time import asctime, time, localtime
+from threading import Thread, Condition, Event, Lock
+from base64 import encodestring, decodestring
+from psycopg2 import Binary
+from pgpool import get_pool, release_pool, format_msg, PoolError
+from pgpool import MINSIZE, MAXSIZE, CHECKIDLE, WAIT
 
-mail_template = """
+## Statements are prepared on the pool connections with the name they
+## have here, values are bound as parameters of EXECUTE
+
+mail_statement = """
 INSERT INTO mail (
     mail_id,
     year,
@@ -45,81 +50,210 @@ INSERT INTO mail (
     media
 ) VALUES (
     get_next_mail_id(),
-    get_curr_year(),
-    get_new_pid(),
-    '%(message_id)s',
-    '%(from_login)s',
-    '%(from_domain)s',
-    '%(subject)s',
-    '%(mail_date)s',
-    %(mail_size)s,
-    %(attachment)s,
+    %s,
+    %s,
+    $1,
+    $2,
+    $3,
+    $4,
+    $5,
+    $6,
+    $7,
     -1
-);
-"""
+)"""
 
-recipient_template = """
+archive_statements = {
+    'archive_mail'      : mail_statement % ('get_curr_year()', 'get_new_pid()'),
+    'archive_mail_pid'  : mail_statement % ('$8', '$9'),
+    'archive_recipient' : """
 INSERT INTO recipient (
     mail_id,
     to_login,
     to_domain
 ) VALUES (
     get_curr_mail_id(),
-    '%(to_login)s',
-    '%(to_domain)s'
-);
-"""
-authorized_template = """
+    $1,
+    $2
+)""",
+    'archive_authorized': """
 INSERT INTO authorized (
     mail_id,
     mailbox
 ) VALUES (
     get_curr_mail_id(),
-    '%s'
-);
-"""
-
-storage_template = """
+    $1
+)""" }
+
+## Partitioned schema (sql/mail_partitioned.sql): recipient and authorized
+## have the year of the mail too, year and pid always come from a reserved
+## block so the year is known before inserting
+partitioned_statements = {
+    'archive_mail_pid'       : archive_statements['archive_mail_pid'],
+    'archive_recipient_year' : """
+INSERT INTO recipient (
+    mail_id,
+    year,
+    to_login,
+    to_domain
+) VALUES (
+    get_curr_mail_id(),
+    $3,
+    $1,
+    $2
+)""",
+    'archive_authorized_year': """
+INSERT INTO authorized (
+    mail_id,
+    year,
+    mailbox
+) VALUES (
+    get_curr_mail_id(),
+    $2,
+    $1
+)""" }
+
+## Storage modes: text is the base64 mail column, bytea stores the mail
+## as is in the data column, or as a large object referenced by the lob
+## column when bigger than lobsize
+storage_statements = {
+    'text': {
+        'storage_mail': """
 INSERT INTO mail_storage (
     year,
     pid,
     mail
 ) VALUES (
-    '%(year)d',
-    '%(pid)d',
-    '%(mail)s'
-);
+    $1,
+    $2,
+    $3
+)""" },
+    'bytea': {
+        'storage_data': """
+INSERT INTO mail_storage (
+    year,
+    pid,
+    data
+) VALUES (
+    $1,
+    $2,
+    $3
+)""",
+        'storage_lob': """
+INSERT INTO mail_storage (
+    year,
+    pid,
+    lob
+) VALUES (
+    $1,
+    $2,
+    $3
+)""" } }
+
+execute_mail       = 'EXECUTE archive_mail (%s, %s, %s, %s, %s, %s, %s);'
+execute_mail_pid   = 'EXECUTE archive_mail_pid (%s, %s, %s, %s, %s, %s, %s, %s, %s);'
+execute_recipient  = 'EXECUTE archive_recipient (%s, %s);'
+execute_authorized = 'EXECUTE archive_authorized (%s);'
+execute_recipient_year  = 'EXECUTE archive_recipient_year (%s, %s, %s);'
+execute_authorized_year = 'EXECUTE archive_authorized_year (%s, %s);'
+execute_storage    = 'EXECUTE storage_mail (%s, %s, %s);'
+execute_data       = 'EXECUTE storage_data (%s, %s, %s);'
+execute_lob        = 'EXECUTE storage_lob (%s, %s, %s);'
+
+## Retrieval, bytea is read a chunk at time
+retrieve_template = 'SELECT mail, octet_length(data), lob FROM mail_storage WHERE year = %s AND pid = %s;'
+retrieve_chunk_template = 'SELECT substring(data from %s for %s) FROM mail_storage WHERE year = %s AND pid = %s;'
+
+## Batch mode: mail_id are taken from the sequence first, the rows of
+## all the mails of the batch are inserted with one statement for table
+batch_ids_template = """
+SELECT nextval('mail_id_sequence') FROM generate_series(1, %d);
+"""
+
+batch_mail_template = """
+INSERT INTO mail (
+    mail_id,
+    year,
+    pid,
+    message_id,
+    from_login,
+    from_domain,
+    subject,
+    mail_date,
+    mail_size,
+    attachment,
+    media
+) VALUES %s;
 """
 
+batch_mail_row     = '(%s, get_curr_year(), get_new_pid(), %s, %s, %s, %s, %s, %s, %s, -1)'
+batch_mail_pid_row = '(%s, %s, %s, %s, %s, %s, %s, %s, %s, %s, -1)'
+
+batch_recipient_template = """
+INSERT INTO recipient (
+    mail_id,
+    to_login,
+    to_domain
+) VALUES %s;
+"""
+
+batch_authorized_template = """
+INSERT INTO authorized (
+    mail_id,
+    mailbox
+) VALUES %s;
+"""
+
+batch_recipient_year_template = """
+INSERT INTO recipient (
+    mail_id,
+    year,
+    to_login,
+    to_domain
+) VALUES %s;
+"""
+
+batch_authorized_year_template = """
+INSERT INTO authorized (
+    mail_id,
+    year,
+    mailbox
+) VALUES %s;
+"""
+
+batch_result_template = """
+SELECT mail_id, year, pid FROM mail WHERE mail_id IN (%s);
+"""
+
+reserve_template = 'SELECT year, pid FROM reserve_pids(%d);'
+
+### Batch mode defaults
+BATCHSIZE = 0    # mails, 0 disables
+BATCHWAIT = 20.0 # milliseconds
+BATCHTIMEOUT = 60 # seconds a session waits for its batch
+PIDBLOCK  = 0    # pids reserved at time, 0 disables
+PARTBLOCK = 1000 # pids reserved at time with the partitioned schema
+
+### Durability of the commits
+## synchronous: each mail waits for its WAL flush
+## async_commit: synchronous_commit is off, commits return before the
+##   flush, a server crash loses the last 3 x wal_writer_delay of mails
+## batched: archive only, mails are committed a batch at time and each
+##   batch waits for its flush
+DURABILITY = 'synchronous'
+TIERS      = ('synchronous', 'async_commit', 'batched')
+BATCHED    = 32  # batchsize of the batched tier when not given
+
+### Storage defaults
+STORAGEMODE = 'text'
+LOBSIZE     = 0       # bytes, bigger mails are large objects, 0 disables
+CHUNK       = 1048576 # bytes read at time retrieving a mail
+
 ##
-def sql_quote(text):
-    """sql_quote
-
-    quotes special chars and removes NULL chars
-    @param text: is the text that should be quoted
-    @return: quoted string"""
-    text = text.replace('\x00', '')
-    text = text.replace("\\", "\\\\")
-    text = text.replace("'", "\\'")
-    return text
-
-def quote_dict(info):
-    for key in info.keys():
-        if type(info[key]) == StringType:
-            info[key] = sql_quote(info[key])
-
-def format_msg(msg):
-    """Formats an error message from pgsql backend
-
-    removes tabs and replaces cr with commas, also trims the msg to 256 chars
-    @param msg: is the original object for error message
-    @return: formatted message"""
-    msg = str(msg)
-    if len(msg) > 256:
-        msg = msg[:256] + '...(message too long)'
-    msg = ', '.join(msg.strip().split('\n'))
-    msg = msg.replace('\t', '')
-    return msg
+def sql_clean(text):
+    """removes NULL chars, they can't be in a text value
+
+    Quoting is done by the driver when binding parameters"""
+    return text.replace('\x00', '')
 
 class BadConnectionString(Exception):
     """BadConnectionString The specified connection string is wrong"""
@@ -129,14 +263,184 @@ class ConnectionError(Exception):
     """ConnectionError An error occurred when connecting to PGSQL"""
     pass
 
+class PidAllocator:
+    """Hands out year/pid pairs from blocks reserved with reserve_pids()
+
+    The mail_pid row is updated once for block instead of once for mail.
+    A new block is reserved when the current one is used or the year
+    changes; pids left in a block when the year changes or the archiver
+    stops are never used."""
+    def __init__(self, backend, blocksize):
+        self.backend = backend
+        self.blocksize = blocksize
+        self.lock = Lock()
+        self.localyear = None
+        self.year = None
+        self.next = 1
+        self.last = 0
+
+    def reserve(self):
+        """reserves a new block, lock must be held"""
+        res, data, msg = self.backend.do_query(reserve_template % self.blocksize, True, True)
+        if not res or len(data) != 2:
+            raise ConnectionError, msg
+        self.year, self.next = data
+        self.last = self.next + self.blocksize - 1
+        self.backend.LOG(E_TRACE, self.backend._prefix + 'reserved pids %d-%d of %d' % (self.next, self.last, self.year))
+
+    def get(self):
+        """returns a new year, pid
+
+        raises ConnectionError if a block cannot be reserved"""
+        self.lock.acquire()
+        try:
+            ## The year of the block is the db one, the local clock only triggers the change
+            localyear = localtime()[0]
+            if self.next > self.last or localyear != self.localyear:
+                self.reserve()
+                self.localyear = localyear
+            pid = self.next
+            self.next = self.next + 1
+            return self.year, pid
+        finally:
+            self.lock.release()
+
+class ArchiveJob:
+    """A mail waiting in the batch for its year/pid"""
+    def __init__(self, values, recipients, mboxes):
+        self.values = values
+        self.recipients = recipients
+        self.mboxes = mboxes
+        self.mail_id = None
+        self.result = None
+        self.done = Event()
+
+class BatchWriter(Thread):
+    """Writes the archive rows of many mails in one transaction
+
+    Sessions queue their mail and wait, the writer takes up to batchsize
+    mails, waiting at most batchwait seconds after the first one, and
+    inserts them with multi-row INSERTs, so there is one commit for
+    batch. If the batch fails each mail is written alone, a bad mail
+    doesn't fail the others. A session waits at most timeout seconds,
+    then its mail fails with a temporary error."""
+    def __init__(self, backend, batchsize, batchwait, timeout=BATCHTIMEOUT):
+        self.backend = backend
+        self.batchsize = batchsize
+        self.batchwait = batchwait
+        self.timeout = timeout
+        self.queue = []
+        self.cond = Condition()
+        self.running = True
+        Thread.__init__(self, name='BatchWriter')
+        self.setDaemon(True)
+
+    def process(self, values, recipients, mboxes):
+        """queues a mail and waits for its year, pid, message"""
+        job = ArchiveJob(values, recipients, mboxes)
+        self.cond.acquire()
+        try:
+            if not self.running:
+                return 0, 443, 'Batch writer stopped'
+            self.queue.append(job)
+            if len(self.queue) == 1 or len(self.queue) >= self.batchsize:
+                self.cond.notify()
+        finally:
+            self.cond.release()
+        job.done.wait(self.timeout)
+        if job.done.isSet():
+            return job.result
+        self.cond.acquire()
+        try:
+            ## Still queued: it will not be written, else it's late and
+            ## can be archived anyway
+            if job in self.queue:
+                self.queue.remove(job)
+        finally:
+            self.cond.release()
+        self.backend.LOG(E_ERR, self.backend._prefix + 'mail not written in %d seconds' % self.timeout)
+        return 0, 443, 'Timeout waiting for the batch'
+
+    def run(self):
+        jobs = []
+        try:
+            while 1:
+                self.cond.acquire()
+                try:
+                    while self.running and not self.queue:
+                        self.cond.wait()
+                    if not self.queue:
+                        break
+                    ## Wait for more mails to come
+                    deadline = time() + self.batchwait
+                    while self.running and len(self.queue) < self.batchsize:
+                        left = deadline - time()
+                        if left <= 0:
+                            break
+                        self.cond.wait(left)
+                    jobs = self.queue[:self.batchsize]
+                    self.queue = self.queue[self.batchsize:]
+                finally:
+                    self.cond.release()
+                self.write(jobs)
+                jobs = []
+        finally:
+            ## Nothing writes the queued mails anymore
+            self.cond.acquire()
+            self.running = False
+            jobs, self.queue = jobs + self.queue, []
+            self.cond.release()
+            for job in jobs:
+                if not job.done.isSet():
+                    job.result = (0, 443, 'Batch writer stopped')
+                    job.done.set()
+
+    def write(self, jobs):
+        """writes the jobs, each one is completed even if the writer fails"""
+        try:
+            try:
+                results = self.backend.archive_batch(jobs)
+            except:
+                t, val, tb = exc_info()
+                del tb
+                self.backend.LOG(E_ERR, self.backend._prefix + 'batch of %d failed, writing one at time: %s' % (len(jobs), format_msg(val)))
+                results = []
+                for job in jobs:
+                    try:
+                        results.append(self.backend.archive_one(job.values, job.recipients, job.mboxes))
+                    except:
+                        t, val, tb = exc_info()
+                        del tb
+                        results.append((0, 443, format_msg(val)))
+            for job, result in zip(jobs, results):
+                job.result = result
+        finally:
+            for job in jobs:
+                if job.result is None:
+                    job.result = (0, 443, 'Batch write failed')
+                job.done.set()
+
+    def stop(self):
+        """writes the queued mails and stops"""
+        self.cond.acquire()
+        self.running = False
+        self.cond.notify()
+        self.cond.release()
+        self.join()
+
 class Backend(BackendBase):
     """PGSQL Backend uses PostgreSQL database
 
         This backend can be used either as Storage either as Archive"""
-    def __init__(self, config, stage_type, ar_globals, prefix = None):
+
+    ## Each query checks out its own connection from the pool
+    threadsafe = True
+
+    def __init__(self, config, stage_type, ar_globals, prefix = None, statements = None):
         """The constructor
 
-        Initialize a connection to pgsql"""
+        Gets the connection pool of the dsn, shared with the other stages
+        @param statements: the statements to prepare, by default the ones of the stage"""
 
         self.config = config
         self.type = stage_type
@@ -150,6 +454,36 @@ class Backend(BackendBase):
         else:
             self._prefix = prefix
 
+        ## Mail column of the storage stage
+        try:
+            self.storagemode = self.config.get(self.type, 'storagemode').lower()
+        except:
+            self.storagemode = STORAGEMODE
+        if not storage_statements.has_key(self.storagemode):
+            raise BadConfig, 'Invalid storagemode %s' % self.storagemode
+        try:
+            self.lobsize = self.config.getint(self.type, 'lobsize')
+        except:
+            self.lobsize = LOBSIZE
+
+        ## Archive schema, plain is sql/mail.sql
+        try:
+            schema = self.config.get(self.type, 'schema').lower()
+        except:
+            schema = 'plain'
+        if schema not in ('plain', 'partitioned'):
+            raise BadConfig, 'Invalid schema %s' % schema
+        self.partitioned = schema == 'partitioned'
+
+        if statements is None:
+            if self.type == 'archive' and self.partitioned:
+                statements = partitioned_statements
+            elif self.type == 'archive':
+                statements = archive_statements
+            else:
+                statements = storage_statements[self.storagemode]
+        self.statements = statements
+
         try:
             dsn = self.config.get(self.type, 'dsn')
         except:
@@ -163,86 +497,139 @@ class Backend(BackendBase):
                                                               username,
                                                               password,
                                                               dbname)
-        self.connection = None
-        self.cursor = None
-        try:
-            self.connect()
-        except: pass
-        if prefix is None:
-            self.LOG(E_ALWAYS, self._prefix + '(%s) at %s' % (self.type, host))
 
-    def close(self):
-        """closes the cursor and the connection"""
+        ## Connections come from the pool of the dsn, shared with the other stages
         try:
-            self.cursor.close()
-            del self.cursor
-        except: pass
-
+            minsize = self.config.getint(self.type, 'dbpoolmin')
+        except:
+            minsize = MINSIZE
         try:
-            self.connection.close()
-            del self.connection
-        except: pass
-
-    def connect(self):
-        """make a connection to pgsql
+            maxsize = self.config.getint(self.type, 'dbpoolmax')
+        except:
+            maxsize = MAXSIZE
+        try:
+            checkidle = self.config.getint(self.type, 'dbcheckidle')
+        except:
+            checkidle = CHECKIDLE
+        try:
+            wait = self.config.getint(self.type, 'dbwait')
+        except:
+            wait = WAIT
+        ## Statement timeout in milliseconds, 0 disables
+        try:
+            self.timeout = self.config.getint(self.type, 'dbtimeout')
+        except:
+            self.timeout = 0
 
-        raises ConnectionError if fails"""
-        self.close()
-        error = None
         try:
-            self.connection = db_connect(self.dsn)
+            self.durability = self.config.get(self.type, 'durability').lower()
         except:
-            ## We can work without the db connection and call it when needed
-            t, val, tb = exc_info()
-            del t, tb
-            error = format_msg(val)
+            self.durability = DURABILITY
+        if self.durability not in TIERS:
+            raise BadConfig, 'Invalid durability %s' % self.durability
+        if self.durability == 'batched' and self.type != 'archive':
+            raise BadConfig, 'batched durability is only for the archive stage'
+        if self.durability == 'async_commit':
+            self.synccommit = 'off'
+        else:
+            self.synccommit = 'on'
 
-        if error is not None:
-            self.LOG(E_ERR, self._prefix + 'connection to database failed: ' + error)
-            raise ConnectionError, error
+        self.pool = get_pool(self.dsn, minsize, maxsize, checkidle, wait, self.pool_log)
+        self.pool.prepare(self.statements)
+        if prefix is None:
+            self.LOG(E_ALWAYS, self._prefix + '(%s) at %s, %d-%d connections, %s' % (self.type, host, minsize, maxsize, self.durability))
 
-        self.connection.set_isolation_level(0)
-        self.cursor = self.connection.cursor()
-        self.LOG(E_TRACE, self._prefix + 'I\'ve got a cursor from the driver')
+        ## Archive pids from reserved blocks
+        self.pids = None
+        if prefix is None and self.type == 'archive':
+            try:
+                pidblock = self.config.getint(self.type, 'pidblock')
+            except:
+                if self.partitioned:
+                    pidblock = PARTBLOCK
+                else:
+                    pidblock = PIDBLOCK
+            if pidblock <= 0 and self.partitioned:
+                raise BadConfig, 'The partitioned schema needs pidblock'
+            if pidblock > 0:
+                self.pids = PidAllocator(self, pidblock)
+                self.LOG(E_ALWAYS, self._prefix + '(%s) reserving %d pids at time' % (self.type, pidblock))
+
+        ## Archive batch mode, sessions call process concurrently
+        self.batch = None
+        if prefix is None and self.type == 'archive':
+            try:
+                batchsize = self.config.getint(self.type, 'batchsize')
+            except:
+                if self.durability == 'batched':
+                    batchsize = BATCHED
+                else:
+                    batchsize = BATCHSIZE
+            if batchsize <= 1 and self.durability == 'batched':
+                raise BadConfig, 'batched durability needs batchsize'
+            try:
+                batchwait = self.config.getfloat(self.type, 'batchwait')
+            except:
+                batchwait = BATCHWAIT
+            try:
+                batchtimeout = self.config.getint(self.type, 'batchtimeout')
+            except:
+                batchtimeout = BATCHTIMEOUT
+            if batchsize > 1:
+                ## Each waiting mail holds a stage worker, with fewer workers
+                ## a batch is never full and the stage loop would block
+                try:
+                    poolsize = self.config.getint(self.type, 'poolsize')
+                except:
+                    poolsize = 0
+                if poolsize < batchsize:
+                    raise BadConfig, 'batchsize %d needs poolsize of at least %d' % (batchsize, batchsize)
+                self.batch = BatchWriter(self, batchsize, batchwait / 1000.0, batchtimeout)
+                self.batch.start()
+                self.LOG(E_ALWAYS, self._prefix + '(%s) batches of %d mails, %.1f ms' % (self.type, batchsize, batchwait))
+
+    def pool_log(self, text):
+        self.LOG(E_ERR, 'PGSQL Pool: ' + text)
 
-    def do_query(self, qs, fetch=False, autorecon=False):
+    def do_query(self, qs, fetch=False, autorecon=False, fetchall=False, params=None):
         """execute a query
 
-        Query -> reconnection -> Query
+        Query -> connection lost -> Query on another connection
         @param qs: the query string
         @param fetch: if True the query must return a result
-        @param autorecon: if a query fails a db reconnection is done
+        @param autorecon: if the connection is lost the query is done again once
+        @param fetchall: if True all the rows are returned
+        @param params: values bound to the %s placeholders of qs
         @return: Boolean Status, data, and message"""
         try:
-            self.cursor.execute(qs)
-            self.connection.commit()
+            conn = self.pool.get(self.timeout, self.synccommit)
+        except PoolError, val:
+            self.LOG(E_ERR, self._prefix + 'no database connection: %s' % val)
+            return False, [], 'Internal Server Error - %s' % val
+
+        try:
+            conn.cursor.execute(qs, params)
+            conn.connection.commit()
             res = []
-            if fetch:
-                res = self.cursor.fetchone()
-            return True, res, 'Ok'
+            if fetchall:
+                res = conn.cursor.fetchall()
+            elif fetch:
+                res = conn.cursor.fetchone()
         except:
-            try:
-                self.connection.rollback()
-            except:
-                self.LOG(E_ERR, self._prefix + 'rollback failed')
+            t, val, tb = exc_info()
+            del tb
+            lost = self.pool.release(conn)
             self.LOG(E_ERR, self._prefix + 'query fails')
-            if autorecon:
-                self.LOG(E_ERR, self._prefix + 'Trying to reopen DB Connection')
-                error = None
-                try:
-                    self.connect()
-                except:
-                    error = 'Error reopening DB connectin'
-                if error is not None:
-                    return False, [], 'Internal Server Error - ' + error
-                return self.do_query(qs, fetch)
-            else:
-                t, val, tb = exc_info()
-                del tb
-                msg = format_msg(val)
-                self.LOG(E_ERR, self._prefix + 'Cannot execute query: ' + msg)
-                self.LOG(E_ERR, self._prefix + 'the query was: ' + qs)
-                return False, [], '%s: Internal Server Error' % t
+            if lost and autorecon:
+                self.LOG(E_ERR, self._prefix + 'Connection lost, trying again')
+                return self.do_query(qs, fetch, False, fetchall, params)
+            msg = format_msg(val)
+            self.LOG(E_ERR, self._prefix + 'Cannot execute query: ' + msg)
+            self.LOG(E_ERR, self._prefix + 'the query was: ' + qs)
+            return False, [], '%s: Internal Server Error' % t
+
+        self.pool.put(conn)
+        return True, res, 'Ok'
 
     def parse_recipients(self, recipients):
         result = []
@@ -254,7 +641,7 @@ class Backend(BackendBase):
                 dlog = recipient[1]
                 ddom = recipient[1]
 
-            result.append({'to_login': sql_quote(dlog[:512]), 'to_domain': sql_quote(ddom[:512]) })
+            result.append({'to_login': sql_clean(dlog[:512]), 'to_domain': sql_clean(ddom[:512]) })
         return result
 
     def process_archive(self, data):
@@ -262,70 +649,277 @@ class Backend(BackendBase):
 
         Creates a query by using data passed by the main archiver process
         @param data: is a dict containing all needed stuff
-        @return: the result of do_query"""
+        @return: year, pid and message, 0, code and message on errors"""
 
         # Conversions
-        quote_dict(data)
         nattach = len(data['m_attach'])
         mail_size = data['m_size']
-        subject = data['m_sub'][:512].encode('utf-8', 'replace')
+        subject = sql_clean(data['m_sub'][:512].encode('utf-8', 'replace'))
         mail_date = asctime(data['m_date'])
-        mid = data['m_mid'][:512]
+        mid = sql_clean(data['m_mid'][:512])
 
         slog, sdom = data['m_from'].split('@', 1)
-        slog = sql_quote(slog.strip()[:512])
-        sdom = sql_quote(sdom.strip()[:512])
+        slog = sql_clean(slog.strip()[:512])
+        sdom = sql_clean(sdom.strip()[:512])
 
-        values = { 'message_id' : mid,
-                   'from_login' : slog,
-                   'from_domain': sdom,
-                   'subject'    : subject,
-                   'mail_date'  : mail_date,
-                   'mail_size'  : mail_size,
-                   'attachment' : nattach }
+        ## In the order of the statement parameters
+        values = (mid, slog, sdom, subject, mail_date, mail_size, nattach)
 
         recipients = []
         for rec in data['m_rec']:
             rlog, rdom = rec.split('@', 1)
-            rlog = sql_quote(rlog.strip()[:512])
-            rdom = sql_quote(rdom.strip()[:512])
-            recipients.append(dict(to_login=rlog, to_domain=rdom))
+            rlog = sql_clean(rlog.strip()[:512])
+            rdom = sql_clean(rdom.strip()[:512])
+            recipients.append((rlog, rdom))
 
-        qs = mail_template % values
+        mboxes = [ sql_clean(mailbox[:512]) for mailbox in data['m_mboxes'] ]
 
-        for recipient in recipients:
-            qs = qs + recipient_template % recipient
+        if self.batch is not None:
+            return self.batch.process(values, recipients, mboxes)
+        return self.archive_one(values, recipients, mboxes)
+
+    def new_pid(self):
+        """returns year and pid of a new mail, None if get_new_pid() is used
 
-        for mailbox in data['m_mboxes']:
-            qs = qs + authorized_template % mailbox[:512]
+        raises ConnectionError if a pid block cannot be reserved"""
+        if self.pids is None:
+            return None
+        return self.pids.get()
+
+    def archive_one(self, values, recipients, mboxes):
+        """inserts a mail in its own transaction
+
+        @return: year, pid and message, 0, code and message on errors"""
+        try:
+            pids = self.new_pid()
+        except ConnectionError, val:
+            return 0, 443, str(val)
+
+        if pids is None:
+            qs = execute_mail
+            params = list(values)
+        else:
+            qs = execute_mail_pid
+            params = list(values) + list(pids)
+
+        if self.partitioned:
+            year = pids[0]
+            for recipient in recipients:
+                qs = qs + execute_recipient_year
+                params.extend(recipient + (year,))
+            for mailbox in mboxes:
+                qs = qs + execute_authorized_year
+                params.extend((mailbox, year))
+        else:
+            for recipient in recipients:
+                qs = qs + execute_recipient
+                params.extend(recipient)
+            for mailbox in mboxes:
+                qs = qs + execute_authorized
+                params.append(mailbox)
+
+        if pids is not None:
+            res, data, msg = self.do_query(qs, False, True, params=params)
+            if not res:
+                return 0, 443, msg
+            return pids[0], pids[1], msg
 
         qs = qs + 'SELECT year, pid from mail_pid;'
 
-        res, data, msg = self.do_query(qs, True, True)
+        res, data, msg = self.do_query(qs, True, True, params=params)
         if not res or len(data) != 2:
             return 0, 443, msg
 
         return data[0], data[1], msg # year, pid, message
 
+    def archive_batch(self, jobs):
+        """inserts the mails of the jobs in one transaction
+
+        raises the driver exceptions, the transaction is rolled back
+        @return: a list of year, pid and message for each job"""
+        res, ids, msg = self.do_query(batch_ids_template % len(jobs), autorecon=True, fetchall=True)
+        if not res:
+            raise ConnectionError, msg
+
+        mails = []
+        recipients = []
+        authorized = []
+        params = []
+        pids = {}
+        for job, (mail_id,) in zip(jobs, ids):
+            job.mail_id = mail_id
+            mail_pids = self.new_pid()
+            if mail_pids is None:
+                mails.append(batch_mail_row)
+                params.append(mail_id)
+            else:
+                mails.append(batch_mail_pid_row)
+                params.extend((mail_id,) + mail_pids)
+                pids[mail_id] = mail_pids
+            params.extend(job.values)
+        for job in jobs:
+            for recipient in job.recipients:
+                if self.partitioned:
+                    recipients.append('(%s, %s, %s, %s)')
+                    params.extend((job.mail_id, pids[job.mail_id][0]) + recipient)
+                else:
+                    recipients.append('(%s, %s, %s)')
+                    params.extend((job.mail_id,) + recipient)
+        for job in jobs:
+            for mailbox in job.mboxes:
+                if self.partitioned:
+                    authorized.append('(%s, %s, %s)')
+                    params.extend((job.mail_id, pids[job.mail_id][0], mailbox))
+                else:
+                    authorized.append('(%s, %s)')
+                    params.extend((job.mail_id, mailbox))
+
+        qs = batch_mail_template % ','.join(mails)
+        if self.partitioned:
+            recipient_template = batch_recipient_year_template
+            authorized_template = batch_authorized_year_template
+        else:
+            recipient_template = batch_recipient_template
+            authorized_template = batch_authorized_template
+        if recipients:
+            qs = qs + recipient_template % ','.join(recipients)
+        if authorized:
+            qs = qs + authorized_template % ','.join(authorized)
+        ## Year and pid assigned by get_new_pid() are read back
+        if not pids:
+            qs = qs + batch_result_template % ','.join(['%s'] * len(ids))
+            params.extend([ mail_id for (mail_id,) in ids ])
+
+        try:
+            conn = self.pool.get(self.timeout, self.synccommit)
+        except PoolError, val:
+            raise ConnectionError, str(val)
+
+        ## A multi statement query is a single transaction
+        try:
+            conn.cursor.execute(qs, params)
+            if not pids:
+                for mail_id, year, pid in conn.cursor.fetchall():
+                    pids[mail_id] = (year, pid)
+            conn.connection.commit()
+        except:
+            t, val, tb = exc_info()
+            self.pool.release(conn)
+            raise t, val, tb
+        self.pool.put(conn)
+
+        results = []
+        for job in jobs:
+            year, pid = pids[job.mail_id]
+            results.append((year, pid, 'Ok'))
+        return results
+
     def process_storage(self, data):
         """process storaging of mail on pgsql
 
         The query doesn't return rows but only result code
         @param data: is a dict containg year, pid and mail from archiver
         @return: result code"""
-        msg = { 'year': data['year'],
-                'pid' : data['pid'],
-                'mail': encodestring(data['mail'])
-                }
+        mail = data['mail']
+        if self.storagemode == 'text':
+            qs = execute_storage
+            params = (data['year'], data['pid'], encodestring(str(mail)))
+        elif self.lobsize > 0 and len(mail) > self.lobsize:
+            return self.store_lob(data['year'], data['pid'], mail)
+        else:
+            qs = execute_data
+            params = (data['year'], data['pid'], Binary(str(mail)))
 
-        res, data, msg = self.do_query(storage_template % msg)
+        res, data, msg = self.do_query(qs, params=params)
         if not res:
             return 0, 443, msg
         return BACKEND_OK
 
+    def store_lob(self, year, pid, mail):
+        """stores a mail as a large object
+
+        The mail is written to the large object CHUNK bytes at time, as
+        strings: lobject.write doesn't take buffers. Large objects need a
+        transaction, the connection is put back in autocommit afterwards"""
+        try:
+            conn = self.pool.get(self.timeout, self.synccommit)
+        except PoolError, val:
+            self.LOG(E_ERR, self._prefix + 'no database connection: %s' % val)
+            return 0, 443, 'Internal Server Error - %s' % val
+
+        try:
+            conn.connection.set_isolation_level(1)
+            try:
+                lob = conn.connection.lobject(0, 'wb')
+                for chunk in mail.chunks(CHUNK):
+                    lob.write(chunk)
+                lob.close()
+                conn.cursor.execute(execute_lob, (year, pid, lob.oid))
+                conn.connection.commit()
+            finally:
+                conn.connection.set_isolation_level(0)
+        except:
+            t, val, tb = exc_info()
+            del tb
+            self.pool.release(conn)
+            msg = format_msg(val)
+            self.LOG(E_ERR, self._prefix + 'Cannot store large object: ' + msg)
+            return 0, 443, '%s: Internal Server Error' % t
+
+        self.pool.put(conn)
+        return BACKEND_OK
+
+    def retrieve(self, year, pid, fd):
+        """writes a stored mail to fd
+
+        base64 rows are decoded, bytea and large objects are read CHUNK
+        bytes at time, in a transaction so all the chunks are of the same row
+        raises ConnectionError if there is no database connection
+        @return: True if the mail was found"""
+        try:
+            conn = self.pool.get(self.timeout, self.synccommit)
+        except PoolError, val:
+            raise ConnectionError, str(val)
+
+        found = False
+        try:
+            conn.connection.set_isolation_level(1)
+            try:
+                conn.cursor.execute(retrieve_template, (year, pid))
+                row = conn.cursor.fetchone()
+                if row is not None:
+                    found = True
+                    text, size, lob = row
+                    if text is not None:
+                        fd.write(decodestring(text))
+                    elif lob is not None:
+                        lob = conn.connection.lobject(lob, 'rb')
+                        while 1:
+                            chunk = lob.read(CHUNK)
+                            if not chunk:
+                                break
+                            fd.write(chunk)
+                        lob.close()
+                    elif size is not None:
+                        for offset in xrange(0, size, CHUNK):
+                            conn.cursor.execute(retrieve_chunk_template, (offset + 1, CHUNK, year, pid))
+                            fd.write(conn.cursor.fetchone()[0])
+                conn.connection.commit()
+            finally:
+                conn.connection.set_isolation_level(0)
+        except:
+            t, val, tb = exc_info()
+            self.pool.release(conn)
+            raise t, val, tb
+
+        self.pool.put(conn)
+        return found
+
     def shutdown(self):
         """shutdown the PGSQL stage
 
         closes the pgsql connection and the stage Thread"""
-        self.close()
+        if self.batch is not None:
+            self.batch.stop()
+        release_pool(self.pool)
         self.LOG(E_ALWAYS, self._prefix + '(%s): closing connection' % self.type)
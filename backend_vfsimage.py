@@ -26,14 +26,16 @@ __all__ = [ 'Backend' ]
 
 from archiver import *
 from sys import platform, exc_info
-from os import path, access, makedirs, stat, F_OK, R_OK, W_OK
+from os import path, access, stat, F_OK, R_OK, W_OK
 from os import unlink, rename
 from errno import ENOSPC
 from anydbm import open as opendb
 from ConfigParser import ConfigParser
 from popen2 import Popen4
 from compress import CompressedFile, compressors
-from backend_pgsql import sql_quote, format_msg, Backend as BackendPGSQL
+from mimescan import Segments
+from backend_pgsql import format_msg, Backend as BackendPGSQL
+from backend_filesystem import DirCache
 
 ### /etc/sudoers
 # user ALL = NOPASSWD:/bin/mount,/bin/umount,/usr/bin/install
@@ -46,7 +48,8 @@ cmd_umount='/usr/bin/sudo /bin/umount %(mountpoint)s'
 cmd_prepare='/usr/bin/sudo /usr/bin/install -d -m 755 -o %(user)s %(mountpoint)s/%(archiverdir)s'
 
 ##
-update_query = 'update mail set media = get_curr_media() where year = %(year)d and pid = %(pid)d;'
+vfsimage_statements = { 'vfsimage_media': 'update mail set media = get_curr_media() where year = $1 and pid = $2' }
+execute_media = 'EXECUTE vfsimage_media (%s, %s);'
 
 class VFSError(Exception):
     pass
@@ -55,13 +58,17 @@ class Backend(BackendPGSQL):
     """VFS Image Backend Class
 
     Stores emails on filesystem image"""
+
+    ## The image is mounted and switched by the backend, one mail at time
+    threadsafe = False
+
     def __init__(self, config, stage_type, ar_globals):
         """The constructor"""
 
         self._prefix = 'VFSImage Backend: '
 
         ### Init PGSQL Backend
-        BackendPGSQL.__init__(self, config, 'archive', ar_globals, self._prefix)
+        BackendPGSQL.__init__(self, config, 'archive', ar_globals, self._prefix, vfsimage_statements)
         # Avoid any chance to call uneeded methods
         self.process_archive = None
         self.parse_recipients = None
@@ -95,6 +102,10 @@ class Backend(BackendPGSQL):
             raise BadConfig
 
         self.image = self.imagebase + '.img'
+        ## The image is checked with stat() until it's known to be there,
+        ## directories in it are cached until it's recycled
+        self.imageready = False
+        self.dirs = DirCache()
         try:
             self.compression = config.get(self.type, 'compression')
         except:
@@ -253,45 +264,37 @@ class Backend(BackendPGSQL):
     def process(self, data):
         mailpath, filename = self.get_paths(data)
 
-        try:
-            stat(self.image)
-        except:
-            self.LOG(E_ALWAYS, self._prefix + 'Image not present, creating it')
-
-            if not self.create():
-                self.LOG(E_ERR, self._prefix + 'Cannot create Image file')
-                return 0, 443, 'Internal Error (Image creation failed)'
-
-            if not self.initImage():
-                self.LOG(E_ERR, self._prefix + 'Cannot init Image')
-                return 0, 443, 'Internal Error (Cannot init Image)'
-
-        error = None
-        if not access(mailpath, F_OK | R_OK | W_OK):
-            error = 'No access to mailpath'
+        if not self.imageready:
             try:
-                makedirs(mailpath, 0700)
-                error = None
+                stat(self.image)
             except:
-                t, val, tb = exc_info()
-                del tb
-                error = '%s: %s' % (t, val)
-                self.LOG(E_ERR, self._prefix + 'Cannot create storage directory: %s' % str(val))
+                self.LOG(E_ALWAYS, self._prefix + 'Image not present, creating it')
 
+                if not self.create():
+                    self.LOG(E_ERR, self._prefix + 'Cannot create Image file')
+                    return 0, 443, 'Internal Error (Image creation failed)'
+
+                if not self.initImage():
+                    self.LOG(E_ERR, self._prefix + 'Cannot init Image')
+                    return 0, 443, 'Internal Error (Cannot init Image)'
+            self.imageready = True
+
+        error = self.dirs.check(mailpath)
         if error is not None:
+            self.LOG(E_ERR, self._prefix + 'Cannot create storage directory: %s' % error)
             return 0, 443, error
 
         if self.compression is not None:
             name = '%d-%d.eml' % (data['year'], data['pid'])
             comp = CompressedFile(compressor=self.compression[0], ratio=self.compression[1], name=name)
-            comp.write(data['mail'])
-            data['mail'] = comp.getdata()
+            comp.write(str(data['mail']))
+            data['mail'] = Segments(comp.getdata())
             comp.close()
 
         error_no = 0
         try:
             fd = open(filename, 'wb')
-            fd.write(data['mail'])
+            data['mail'].writeto(fd)
         except:
             t, val, tb = exc_info()
             error_no = val.errno
@@ -304,6 +307,10 @@ class Backend(BackendPGSQL):
             try: unlink(filename)
             except: pass
 
+            ## Image and directories are checked again with the next mail
+            self.imageready = False
+            self.dirs.forget()
+
             if error_no == ENOSPC:
                 if not self.recycle():
                     self.LOG(E_ERR, self._prefix + 'Error recycling Image')
@@ -317,7 +324,7 @@ class Backend(BackendPGSQL):
 
         self.LOG(E_TRACE, self._prefix + 'wrote %s' % filename)
 
-        res, data, msg = self.do_query(update_query % data, fetch=False, autorecon=True)
+        res, data, msg = self.do_query(execute_media, fetch=False, autorecon=True, params=(data['year'], data['pid']))
         if not res:
             try: unlink(filename)
             except: pass
@@ -60,6 +60,9 @@ class Backend(BackendBase):
         @return: year as status and pid as code"""
         ## FIXME wrap with xmlrpc DateTime - time.struct_time objects cannot be marshalled
         data['m_date'] = mktime(data['m_date'])
+        ## Storage stage mail is a mimescan.Segments
+        if data.has_key('mail'):
+            data['mail'] = str(data['mail'])
         self.LOG(E_TRACE, 'XmlRpc Backend (%s): ready to process %s' % (self.type, data))
         try:
             getattr(self.server, self.method)({'data': data})
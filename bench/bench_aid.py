@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_aid.py
+## X-Archiver-ID injection and DATA to the next hop, memory and time
+
+## The old way is the string concatenation of add_aid followed by
+## smtplib.SMTP.data, the new one is a mimescan.Segments sent by
+## smtppool.StreamSMTP. The next hop is /dev/null, the SMTP replies are
+## faked. Peak memory is measured in a child process for each run, as
+## the growth of the max rss over the received mail.
+
+from sys import path, argv, executable, exit as sys_exit
+from os.path import dirname, abspath, join
+from os import popen, devnull
+from resource import getrusage, RUSAGE_SELF
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mimescan import ScannedMessage
+from smtppool import StreamSMTP
+from getopt import getopt
+from time import time
+
+HEADERS = """From: sender@example.com
+To: archive@example.com
+Subject: benchmark
+Message-ID: <1@example.com>
+
+"""
+
+class NullSMTP(StreamSMTP):
+    def __init__(self):
+        self.out = open(devnull, 'wb')
+    def putcmd(self, cmd, args=''):
+        pass
+    def getreply(self):
+        return 354, 'Ok'
+    def send(self, data):
+        self.out.write(data)
+
+def make_message(size):
+    ## A single copy of the mail, so the peak before sending is the mail
+    return ''.join([ HEADERS ] + [ 'x' * 70 + '\n' ] * (size / 71 + 1))
+
+def old_send(data):
+    msg = ScannedMessage(data)
+    headers = data[:msg.startofbody]
+    data = headers.strip() + '\nX-Archiver-ID: 2007-1\n' + '\n\n' + data[msg.startofbody:]
+    ## smtplib.SMTP.data
+    NullSMTP().data(data)
+
+def new_send(data):
+    msg = ScannedMessage(data)
+    headers = data[:msg.startofbody]
+    data = msg.withheaders(headers.strip() + '\nX-Archiver-ID: 2007-1\n\n')
+    NullSMTP().data(data)
+
+SENDERS = { 'old': old_send, 'new': new_send }
+
+def peak(name, size):
+    """max rss growth in KB sending a mail, run in a child process"""
+    return int(popen('%s %s -m %s -s %d' % (executable, abspath(__file__), name, size)).read())
+
+def measure(func, message, rounds):
+    start = time()
+    for i in xrange(rounds):
+        func(message)
+    return (time() - start) / rounds
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'r:m:s:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-r rounds_scale]' % argv[0]
+        sys_exit(-1)
+
+    scale = 1.0
+    child = None
+    for opt, value in optlist:
+        if opt == '-r': scale = float(value)
+        elif opt == '-m': child = value
+        elif opt == '-s': size = int(value)
+
+    if child is not None:
+        message = make_message(size)
+        before = getrusage(RUSAGE_SELF).ru_maxrss
+        SENDERS[child](message)
+        print getrusage(RUSAGE_SELF).ru_maxrss - before
+        sys_exit(0)
+
+    print '%10s %12s %12s %12s %12s' % ('size', 'old ms', 'new ms', 'old peak KB', 'new peak KB')
+    for size, rounds in ((64 * 1024, 500), (1024 * 1024, 50), (20 * 1024 * 1024, 3)):
+        message = make_message(size)
+        rounds = max(1, int(rounds * scale))
+        old = measure(old_send, message, rounds)
+        new = measure(new_send, message, rounds)
+        print '%10d %12.3f %12.3f %12d %12d' % (size, old * 1000, new * 1000, peak('old', size), peak('new', size))
@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_concurrency.py
+## Messages/sec with concurrent smtp clients
+
+## Each client keeps its connection open and sends messages in a row,
+## like postfix does with the smtp connection cache. The stage backend
+## and the next hop are simulated by sleeping for --delay milliseconds.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mtplib import MTPServer
+from smtplib import SMTP
+from threading import Thread
+from getopt import getopt
+from time import time, sleep
+
+MESSAGE = """From: bench@example.com
+To: archive@example.com
+Subject: benchmark
+
+%s
+""" % ('x' * 72 + '\n') * 64
+
+class BenchServer(MTPServer):
+    def process_message(self, peer, mailfrom, mail_options, rcpttos, rcptopts, data):
+        sleep(self.delay)
+        return None
+
+def client(port, count, errors):
+    try:
+        server = SMTP('127.0.0.1', port)
+        for i in range(count):
+            server.sendmail('bench@example.com', ['archive@example.com'], MESSAGE)
+        server.quit()
+    except:
+        errors.append(1)
+
+def run(port, poolsize, delay, clients, count):
+    server = BenchServer('127.0.0.1:%d' % port, poolsize=poolsize)
+    server.delay = delay
+    loop = Thread(target=server.loop, args=(0.1, True, server.map))
+    loop.setDaemon(True)
+    loop.start()
+
+    errors = []
+    threads = [ Thread(target=client, args=(port, count, errors)) for i in range(clients) ]
+    start = time()
+    for t in threads: t.start()
+    for t in threads: t.join()
+    elapsed = time() - start
+
+    server.close_all()
+    server.close()
+    loop.join()
+    return clients * count, elapsed, len(errors)
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'p:w:d:n:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-p port] [-w poolsize] [-d delay_ms] [-n msgs_per_client]' % argv[0]
+        sys_exit(-1)
+
+    port, poolsize, delay, count = 10125, 8, 5.0, 20
+    for opt, value in optlist:
+        if opt == '-p': port = int(value)
+        elif opt == '-w': poolsize = int(value)
+        elif opt == '-d': delay = float(value)
+        elif opt == '-n': count = int(value)
+
+    print 'poolsize %d - simulated backend delay %.1f ms' % (poolsize, delay)
+    print '%8s %8s %10s %10s %6s' % ('clients', 'msgs', 'seconds', 'msgs/sec', 'errors')
+    for clients in (1, 8, 64):
+        msgs, elapsed, errors = run(port, poolsize, delay / 1000.0, clients, count)
+        print '%8d %8d %10.3f %10.1f %6d' % (clients, msgs, elapsed, msgs / elapsed, errors)
+        port = port + 1
@@ -0,0 +1,91 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_connect.py
+## Connection setup latency
+
+## Time from connect to the EHLO reply, the banner included, with
+## sequential and concurrent clients. A slow resolver can be simulated
+## with --resolver, it only delays the server startup since the local
+## fqdn is resolved once per MTPServer.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import mtplib
+from mtplib import MTPServer
+from smtplib import SMTP
+from threading import Thread
+from getopt import getopt
+from time import time, sleep
+
+def client(port, count, times):
+    for i in range(count):
+        start = time()
+        ## No client side fqdn lookup
+        server = SMTP('127.0.0.1', port, 'bench.example.com')
+        server.ehlo()
+        times.append(time() - start)
+        server.quit()
+
+def run(port, clients, count):
+    times = []
+    threads = [ Thread(target=client, args=(port, count, times)) for i in range(clients) ]
+    for t in threads: t.start()
+    for t in threads: t.join()
+    times.sort()
+    return len(times), sum(times) / len(times), times[len(times) / 2], times[int(len(times) * 0.99)]
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'p:r:n:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-p port] [-r resolver_delay_ms] [-n connections_per_client]' % argv[0]
+        sys_exit(-1)
+
+    port, resolver, count = 10225, 0.0, 50
+    for opt, value in optlist:
+        if opt == '-p': port = int(value)
+        elif opt == '-r': resolver = float(value)
+        elif opt == '-n': count = int(value)
+
+    if resolver:
+        gethostbyaddr = mtplib.gethostbyaddr
+        def slow_gethostbyaddr(addr):
+            sleep(resolver / 1000.0)
+            return gethostbyaddr(addr)
+        mtplib.gethostbyaddr = slow_gethostbyaddr
+
+    start = time()
+    server = MTPServer('127.0.0.1:%d' % port)
+    print 'server startup %.3f ms - simulated resolver delay %.1f ms' % ((time() - start) * 1000, resolver)
+    loop = Thread(target=server.loop, args=(0.1, True, server.map))
+    loop.setDaemon(True)
+    loop.start()
+
+    print '%8s %8s %10s %10s %10s' % ('clients', 'conns', 'avg ms', 'p50 ms', 'p99 ms')
+    for clients in (1, 8, 64):
+        conns, avg, p50, p99 = run(port, clients, count)
+        print '%8d %8d %10.3f %10.3f %10.3f' % (clients, conns, avg * 1000, p50 * 1000, p99 * 1000)
+
+    server.close_all()
+    server.close()
+    loop.join()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_dataparse.py
+## DATA section decoding, old split/join against the streaming decoder
+
+## Both are fed with MTPChannel recv sized chunks, like the asyncore loop does.
+## The old one is the async_chat terminator search followed by the
+## split/dot check/join of the former MTPChannel.found_terminator.
+## Peak memory is measured in a child process for each run, as the
+## growth of the max rss over the message itself.
+
+from sys import path, argv, executable, exit as sys_exit
+from os.path import dirname, abspath, join
+from os import popen
+from resource import getrusage, RUSAGE_SELF
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mtplib import MTPChannel, DataDecoder, ENDDATA
+from asynchat import find_prefix_at_end
+from cStringIO import StringIO
+from getopt import getopt
+from time import time
+
+CHUNK = MTPChannel.ac_in_buffer_size
+
+def make_message(size):
+    line = 'x' * 70 + '\r\n'
+    dotted = '..leading dot' + '\r\n'
+    lines = []
+    length = 0
+    i = 0
+    while length < size:
+        if i % 50 == 0:
+            lines.append(dotted)
+            length = length + len(dotted)
+        else:
+            lines.append(line)
+            length = length + len(line)
+        i = i + 1
+    ## The last CRLF is part of the end of data
+    return ''.join(lines)[:-2] + ENDDATA
+
+def old_decode(message, chunk):
+    collected = []
+    buffer = ''
+    for pos in xrange(0, len(message), chunk):
+        buffer = buffer + message[pos:pos+chunk]
+        while buffer:
+            index = buffer.find(ENDDATA)
+            if index != -1:
+                collected.append(buffer[:index])
+                buffer = buffer[index+len(ENDDATA):]
+                line = ''.join(collected)
+                data = []
+                for text in line.split('\r\n'):
+                    if text and text[0] == '.':
+                        data.append(text[1:])
+                    else:
+                        data.append(text)
+                return '\n'.join(data)
+            index = find_prefix_at_end(buffer, ENDDATA)
+            if index:
+                if index != len(buffer):
+                    collected.append(buffer[:-index])
+                    buffer = buffer[-index:]
+                break
+            collected.append(buffer)
+            buffer = ''
+
+def new_decode(message, chunk):
+    out = StringIO()
+    decoder = DataDecoder(out)
+    for pos in xrange(0, len(message), chunk):
+        if decoder.feed(message[pos:pos+chunk]) is not None:
+            return out.getvalue()
+
+def measure(func, message, rounds):
+    start = time()
+    for i in xrange(rounds):
+        func(message, CHUNK)
+    return (time() - start) / rounds
+
+DECODERS = { 'old': old_decode, 'new': new_decode }
+
+def peak(name, size):
+    """max rss growth in KB decoding a message, run in a child process"""
+    return int(popen('%s %s -m %s -s %d' % (executable, abspath(__file__), name, size)).read())
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'r:m:s:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-r rounds_scale]' % argv[0]
+        sys_exit(-1)
+
+    scale = 1.0
+    child = None
+    for opt, value in optlist:
+        if opt == '-r': scale = float(value)
+        elif opt == '-m': child = value
+        elif opt == '-s': size = int(value)
+
+    if child is not None:
+        message = make_message(size)
+        before = getrusage(RUSAGE_SELF).ru_maxrss
+        DECODERS[child](message, CHUNK)
+        print getrusage(RUSAGE_SELF).ru_maxrss - before
+        sys_exit(0)
+
+    print '%10s %12s %12s %8s %12s %12s' % ('size', 'old ms', 'new ms', 'speedup', 'old peak KB', 'new peak KB')
+    for size, rounds in ((10 * 1024, 2000), (1024 * 1024, 20), (25 * 1024 * 1024, 2)):
+        message = make_message(size)
+        rounds = max(1, int(rounds * scale))
+        if old_decode(message, CHUNK) != new_decode(message, CHUNK):
+            print 'Decoders disagree at size %d' % size
+            sys_exit(1)
+        old = measure(old_decode, message, rounds)
+        new = measure(new_decode, message, rounds)
+        print '%10d %12.3f %12.3f %7.1fx %12d %12d' % (size, old * 1000, new * 1000, old / new,
+                                                    peak('old', size), peak('new', size))
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_durability.py
+## Archive stage mails/sec for each durability tier of the pgsql backend
+
+## Needs a scratch database with sql/mail.sql loaded, rows are added to
+## it. For each tier the archive backend is made as the archiver does and
+## the mails are archived by concurrent sessions, as the stage workers
+## do. The numbers depend on the disk flush latency of the server more
+## than on anything else, run it on the database host of the archiver.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import archiver
+from backend_pgsql import Backend, TIERS
+from ConfigParser import ConfigParser
+from threading import Thread
+from time import time, localtime
+from getopt import getopt
+
+def log(level, msg):
+    pass
+
+def archive_data(i):
+    return { 'm_attach': [], 'm_size': 4096, 'm_sub': u'Benchmark subject %d' % i,
+             'm_date': localtime(), 'm_mid': '<%d.bench@example.com>' % i, 'm_from': 'sender@example.com',
+             'm_rec': [ 'rcpt%d@example.com' % r for r in range(2) ], 'm_mboxes': [ 'user.rcpt0' ] }
+
+def session(backend, count, errors):
+    for i in xrange(count):
+        if backend.process(archive_data(i))[1] == 443:
+            errors.append(i)
+
+def measure(dsn, tier, sessions, count):
+    config = ConfigParser()
+    config.add_section('archive')
+    config.set('archive', 'dsn', dsn)
+    config.set('archive', 'durability', tier)
+    config.set('archive', 'dbpoolmax', str(sessions))
+    config.set('archive', 'pidblock', '1000')
+    ## The sessions are the stage workers
+    config.set('archive', 'poolsize', str(sessions))
+    if tier == 'batched':
+        config.set('archive', 'batchsize', str(sessions))
+    backend = Backend(config, 'archive', { 'LOG': log })
+    errors = []
+    threads = [ Thread(target=session, args=(backend, count, errors)) for i in range(sessions) ]
+    start = time()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time() - start
+    backend.shutdown()
+    if errors:
+        print '%s: %d mails failed' % (tier, len(errors))
+    return sessions * count / elapsed
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'd:n:s:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s -d user:password:host:dbname [-n mails_for_session] [-s sessions]' % argv[0]
+        sys_exit(-1)
+
+    dsn = None
+    count = 500
+    sessions = 8
+    for opt, value in optlist:
+        if opt == '-d': dsn = value
+        elif opt == '-n': count = int(value)
+        elif opt == '-s': sessions = int(value)
+    if dsn is None:
+        print 'A scratch database is needed, use -d'
+        sys_exit(-1)
+
+    print '%-14s %12s' % ('durability', 'mails/sec')
+    for tier in TIERS:
+        print '%-14s %12.1f' % (tier, measure(dsn, tier, sessions, count))
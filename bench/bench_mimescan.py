@@ -0,0 +1,138 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_mimescan.py
+## Archive stage parsing, mimetools/MultiFile against mimescan
+
+## Both sides extract what process_archive needs: the header fields and
+## the attachment list. The corpus is generated, mails from a directory
+## (one file each) can be added with -d; results of both parsers must be
+## the same.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join, isfile
+from os import listdir
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mimescan import ScannedMessage
+from utils import parse_message, hash_headers
+from mimetools import Message
+from multifile import MultiFile
+from cStringIO import StringIO
+from base64 import encodestring
+from getopt import getopt
+from time import time
+
+HEADERS = """From: Sender <sender@example.com>
+To: Rcpt One <one@example.com>, two@example.com
+Cc: three@example.com
+Subject: =?iso-8859-1?q?benchmark_=E0?=
+Date: Mon, 1 Jan 2007 10:00:00 +0100
+Message-ID: <%d@example.com>
+MIME-Version: 1.0
+"""
+
+BOUNDARY = '----=_NextPart_000_0001_01C7A1B2.3C4D5E6F'
+
+def make_plain(i, size):
+    body = ('x' * 70 + '\n') * (size / 71 + 1)
+    return HEADERS % i + 'Content-Type: text/plain\n\n' + body
+
+def make_multipart(i, count, size):
+    payload = encodestring('\x00\xff' * (size / 2))
+    parts = [ HEADERS % i + 'Content-Type: multipart/mixed;\n\tboundary="%s"\n\n' % BOUNDARY,
+              'This is a multi-part message in MIME format.\n\n',
+              '--%s\nContent-Type: text/plain\n\nsee attachments\n\n' % BOUNDARY ]
+    for n in range(count):
+        parts.append('--%s\nContent-Type: application/octet-stream;\n\tname="file%d.bin"\n'
+                     'Content-Transfer-Encoding: base64\n'
+                     'Content-Disposition: attachment;\n\tfilename="file%d.bin"\n\n' % (BOUNDARY, n, n))
+        parts.append(payload)
+        parts.append('\n')
+    parts.append('--%s--\n' % BOUNDARY)
+    return ''.join(parts)
+
+def fields(msg):
+    return (msg.getaddrlist('From'), msg.getaddrlist('To'), msg.getaddrlist('Cc'),
+            msg.get('Subject'), msg.getdate('Date'), hash_headers(msg.get))
+
+def old_parse(data):
+    stream = StringIO(data)
+    msg = Message(stream)
+    result = fields(msg)
+    m_attach = []
+    if msg.maintype != 'multipart':
+        m_parse = parse_message(msg)
+        if m_parse is not None:
+            m_attach.append(m_parse)
+    else:
+        filepart = MultiFile(stream)
+        filepart.push(msg.getparam('boundary'))
+        try:
+            while filepart.next():
+                submsg = Message(filepart)
+                subpart = parse_message(submsg)
+                if subpart is not None:
+                    m_attach.append(subpart)
+        except:
+            pass
+    return result, m_attach
+
+def new_parse(data):
+    msg = ScannedMessage(data)
+    return fields(msg), msg.attachments()
+
+def measure(func, mails, rounds):
+    start = time()
+    for i in xrange(rounds):
+        for data in mails:
+            func(data)
+    return (time() - start) / rounds / len(mails)
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'r:d:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-r rounds_scale] [-d maildir]' % argv[0]
+        sys_exit(-1)
+
+    scale = 1.0
+    corpus = [ ('plain 4KB', [ make_plain(i, 4096) for i in range(10) ], 500),
+               ('plain 1MB', [ make_plain(i, 1024 * 1024) for i in range(2) ], 20),
+               ('3 x 64KB', [ make_multipart(i, 3, 65536) for i in range(10) ], 100),
+               ('20 x 16KB', [ make_multipart(i, 20, 16384) for i in range(10) ], 50),
+               ('2 x 10MB', [ make_multipart(0, 2, 10 * 1024 * 1024) ], 2) ]
+    for opt, value in optlist:
+        if opt == '-r': scale = float(value)
+        elif opt == '-d':
+            mails = [ open(join(value, name)).read().replace('\r\n', '\n')
+                      for name in listdir(value) if isfile(join(value, name)) ]
+            corpus.append((value, mails, 10))
+
+    print '%-16s %6s %12s %12s %8s' % ('corpus', 'mails', 'old ms', 'new ms', 'speedup')
+    for name, mails, rounds in corpus:
+        for data in mails:
+            if old_parse(data) != new_parse(data):
+                print 'Parsers disagree in %s' % name
+                sys_exit(1)
+        rounds = max(1, int(rounds * scale))
+        old = measure(old_parse, mails, rounds)
+        new = measure(new_parse, mails, rounds)
+        print '%-16s %6d %12.3f %12.3f %7.1fx' % (name, len(mails), old * 1000, new * 1000, old / new)
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_partition.py
+## Archive insert rate as the archive grows, sql/mail.sql against sql/mail_partitioned.sql
+
+## Needs a scratch database, the schemas bench_plain and bench_part are
+## dropped and made again. Both are filled server side up to the number
+## of mails given (10M by default, with two recipients and a mailbox each)
+## spread over the last years, oldest first; at each step mails of the
+## current year are inserted as the archive stage does, one transaction
+## each with the backend prepared statements, and the rate and the size
+## of all the indexes are printed.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from backend_pgsql import archive_statements, partitioned_statements
+from backend_pgsql import execute_mail_pid, execute_recipient, execute_authorized
+from backend_pgsql import execute_recipient_year, execute_authorized_year
+from pgpool import prepare_template
+from psycopg2 import connect
+from getopt import getopt
+from time import time, localtime, asctime
+
+SQLDIR = join(dirname(abspath(__file__)), '..', 'sql')
+YEARS = 10
+
+fill_mail = """
+INSERT INTO mail (mail_id, year, pid, message_id, from_login, from_domain,
+                  subject, mail_date, mail_size, attachment)
+SELECT i, %(first)d + (i - 1) * %(years)d / %(total)d, i, md5(i::text) || '@example.com',
+       'user' || (i %% 5000), 'domain' || (i %% 300) || '.com', 'subject ' || md5((i * 7)::text),
+       date '2000-01-01' + (i %% 7000), 4096, i %% 3
+FROM generate_series(%(start)d, %(end)d) AS i;
+"""
+fill_recipient = """
+INSERT INTO recipient (mail_id, %(year)s to_login, to_domain)
+SELECT i / 2, %(yearexpr)s 'rcpt' || (i %% 20000), 'domain' || (i %% 300) || '.com'
+FROM generate_series(%(start)d * 2, %(end)d * 2 + 1) AS i;
+"""
+fill_authorized = """
+INSERT INTO authorized (mail_id, %(year)s mailbox)
+SELECT i, %(yearexpr)s 'user.rcpt' || (i %% 20000)
+FROM generate_series(%(start)d, %(end)d) AS i;
+"""
+create_partition = 'CREATE TABLE %(table)s_%(year)d PARTITION OF %(table)s FOR VALUES FROM (%(year)d) TO (%(next)d);'
+index_size = """
+SELECT sum(pg_relation_size(c.oid)) FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE c.relkind = 'i' AND n.nspname = current_schema();
+"""
+
+class Schema:
+    def __init__(self, dsn, name, sqlfile, partitioned):
+        self.name = name
+        self.partitioned = partitioned
+        self.conn = connect(dsn)
+        self.conn.set_isolation_level(0)
+        self.cursor = self.conn.cursor()
+        self.cursor.execute('DROP SCHEMA IF EXISTS %s CASCADE; CREATE SCHEMA %s; SET search_path = %s;' % (name, name, name))
+        self.cursor.execute(open(join(SQLDIR, sqlfile)).read())
+        self.year = localtime()[0]
+        if partitioned:
+            statements = partitioned_statements
+            for year in range(self.year - YEARS + 1, self.year + 1):
+                for table in ('mail', 'recipient', 'authorized'):
+                    self.cursor.execute(create_partition % dict(table=table, year=year, next=year + 1))
+        else:
+            statements = archive_statements
+        for name, statement in statements.items():
+            self.cursor.execute(prepare_template % (name, statement))
+        ## Mails of the benchmark after the ones of the fill
+        self.cursor.execute('ALTER SEQUENCE mail_id_sequence RESTART 1000000000;')
+        self.pid = 2000000000
+
+    def fill(self, start, end, total):
+        values = dict(first=self.year - YEARS + 1, years=YEARS, total=total, start=start, end=end)
+        self.cursor.execute(fill_mail % values)
+        ## The year of the mail, as in fill_mail
+        for template, mail_id in ((fill_recipient, 'i / 2'), (fill_authorized, 'i')):
+            if self.partitioned:
+                values['year'] = 'year,'
+                values['yearexpr'] = '%d + (%s - 1) * %d / %d,' % (values['first'], mail_id, YEARS, total)
+            else:
+                values['year'] = values['yearexpr'] = ''
+            self.cursor.execute(template % values)
+        self.cursor.execute('ANALYZE;')
+
+    def insert(self, count):
+        """inserts count mails, returns mails for second"""
+        mail_date = asctime(localtime())
+        start = time()
+        for i in xrange(count):
+            self.pid = self.pid - 1
+            params = [ '<%d.%d.bench@example.com>' % (self.pid, i), 'sender', 'example.com',
+                       'Benchmark subject %d' % self.pid, mail_date, 4096, 1, self.year, self.pid ]
+            qs = execute_mail_pid
+            for rcpt in ('one', 'two'):
+                if self.partitioned:
+                    qs = qs + execute_recipient_year
+                    params.extend((rcpt, 'example.com', self.year))
+                else:
+                    qs = qs + execute_recipient
+                    params.extend((rcpt, 'example.com'))
+            if self.partitioned:
+                qs = qs + execute_authorized_year
+                params.extend(('user.one', self.year))
+            else:
+                qs = qs + execute_authorized
+                params.append('user.one')
+            self.cursor.execute(qs, params)
+        return count / (time() - start)
+
+    def indexes(self):
+        self.cursor.execute(index_size)
+        return (self.cursor.fetchone()[0] or 0) / 1048576.0
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'd:n:s:i:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s -d "libpq dsn" [-n mails] [-s steps] [-i inserts_for_step]' % argv[0]
+        sys_exit(-1)
+
+    dsn = None
+    total = 10000000
+    steps = 10
+    inserts = 2000
+    for opt, value in optlist:
+        if opt == '-d': dsn = value
+        elif opt == '-n': total = int(value)
+        elif opt == '-s': steps = int(value)
+        elif opt == '-i': inserts = int(value)
+    if dsn is None:
+        print 'A scratch database is needed, use -d'
+        sys_exit(-1)
+
+    plain = Schema(dsn, 'bench_plain', 'mail.sql', False)
+    part = Schema(dsn, 'bench_part', 'mail_partitioned.sql', True)
+
+    print '%10s %12s %12s %12s %12s' % ('mails', 'plain m/s', 'plain idx MB', 'part m/s', 'part idx MB')
+    done = 0
+    for step in range(1, steps + 1):
+        end = total * step / steps
+        for schema in (plain, part):
+            schema.fill(done + 1, end, total)
+        done = end
+        print '%10d %12.1f %12.1f %12.1f %12.1f' % (done, plain.insert(inserts), plain.indexes(),
+                                                    part.insert(inserts), part.indexes())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_pgsql.py
+## Archive and storage inserts, string built queries against prepared statements
+
+## Needs a scratch database with sql/mail.sql and sql/mail_storage.sql
+## loaded, rows are added to it. The old way is the former backend code:
+## values escaped with sql_quote and formatted in the query text, parsed
+## and planned by the server for each mail. The new one is the backend,
+## EXECUTE of the statements prepared on connect with bound values.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import archiver
+from backend_pgsql import Backend
+from ConfigParser import ConfigParser
+from base64 import encodestring
+from time import time, localtime, asctime
+from getopt import getopt
+
+old_mail = """
+INSERT INTO mail (mail_id, year, pid, message_id, from_login, from_domain,
+                  subject, mail_date, mail_size, attachment, media)
+VALUES (get_next_mail_id(), get_curr_year(), get_new_pid(), '%(message_id)s',
+        '%(from_login)s', '%(from_domain)s', '%(subject)s', '%(mail_date)s',
+        %(mail_size)s, %(attachment)s, -1);
+"""
+old_recipient = """
+INSERT INTO recipient (mail_id, to_login, to_domain)
+VALUES (get_curr_mail_id(), '%(to_login)s', '%(to_domain)s');
+"""
+old_authorized = """
+INSERT INTO authorized (mail_id, mailbox) VALUES (get_curr_mail_id(), '%s');
+"""
+old_storage = """
+INSERT INTO mail_storage (year, pid, mail) VALUES ('%(year)d', '%(pid)d', '%(mail)s');
+"""
+
+def sql_quote(text):
+    text = text.replace('\x00', '')
+    text = text.replace("\\", "\\\\")
+    text = text.replace("'", "\\'")
+    return text
+
+def log(level, msg):
+    pass
+
+def archive_data(i):
+    return { 'm_attach': [ 'a', 'b' ], 'm_size': 4096, 'm_sub': u"Benchmark subject it's %d" % i,
+             'm_date': localtime(), 'm_mid': '<%d.bench@example.com>' % i, 'm_from': 'sender@example.com',
+             'm_rec': [ 'rcpt%d@example.com' % r for r in range(4) ], 'm_mboxes': [ 'user.rcpt0', 'user.rcpt1' ] }
+
+def old_archive(backend, data):
+    values = { 'message_id' : sql_quote(data['m_mid'][:512]),
+               'from_login' : sql_quote(data['m_from'].split('@', 1)[0]),
+               'from_domain': sql_quote(data['m_from'].split('@', 1)[1]),
+               'subject'    : sql_quote(data['m_sub'][:512].encode('utf-8', 'replace')),
+               'mail_date'  : asctime(data['m_date']),
+               'mail_size'  : data['m_size'],
+               'attachment' : len(data['m_attach']) }
+    qs = old_mail % values
+    for rec in data['m_rec']:
+        rlog, rdom = rec.split('@', 1)
+        qs = qs + old_recipient % dict(to_login=sql_quote(rlog), to_domain=sql_quote(rdom))
+    for mailbox in data['m_mboxes']:
+        qs = qs + old_authorized % sql_quote(mailbox)
+    qs = qs + 'SELECT year, pid from mail_pid;'
+    return backend.do_query(qs, True, True)
+
+def old_storage_insert(backend, data):
+    return backend.do_query(old_storage % { 'year': data['year'], 'pid': data['pid'],
+                                            'mail': encodestring(str(data['mail'])) })
+
+def measure(func, backend, make, count):
+    start = time()
+    for i in xrange(count):
+        func(backend, make(i))
+    return (time() - start) / count
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'd:n:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s -d user:password:host:dbname [-n mails]' % argv[0]
+        sys_exit(-1)
+
+    dsn = None
+    count = 1000
+    for opt, value in optlist:
+        if opt == '-d': dsn = value
+        elif opt == '-n': count = int(value)
+    if dsn is None:
+        print 'A scratch database is needed, use -d'
+        sys_exit(-1)
+
+    config = ConfigParser()
+    for stage in ('archive', 'storage'):
+        config.add_section(stage)
+        config.set(stage, 'dsn', dsn)
+    ar_globals = { 'LOG': log }
+    archive = Backend(config, 'archive', ar_globals)
+    storage = Backend(config, 'storage', ar_globals)
+
+    mail = 'From: sender@example.com\n\n' + 'x' * 8192
+    def storage_data(i):
+        return { 'year': 2007, 'pid': i, 'mail': mail }
+
+    print '%-10s %12s %12s' % ('', 'old ms', 'new ms')
+    old = measure(old_archive, archive, archive_data, count)
+    new = measure(lambda backend, data: backend.process(data), archive, archive_data, count)
+    print '%-10s %12.3f %12.3f' % ('archive', old * 1000, new * 1000)
+    old = measure(old_storage_insert, storage, storage_data, count)
+    new = measure(lambda backend, data: backend.process(data), storage, storage_data, count)
+    print '%-10s %12.3f %12.3f' % ('storage', old * 1000, new * 1000)
+
+    archive.shutdown()
+    storage.shutdown()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_policy.py
+## Whitelist and subject checks per mail, list scan against policy.Policy
+
+## The old check is the local part lookup in the whitelist list and a
+## substring search for each subject pattern. Each mail has a sender and
+## four recipients, none of them whitelisted, so all the rules are tried.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from policy import Policy
+from getopt import getopt
+from time import time
+
+ADDRESSES = [ 'sender@example.com', 'one@example.org', 'two@mail.example.net',
+              'three@example.com', 'four@sub.example.org' ]
+SUBJECT = u'Re: quarterly report for the board, please review'
+
+def old_check(whitelist, subjpatterns):
+    for pattern in subjpatterns:
+        if SUBJECT.find(pattern) != -1:
+            return True
+    for check in ADDRESSES:
+        if check.split('@', 1)[0] in whitelist:
+            return True
+    return False
+
+def new_check(policy):
+    return policy.subject(SUBJECT) or policy.whitelisted(ADDRESSES) is not None
+
+def measure(func, args, rounds):
+    start = time()
+    for i in xrange(rounds):
+        func(*args)
+    return (time() - start) / rounds
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'r:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-r rounds_scale]' % argv[0]
+        sys_exit(-1)
+
+    scale = 1.0
+    for opt, value in optlist:
+        if opt == '-r': scale = float(value)
+
+    rounds = max(1, int(20000 * scale))
+    print '%8s %8s %12s %12s' % ('entries', 'rules', 'old us', 'new us')
+    for entries, rules in ((3, 1), (100, 10), (1000, 30), (10000, 50)):
+        whitelist = [ 'user%d' % i for i in range(entries) ]
+        subjpatterns = [ '[RULE%d]' % i for i in range(rules) ]
+        ## The same number of entries, a mix of all the kinds
+        policy = Policy([ 'user%d' % i for i in range(entries / 4) ] +
+                        [ 'user%d@example.com' % i for i in range(entries / 4) ] +
+                        [ '@host%d.example.com' % i for i in range(entries / 4) ] +
+                        [ '@.domain%d.example.com' % i for i in range(entries - 3 * (entries / 4) - 1) ] +
+                        [ '*-bounces@*' ], subjpatterns)
+        if old_check(whitelist, subjpatterns) or new_check(policy):
+            print 'Unexpected match'
+            sys_exit(1)
+        old = measure(old_check, (whitelist, subjpatterns), rounds)
+        new = measure(new_check, (policy,), rounds)
+        print '%8d %8d %12.2f %12.2f' % (entries, rules, old * 1e6, new * 1e6)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file bench/bench_prefork.py
+## Messages/sec with 1..N server processes sharing the port
+
+## Server processes listen with SO_REUSEPORT like the archiver workers,
+## the stage work is simulated with cpu bound MIME parsing and zlib
+## compression of each message. Clients are separate processes too, so
+## the numbers scale only up to the number of cores.
+
+from sys import path, argv, exit as sys_exit
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+from mtplib import MTPServer
+from smtplib import SMTP
+from mimetools import Message
+from cStringIO import StringIO
+from zlib import compress
+from os import fork, kill, waitpid, sysconf, _exit
+from signal import SIGTERM
+from getopt import getopt
+from time import time, sleep
+
+MESSAGE = """From: bench@example.com
+To: archive@example.com
+Subject: benchmark
+Content-Type: text/plain
+
+%s
+""" % ''.join([ '%08d %s\n' % (i, 'x' * 63) for i in range(512) ])
+
+class BenchServer(MTPServer):
+    def process_message(self, peer, mailfrom, mail_options, rcpttos, rcptopts, data):
+        if not isinstance(data, str):
+            data = data.read()
+        for i in range(4):
+            msg = Message(StringIO(data))
+            msg.get('subject')
+            compress(data, 9)
+        return None
+
+def server(port):
+    srv = BenchServer('127.0.0.1:%d' % port, reuseport=True)
+    srv.loop(0.1, True, srv.map)
+
+def client(port, count):
+    conn = SMTP('127.0.0.1', port, 'bench.example.com')
+    for i in range(count):
+        conn.sendmail('bench@example.com', ['archive@example.com'], MESSAGE)
+    conn.quit()
+
+def forked(function, *args):
+    pid = fork()
+    if pid == 0:
+        try:
+            function(*args)
+        finally:
+            _exit(0)
+    return pid
+
+def run(port, procs, clients, count):
+    servers = [ forked(server, port) for i in range(procs) ]
+    sleep(0.5)
+    start = time()
+    pids = [ forked(client, port, count) for i in range(clients) ]
+    for pid in pids: waitpid(pid, 0)
+    elapsed = time() - start
+    for pid in servers:
+        kill(pid, SIGTERM)
+        waitpid(pid, 0)
+    return clients * count, elapsed
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'p:c:n:w:')
+        if len(args) > 0:
+            raise Exception
+    except:
+        print 'Usage %s [-p port] [-w max_workers] [-c clients] [-n msgs_per_client]' % argv[0]
+        sys_exit(-1)
+
+    cpus = sysconf('SC_NPROCESSORS_ONLN')
+    port, maxworkers, clients, count = 10325, cpus, 16, 20
+    for opt, value in optlist:
+        if opt == '-p': port = int(value)
+        elif opt == '-w': maxworkers = int(value)
+        elif opt == '-c': clients = int(value)
+        elif opt == '-n': count = int(value)
+
+    print '%d cpus - %d clients' % (cpus, clients)
+    print '%8s %8s %10s %10s' % ('workers', 'msgs', 'seconds', 'msgs/sec')
+    procs = 1
+    while procs <= maxworkers:
+        msgs, elapsed = run(port, procs, clients, count)
+        print '%8d %8d %10.3f %10.1f' % (procs, msgs, elapsed, msgs / elapsed)
+        procs = procs * 2
+        port = port + 1
@@ -0,0 +1,570 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file hashdb.py
+## Write-behind hash database and expiring duplicate detection store
+
+__doc__ = '''Netfarm Archiver - release 2.1.0 - Hash database'''
+__version__ = '2.1.0'
+__all__ = [ 'HashDB', 'DedupStore', 'DedupServer', 'DedupClient', 'DedupError',
+            'BloomFilter', 'SYNCMODES' ]
+
+from sys import platform
+if platform != 'win32':
+    from socket import AF_UNIX
+from socket import socket, SOCK_STREAM, error as socket_error
+from select import select, error as select_error
+from threading import Thread, Lock, Event
+from time import time, sleep
+from os import path, stat, unlink, listdir
+from array import array
+from struct import unpack
+from math import log, ceil
+from md5 import new as MD5
+
+try:
+    from bsddb3 import hashopen
+except:
+    from bsddb import hashopen
+
+### Durability modes
+## always: every change is written and synced (one sync per change)
+## batch:  changes are kept in memory and written with a single sync
+##         every batch changes or every window seconds
+## never:  changes are written, the file is synced only on close
+SYNCMODES = [ 'always', 'batch', 'never' ]
+BATCH     = 64
+WINDOW    = 1.0
+
+### Duplicate detection defaults
+TTL         = 5 * 24 * 3600 # postfix maximal_queue_lifetime
+GENERATIONS = 5
+MAXKEYS     = 1000000
+FPRATE      = 0.01
+
+## Marks a pending delete in the overlay
+DELETED = None
+
+### Shared store defaults
+BACKLOG     = 128
+WAIT        = 10 # seconds a client waits for the server
+GRANULARITY = 1  # seconds between the checks of a stop request
+
+class BadSyncMode(Exception):
+    """BadSyncMode The durability mode is unknown"""
+    pass
+
+class DedupError(Exception):
+    """DedupError The shared store cannot be reached"""
+    pass
+
+class HashDB:
+    """Write-behind layer over a bsddb hash file
+
+    Pending changes live in an in-memory overlay that is looked up before
+    the file, so lookups are correct between flushes. All methods are
+    thread safe."""
+    def __init__(self, filename, mode='batch', batch=BATCH, window=WINDOW):
+        """The constructor
+
+        @param filename: the hash file, created if missing
+        @param mode: one of SYNCMODES
+        @param batch: flush when this number of changes is pending
+        @param window: flush pending changes at least every window seconds"""
+        if mode not in SYNCMODES:
+            raise BadSyncMode, mode
+        self.db = hashopen(filename, 'c')
+        self.mode = mode
+        self.batch = batch
+        self.window = window
+        self.pending = {}
+        self.lock = Lock()
+        self.running = True
+        self.ev = Event()
+        self.flusher = None
+        if self.mode == 'batch':
+            self.flusher = Thread(target=self.run, name='HashDBFlusher')
+            self.flusher.setDaemon(True)
+            self.flusher.start()
+
+    def run(self):
+        """flushes pending changes every window seconds"""
+        while self.running:
+            self.ev.wait(self.window)
+            self.flush()
+
+    def _flush(self):
+        """applies the overlay to the file, lock must be held"""
+        if not self.pending:
+            return
+        for key, value in self.pending.items():
+            if value is DELETED:
+                if self.db.has_key(key):
+                    del self.db[key]
+            else:
+                self.db[key] = value
+        self.pending = {}
+        self.db.sync()
+
+    def flush(self):
+        """writes and syncs the pending changes"""
+        self.lock.acquire()
+        try:
+            self._flush()
+        finally:
+            self.lock.release()
+
+    def _changed(self):
+        """called after each change, lock must be held"""
+        if self.mode == 'always':
+            self.db.sync()
+        elif self.mode == 'batch' and len(self.pending) >= self.batch:
+            self._flush()
+
+    def has_key(self, key):
+        self.lock.acquire()
+        try:
+            if self.pending.has_key(key):
+                return self.pending[key] is not DELETED
+            return self.db.has_key(key)
+        finally:
+            self.lock.release()
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if self.pending.has_key(key):
+                value = self.pending[key]
+                if value is DELETED:
+                    return default
+                return value
+            if self.db.has_key(key):
+                return self.db[key]
+            return default
+        finally:
+            self.lock.release()
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError, key
+        return value
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            if self.mode == 'batch':
+                self.pending[key] = value
+            else:
+                self.db[key] = value
+            self._changed()
+        finally:
+            self.lock.release()
+
+    def keys(self):
+        """returns all the keys, pending changes are flushed first"""
+        self.lock.acquire()
+        try:
+            self._flush()
+            return self.db.keys()
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            if self.mode == 'batch':
+                if self.pending.get(key, DELETED) is DELETED and not self.db.has_key(key):
+                    raise KeyError, key
+                self.pending[key] = DELETED
+            else:
+                del self.db[key]
+            self._changed()
+        finally:
+            self.lock.release()
+
+    def close(self):
+        """flushes the pending changes and closes the file"""
+        self.running = False
+        self.ev.set()
+        if self.flusher is not None:
+            self.flusher.join()
+        self.lock.acquire()
+        try:
+            self._flush()
+            self.db.sync()
+            self.db.close()
+        finally:
+            self.lock.release()
+
+class BloomFilter:
+    """Bloom filter for string keys
+
+    False positives are possible, false negatives are not"""
+    def __init__(self, capacity, fprate=FPRATE):
+        """The constructor
+
+        @param capacity: expected number of keys
+        @param fprate: wanted false positive rate at capacity"""
+        capacity = max(capacity, 1)
+        self.bits = int(ceil(-capacity * log(fprate) / (log(2) ** 2)))
+        self.hashes = max(1, int(round(self.bits * log(2) / capacity)))
+        self.clear()
+
+    def clear(self):
+        self.array = array('B', [0]) * ((self.bits + 7) >> 3)
+
+    def positions(self, key):
+        ## Double hashing on md5
+        h1, h2 = unpack('<QQ', MD5(key).digest())
+        return [ (h1 + i * h2) % self.bits for i in range(self.hashes) ]
+
+    def add(self, key):
+        for pos in self.positions(key):
+            self.array[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, key):
+        for pos in self.positions(key):
+            if not self.array[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+class Generation:
+    """A time bucket of the DedupStore, a HashDB file"""
+    def __init__(self, filename, start, mode, batch, window):
+        self.filename = filename
+        self.start = start
+        self.db = HashDB(filename, mode, batch, window)
+        self.count = len(self.db.keys())
+
+    def drop(self):
+        """closes and removes the file"""
+        self.db.close()
+        try:
+            unlink(self.filename)
+        except: pass
+
+class DedupStore:
+    """Expiring and bounded duplicate detection store
+
+    Keys are stored in time-bucketed generations, each one is a HashDB
+    file named after the time it was started. A new generation is started
+    every ttl/generations seconds or when the current one holds
+    maxkeys/generations keys; a generation is dropped whole when all its
+    keys are older than ttl or when there are too many generations.
+
+    A Bloom filter of all the live keys is kept in memory, keys never seen
+    are answered without touching the files. Deleted and expired keys
+    stay in the filter until a generation is dropped and it is rebuilt."""
+    def __init__(self, filename, ttl=TTL, generations=GENERATIONS, maxkeys=MAXKEYS,
+                 mode='batch', batch=BATCH, window=WINDOW):
+        """The constructor
+
+        @param filename: base name of the generation files
+        @param ttl: seconds a key is remembered at least, if the size allows
+        @param generations: number of time buckets in ttl
+        @param maxkeys: max number of keys, approximately"""
+        self.filename = filename
+        self.ttl = ttl
+        self.generations = max(1, generations)
+        self.span = float(ttl) / self.generations
+        self.genkeys = max(1, maxkeys / self.generations)
+        self.mode = mode
+        self.batch = batch
+        self.window = window
+        self.lock = Lock()
+        self.bloom = BloomFilter(self.genkeys * (self.generations + 1))
+        self.gens = []
+
+        ## Old unbounded hashdb: keep it as the oldest generation, it will expire
+        if path.exists(filename):
+            self.gens.append(Generation(filename, stat(filename).st_mtime, mode, batch, window))
+
+        dirname, basename = path.split(path.abspath(filename))
+        prefix = basename + '.'
+        starts = []
+        for name in listdir(dirname):
+            if name.startswith(prefix) and name[len(prefix):].isdigit():
+                starts.append(int(name[len(prefix):]))
+        starts.sort()
+        for start in starts:
+            self.gens.append(Generation('%s.%d' % (filename, start), start, mode, batch, window))
+
+        self.maintain(time())
+        self.rebuild()
+
+    def newgen(self, now):
+        start = int(now)
+        if self.gens and start <= self.gens[-1].start:
+            start = int(self.gens[-1].start) + 1
+        self.gens.append(Generation('%s.%d' % (self.filename, start), start, self.mode, self.batch, self.window))
+
+    def maintain(self, now):
+        """rotates and expires generations, lock must be held
+
+        @return: True if a generation has been dropped"""
+        if not self.gens or (now - self.gens[-1].start) >= self.span \
+               or self.gens[-1].count >= self.genkeys:
+            self.newgen(now)
+
+        dropped = False
+        while len(self.gens) > 1:
+            ## Keys of the oldest generation were all added before the next one started
+            if (now - self.gens[1].start) < self.ttl and len(self.gens) <= (self.generations + 1):
+                break
+            self.gens.pop(0).drop()
+            dropped = True
+        return dropped
+
+    def rebuild(self):
+        """fills the Bloom filter again from the live generations, lock must be held"""
+        self.bloom.clear()
+        for gen in self.gens:
+            for key in gen.db.keys():
+                self.bloom.add(key)
+
+    ## Lookups and deletes hold the lock, maintain() could close a
+    ## generation while it's being read
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            if key not in self.bloom:
+                return default
+            for index in range(len(self.gens) - 1, -1, -1):
+                value = self.gens[index].db.get(key)
+                if value is not None:
+                    return value
+            return default
+        finally:
+            self.lock.release()
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError, key
+        return value
+
+    def __setitem__(self, key, value):
+        self.lock.acquire()
+        try:
+            if self.maintain(time()):
+                self.rebuild()
+            gen = self.gens[-1]
+            gen.db[key] = value
+            gen.count = gen.count + 1
+            self.bloom.add(key)
+        finally:
+            self.lock.release()
+
+    def __delitem__(self, key):
+        self.lock.acquire()
+        try:
+            if key not in self.bloom:
+                raise KeyError, key
+            found = False
+            for gen in self.gens:
+                try:
+                    del gen.db[key]
+                    found = True
+                except KeyError:
+                    pass
+        finally:
+            self.lock.release()
+        if not found:
+            raise KeyError, key
+
+    def close(self):
+        """flushes and closes all the generations"""
+        self.lock.acquire()
+        try:
+            for gen in self.gens:
+                gen.db.close()
+            self.gens = []
+        finally:
+            self.lock.release()
+
+def listener(address):
+    """returns the listening unix socket for a DedupServer
+
+    It's made by the parent process, so clients connecting while the
+    server is restarted wait in the backlog"""
+    try:
+        unlink(address)
+    except: pass
+    sock = socket(AF_UNIX, SOCK_STREAM)
+    sock.bind(address)
+    sock.listen(BACKLOG)
+    return sock
+
+class DedupServer:
+    """Serves a DedupStore to the processes sharing it
+
+    bsddb files can't be shared by processes, the store is owned by the
+    server process and the others use it with a DedupClient. Requests and
+    replies are lines: get key, put key value and del key are answered
+    with + value, + or - if the key is missing; each client connection is
+    served by its own thread"""
+    def __init__(self, store, sock):
+        """The constructor
+
+        @param store: the DedupStore, closed by serve()
+        @param sock: the listening socket from listener()"""
+        self.store = store
+        self.socket = sock
+        self.running = True
+
+    def serve(self):
+        """serves the clients until stop() is called"""
+        while self.running:
+            ## A signal could be handled by another thread, don't block in accept
+            try:
+                if not select([ self.socket ], [], [], GRANULARITY)[0]:
+                    continue
+                conn, addr = self.socket.accept()
+            except (select_error, socket_error):
+                ## Interrupted by a signal
+                continue
+            client = Thread(target=self.handle, args=(conn,), name='DedupClient')
+            client.setDaemon(True)
+            client.start()
+        self.store.close()
+
+    def stop(self):
+        self.running = False
+
+    def handle(self, conn):
+        reader = conn.makefile('rb')
+        try:
+            while 1:
+                line = reader.readline()
+                if not line:
+                    break
+                conn.sendall(self.request(line.rstrip('\n')))
+        except socket_error:
+            pass
+        reader.close()
+        conn.close()
+
+    def request(self, line):
+        args = line.split(' ', 2)
+        if args[0] == 'get' and len(args) == 2:
+            value = self.store.get(args[1])
+            if value is None:
+                return '-\n'
+            return '+ %s\n' % value
+        if args[0] == 'put' and len(args) == 3:
+            self.store[args[1]] = args[2]
+            return '+\n'
+        if args[0] == 'del' and len(args) == 2:
+            try:
+                del self.store[args[1]]
+            except KeyError:
+                return '-\n'
+            return '+\n'
+        return '! bad request\n'
+
+class DedupClient:
+    """A DedupStore of a DedupServer, with the same interface
+
+    Thread safe, requests are sent one at time on a single connection.
+    If the server goes away the request is sent again on a new
+    connection, waiting up to wait seconds for the server to be back,
+    then DedupError is raised"""
+    def __init__(self, address, wait=WAIT):
+        self.address = address
+        self.wait = wait
+        self.lock = Lock()
+        self.conn = None
+        self.reader = None
+
+    def connect(self):
+        conn = socket(AF_UNIX, SOCK_STREAM)
+        conn.settimeout(self.wait)
+        conn.connect(self.address)
+        self.conn = conn
+        self.reader = conn.makefile('rb')
+
+    def disconnect(self):
+        if self.conn is None:
+            return
+        try:
+            self.reader.close()
+            self.conn.close()
+        except: pass
+        self.conn = self.reader = None
+
+    def request(self, *args):
+        line = ' '.join(args)
+        if line.find('\n') != -1:
+            raise ValueError, 'newline in key or value'
+        deadline = time() + self.wait
+        self.lock.acquire()
+        try:
+            while 1:
+                try:
+                    if self.conn is None:
+                        self.connect()
+                    self.conn.sendall(line + '\n')
+                    reply = self.reader.readline()
+                    if reply:
+                        break
+                    error = 'connection closed'
+                except socket_error, val:
+                    error = str(val)
+                self.disconnect()
+                if time() >= deadline:
+                    raise DedupError, 'hashdb server %s: %s' % (self.address, error)
+                sleep(0.1)
+        finally:
+            self.lock.release()
+        reply = reply.rstrip('\n')
+        if reply.startswith('!'):
+            raise DedupError, reply[1:].strip()
+        return reply
+
+    def get(self, key, default=None):
+        reply = self.request('get', key)
+        if reply == '-':
+            return default
+        return reply[2:]
+
+    def has_key(self, key):
+        return self.get(key) is not None
+
+    def __getitem__(self, key):
+        value = self.get(key)
+        if value is None:
+            raise KeyError, key
+        return value
+
+    def __setitem__(self, key, value):
+        self.request('put', key, value)
+
+    def __delitem__(self, key):
+        if self.request('del', key) == '-':
+            raise KeyError, key
+
+    def close(self):
+        self.lock.acquire()
+        try:
+            self.disconnect()
+        finally:
+            self.lock.release()
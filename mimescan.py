@@ -0,0 +1,224 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file mimescan.py
+## Header and MIME parts scanner working on offsets of the mail buffer
+
+__doc__ = '''Netfarm Archiver - release 2.1.0 - MIME scanner'''
+__version__ = '2.1.0'
+__all__ = [ 'ScannedMessage', 'Segments' ]
+
+from mimetools import Message
+from utils import parse_message
+
+NL    = '\n'
+CHUNK = 65536
+
+class Segments:
+    """A mail made of slices of strings, never joined
+
+    Used to change the headers of a mail without copying the body:
+    a new header block followed by the body slice of the received
+    mail. Slices can also be of a mmap of a spooled mail. Files and
+    sockets get the slices as buffer objects."""
+    def __init__(self, data=None):
+        self.segments = []
+        if data is not None:
+            self.append(data)
+
+    def append(self, data, start=0, end=None):
+        """adds data[start:end] at the end of the mail"""
+        if end is None:
+            end = len(data)
+        if end > start:
+            self.segments.append((data, start, end))
+
+    def __len__(self):
+        size = 0
+        for data, start, end in self.segments:
+            size = size + end - start
+        return size
+
+    def __str__(self):
+        """the whole mail as a string, it's a copy"""
+        if len(self.segments) == 1:
+            ## The string itself if it's the whole one
+            data, start, end = self.segments[0]
+            return data[start:end]
+        return ''.join([ data[start:end] for data, start, end in self.segments ])
+
+    def writeto(self, fd):
+        """writes the mail to a file object"""
+        for data, start, end in self.segments:
+            fd.write(buffer(data, start, end - start))
+
+    def chunks(self, size=CHUNK):
+        """yields the mail in chunks of about size bytes ending with a newline,
+        the last one excepted"""
+        carry = ''
+        for data, start, end in self.segments:
+            pos = start
+            while pos < end:
+                eol = data.find(NL, min(pos + size, end) - 1, end)
+                if eol == -1:
+                    carry = carry + data[pos:end]
+                    break
+                yield carry + data[pos:eol+1]
+                carry = ''
+                pos = eol + 1
+        if carry:
+            yield carry
+
+class ScannedMessage(Message):
+    """mimetools.Message built from a string buffer, or a mmap
+
+    Headers are scanned in place, the body is never copied: startofbody
+    and endofbody are offsets in the buffer. Parts of a multipart message
+    are found with str.find on the boundary, instead of the line by line
+    reading of multifile.MultiFile."""
+    def __init__(self, data, start=0, end=None):
+        """The constructor
+
+        @param data: the mail
+        @param start: offset of the headers
+        @param end: offset of the end of the mail"""
+        if end is None:
+            end = len(data)
+        self.fp = None
+        self.seekable = 0
+        self.data = data
+        self.startofheaders = start
+        self.endofbody = end
+        self.readheaders()
+        self.encodingheader = self.getheader('content-transfer-encoding')
+        self.typeheader = self.getheader('content-type')
+        self.parsetype()
+        self.parseplist()
+
+    def readheaders(self):
+        """rfc822.Message.readheaders on the buffer, sets startofbody"""
+        data = self.data
+        end = self.endofbody
+        self.dict = {}
+        self.unixfrom = ''
+        self.headers = lst = []
+        self.status = ''
+        headerseen = ''
+        firstline = 1
+        pos = self.startofheaders
+        while 1:
+            if pos >= end:
+                self.status = 'EOF in headers'
+                break
+            eol = data.find('\n', pos, end)
+            if eol == -1:
+                eol = end
+            else:
+                eol = eol + 1
+            line = data[pos:eol]
+            start, pos = pos, eol
+            if firstline and line.startswith('From '):
+                self.unixfrom = self.unixfrom + line
+                continue
+            firstline = 0
+            if headerseen and line[0] in ' \t':
+                ## Continuation line
+                lst.append(line)
+                self.dict[headerseen] = (self.dict[headerseen] + '\n ' + line.strip()).strip()
+                continue
+            elif line in ('\r\n', '\n'):
+                break
+            headerseen = self.isheader(line)
+            if headerseen:
+                lst.append(line)
+                self.dict[headerseen] = line[len(headerseen)+1:].strip()
+                continue
+            elif headerseen is not None:
+                continue
+            else:
+                if not self.dict:
+                    self.status = 'No headers'
+                else:
+                    self.status = 'Non-header line where header expected'
+                ## The line is part of the body
+                pos = start
+                break
+        self.startofbody = pos
+
+    def getbody(self):
+        """returns the body as a string"""
+        return self.data[self.startofbody:self.endofbody]
+
+    def withheaders(self, headers):
+        """returns the mail with a new header block, the body is not copied
+
+        @param headers: the header block, blank line included
+        @return: a Segments object"""
+        mail = Segments(headers)
+        mail.append(self.data, self.startofbody, self.endofbody)
+        return mail
+
+    def parts(self):
+        """returns the offsets of the parts of a multipart message
+
+        Like MultiFile the preamble and the epilogue are skipped, the
+        last part ends at the end of the mail if the end marker is missing
+        @return: a list of (start, end) tuples"""
+        boundary = self.getparam('boundary')
+        if self.maintype != 'multipart' or not boundary:
+            return []
+        data = self.data
+        end = self.endofbody
+        delimiter = '\n--' + boundary
+        parts = []
+        partstart = None
+        ## The newline before the body is the one of the first delimiter
+        pos = max(self.startofbody - 1, self.startofheaders)
+        while 1:
+            index = data.find(delimiter, pos, end)
+            if index == -1:
+                if partstart is not None:
+                    parts.append((partstart, end))
+                break
+            eol = data.find('\n', index + 1, end)
+            if eol == -1:
+                eol = end
+            marker = data[index+len(delimiter):eol].rstrip()
+            pos = eol
+            if marker not in ('', '--'):
+                ## Only a line beginning with the boundary
+                continue
+            if partstart is not None:
+                parts.append((partstart, index))
+            if marker == '--':
+                break
+            partstart = eol + 1
+        return parts
+
+    def attachments(self):
+        """returns the attachments as utils.parse_message does for each part"""
+        found = []
+        if self.maintype != 'multipart':
+            parts = [ self ]
+        else:
+            parts = [ ScannedMessage(self.data, start, end) for start, end in self.parts() ]
+        for part in parts:
+            attach = parse_message(part)
+            if attach is not None:
+                found.append(attach)
+        return found
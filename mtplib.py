@@ -22,17 +22,37 @@
 from sys import platform, hexversion
 if platform != 'win32':
     from socket import AF_UNIX
-from asynchat import async_chat, fifo
-from asyncore import loop, dispatcher
+    from socket import socketpair
+from asynchat import async_chat, find_prefix_at_end
+try:
+    ## python >= 2.6 async_chat uses a deque as producer fifo
+    from asynchat import deque as fifo
+except ImportError:
+    from asynchat import fifo
+from asyncore import loop, dispatcher, compact_traceback
 from asyncore import close_all as asyncore_close_all
 from socket import gethostbyaddr, gethostbyname, gethostname
-from socket import socket, AF_INET, SOCK_STREAM
+from socket import socket, error as socket_error, AF_INET, SOCK_STREAM
+from socket import IPPROTO_TCP, TCP_NODELAY, SOL_SOCKET
+try:
+    from socket import SO_REUSEPORT
+except ImportError:
+    ## python < 3.4 doesn't export it
+    if platform.startswith('linux'):
+        SO_REUSEPORT = 15
+    else:
+        SO_REUSEPORT = None
+from threading import Thread, Condition
+from Queue import Queue, Empty
 from sys import argv
 from time import time, ctime
 from os import unlink, chmod
+from cStringIO import StringIO
+from tempfile import TemporaryFile
+from mmap import mmap, ACCESS_READ
 import re
 
-__all__ = [ 'MTPServer' ]
+__all__ = [ 'MTPServer', 'LMTPServer' ]
 __version__ = 'Python Generic MTP Server version 0.2'
 
 if hexversion < 0x02030000:
@@ -42,6 +62,9 @@ NEWLINE     = '\n'
 QUOTE       = '\\'
 EMPTYSTRING = ''
 SPECIAL     = '<>()[]," '
+BACKLOG     = 128
+CRLF        = '\r\n'
+ENDDATA     = '\r\n.\r\n'
 
 re_rel  = re.compile(r"<@.*:(.*)>(.*)")
 re_addr = re.compile(r"<(.*)>(.*)")
@@ -149,12 +172,304 @@ def getaddr(keyword, arg):
 
     return address, options
 
+def make_socketpair():
+    """returns a pair of connected sockets
+
+    win32 has no socketpair(), a loopback tcp connection is used instead"""
+    if platform != 'win32':
+        return socketpair()
+    listener = socket(AF_INET, SOCK_STREAM)
+    listener.bind(('127.0.0.1', 0))
+    listener.listen(1)
+    writer = socket(AF_INET, SOCK_STREAM)
+    writer.connect(listener.getsockname())
+    reader = listener.accept()[0]
+    listener.close()
+    return reader, writer
+
+class Trigger(dispatcher):
+    """Trigger to wake up the asyncore loop from other threads
+
+    Channels must only be touched by the thread running the loop,
+    other threads pull the trigger and the callback is run by the loop"""
+    def __init__(self, callback, map=None):
+        """The constructor"""
+        reader, self.writer = make_socketpair()
+        self.writer.setblocking(0)
+        self.callback = callback
+        self.map = map
+        dispatcher.__init__(self, reader, self.map)
+
+    def pull(self):
+        """wakes up the loop, safe to be called from any thread"""
+        try:
+            self.writer.send('x')
+        except socket_error:
+            ## Buffer full: the loop has a pending wakeup anyway
+            pass
+
+    def writable(self):
+        return 0
+
+    def handle_connect(self):
+        pass
+
+    def handle_read(self):
+        try:
+            self.recv(8192)
+        except socket_error:
+            return
+        self.callback()
+
+    def close(self):
+        """Close the trigger and both sockets"""
+        self.del_channel(self.map)
+        self.socket.close()
+        try:
+            self.writer.close()
+        except: pass
+
+class JobTracker:
+    """Keeps count of the messages being processed
+
+    Used to wait for the running jobs on shutdown"""
+    def __init__(self):
+        """The constructor"""
+        self.cond = Condition()
+        self.running = 0
+
+    def begin(self):
+        self.cond.acquire()
+        self.running = self.running + 1
+        self.cond.release()
+
+    def end(self):
+        self.cond.acquire()
+        self.running = self.running - 1
+        if self.running == 0:
+            self.cond.notifyAll()
+        self.cond.release()
+
+    def wait(self, timeout=None):
+        """waits until there are no running jobs
+
+        @param timeout: max seconds to wait, None waits forever
+        @return: the number of jobs still running"""
+        self.cond.acquire()
+        try:
+            if timeout is not None:
+                deadline = time() + timeout
+            while self.running:
+                if timeout is None:
+                    self.cond.wait()
+                else:
+                    remaining = deadline - time()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            return self.running
+        finally:
+            self.cond.release()
+
+class WorkerPool:
+    """Pool of threads running process_message outside the asyncore loop
+
+    Jobs are queued by the channels, the replies are queued back and
+    handed to the channels by the loop thread through a Trigger"""
+    def __init__(self, server, size, map):
+        """The constructor"""
+        self.server = server
+        self.jobs = Queue()
+        self.done = Queue()
+        self.trigger = Trigger(self.complete, map)
+        self.workers = []
+        for i in range(size):
+            worker = Thread(target=self.work, name='MTPWorker-%d' % i)
+            worker.setDaemon(True)
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, channel, args):
+        """queues a job for the workers"""
+        self.jobs.put((channel, args))
+
+    def work(self):
+        """worker thread main loop"""
+        while 1:
+            job = self.jobs.get()
+            if job is None:
+                break
+            channel, args = job
+            try:
+                status = apply(self.server.process_message, args)
+            except:
+                nil, t, v, tbinfo = compact_traceback()
+                self.server.log_info('uncaptured python exception in worker (%s:%s %s)' % (t, v, tbinfo), 'error')
+                status = '451 4.3.0 Internal server error'
+            self.done.put((channel, status))
+            self.trigger.pull()
+
+    def complete(self):
+        """hands the replies to the channels, called by the loop thread"""
+        while 1:
+            try:
+                channel, status = self.done.get_nowait()
+            except Empty:
+                break
+            channel.job_done(status)
+            self.server.jobs.end()
+            ## Commands sent while the channel was busy
+            channel.process_input()
+
+    def stop(self):
+        """stops the workers after the queued jobs are done"""
+        for worker in self.workers:
+            self.jobs.put(None)
+        for worker in self.workers:
+            worker.join()
+        self.workers = []
+
+class Spool:
+    """Message data buffer
+
+    Data is kept in memory up to size bytes, then it's moved to a
+    temporary file in dir. The file is deleted when the spool is closed"""
+    def __init__(self, size, dir=None):
+        """The constructor"""
+        self.size = size
+        self.dir = dir
+        self.file = StringIO()
+        self.length = 0
+        self.spooled = False
+
+    def write(self, data):
+        if not data:
+            return
+        self.length = self.length + len(data)
+        if not self.spooled and self.length > self.size:
+            fd = TemporaryFile(dir=self.dir)
+            fd.write(self.file.getvalue())
+            self.file = fd
+            self.spooled = True
+        self.file.write(data)
+
+    def __len__(self):
+        return self.length
+
+    def read(self, size=-1):
+        return self.file.read(size)
+
+    def readline(self, size=-1):
+        return self.file.readline(size)
+
+    def seek(self, pos, whence=0):
+        self.file.seek(pos, whence)
+
+    def tell(self):
+        return self.file.tell()
+
+    def mapped(self):
+        """returns the whole data without reading the file
+
+        @return: a string while the data is in memory, else a read only
+        mmap of the file, a string like object that stays valid after close"""
+        if not self.spooled:
+            return self.file.getvalue()
+        self.file.flush()
+        return mmap(self.file.fileno(), 0, access=ACCESS_READ)
+
+    def close(self):
+        self.file.close()
+
+class DataDecoder:
+    """Decoder for the DATA section
+
+    Finds the end of data, removes the transparency dots and converts
+    CRLF to LF (RFC 821, Section 4.5.2) in a single pass, chunk by chunk
+    as data arrives. A trailing partial match of the end of data sequence
+    is held back until the next chunk, so line starts and the terminator
+    spanning two chunks are recognized"""
+    def __init__(self, out):
+        """The constructor
+
+        @param out: file like object receiving the decoded data"""
+        self.out = out
+        ## The data starts at the beginning of a line, so a lone
+        ## dot line right after DATA is the end of an empty message
+        self.carry = CRLF
+        self.first = True
+
+    def feed(self, data):
+        """decodes a chunk of data
+
+        @return: None if the end of data is not found yet, else the data
+        following the end of data that belongs to the next command"""
+        data = self.carry + data
+        index = data.find(ENDDATA)
+        if index != -1:
+            self.carry = ''
+            self.write(data[:index])
+            return data[index+len(ENDDATA):]
+        keep = find_prefix_at_end(data, ENDDATA)
+        self.carry = data[len(data)-keep:]
+        self.write(data[:len(data)-keep])
+        return None
+
+    def write(self, data):
+        if not data:
+            return
+        data = NEWLINE.join(data.replace(CRLF + '.', CRLF).split(CRLF))
+        if self.first:
+            ## Drop the CRLF used to mark the beginning of the data
+            data = data[1:]
+            self.first = False
+        self.out.write(data)
+
+class Discard:
+    """Sink for the data of messages refused while received"""
+    def write(self, data):
+        pass
+
+    def close(self):
+        pass
+
+class BdatDecoder:
+    """Decoder for BDAT chunks
+
+    Chunks are length delimited and not dot stuffed (RFC 3030), only CRLF
+    is converted to LF. A trailing CR is held back until the next chunk"""
+    def __init__(self, out):
+        """The constructor
+
+        @param out: file like object receiving the decoded data"""
+        self.out = out
+        self.carry = ''
+
+    def feed(self, data):
+        data = self.carry + data
+        if data.endswith('\r'):
+            self.carry = '\r'
+            data = data[:-1]
+        else:
+            self.carry = ''
+        if data:
+            self.out.write(NEWLINE.join(data.split(CRLF)))
+
+    def close(self):
+        """flushes the held back data"""
+        data, self.carry = self.carry, ''
+        self.out.write(data)
+
 class MTPChannel(async_chat):
     """MTPChannel for communications with clients
 
     A subclass of async_chat, ideal to handle 'chat' like protocols"""
     COMMAND = 0
     DATA = 1
+    BUSY = 2
+    BDAT = 3
+    ## Bigger reads, less per chunk work while receiving DATA
+    ac_in_buffer_size = 65536
     def __init__(self, server, conn, addr, map=None):
         """The constructor"""
         self.ac_in_buffer = ''
@@ -173,14 +488,95 @@ class MTPChannel(async_chat):
         self.__rcpttos = []
         self.__rcptopts = []
         self.__data = ''
-        self.__fqdn = gethostbyaddr(gethostbyname(gethostname()))[0]
+        self.__decoder = None
+        self.__bdat_left = 0
+        self.__bdat_last = False
+        self.__bdat_error = None
+        self.__size = 0
+        self.__toobig = False
+        self.__replies = []
+        self.__closed = False
+        self.__fqdn = server.fqdn
         self.__peer = conn.getpeername()
         self.push('220 %s %s' % (self.__fqdn, server.banner))
+        self.flush()
         self.set_terminator('\r\n')
         self.__getaddr = getaddr
 
     def push(self, msg):
-        async_chat.push(self, msg + '\r\n')
+        """queues a reply, replies are sent by flush()"""
+        self.__replies.append(msg + '\r\n')
+
+    def flush(self):
+        """sends the queued replies
+
+        Replies to pipelined commands are sent together when the
+        input buffer has been processed, RFC 2920"""
+        if self.__replies and not self.__closed:
+            async_chat.push(self, EMPTYSTRING.join(self.__replies))
+        self.__replies = []
+
+    def readable(self):
+        """Stop reading while the message is being processed"""
+        return self.__state != self.BUSY and async_chat.readable(self)
+
+    def handle_read(self):
+        try:
+            data = self.recv(self.ac_in_buffer_size)
+        except socket_error:
+            self.handle_error()
+            return
+        self.ac_in_buffer = self.ac_in_buffer + data
+        self.process_input()
+
+    def process_input(self):
+        """Splits the input buffer on the terminator
+
+        Same as async_chat, but the buffered input is left untouched
+        while a job is running, it will be processed when the reply is sent.
+        In DATA state the whole buffer goes to the decoder, that finds the
+        end of data by itself. In BDAT state the chunk size is consumed"""
+        while self.ac_in_buffer and self.__state != self.BUSY and not self.__closed:
+            if self.__state == self.DATA:
+                rest = self.__decoder.feed(self.ac_in_buffer)
+                if self.__server.maxsize and not self.__toobig:
+                    self.__size = self.__size + len(self.ac_in_buffer) - len(rest or '')
+                    if self.__size > self.__server.maxsize:
+                        self.discard_data()
+                if rest is None:
+                    self.ac_in_buffer = ''
+                    break
+                self.ac_in_buffer = rest
+                self.found_terminator()
+                continue
+            if self.__state == self.BDAT:
+                size = min(self.__bdat_left, len(self.ac_in_buffer))
+                if self.__bdat_error is None:
+                    self.__decoder.feed(self.ac_in_buffer[:size])
+                self.ac_in_buffer = self.ac_in_buffer[size:]
+                self.__bdat_left = self.__bdat_left - size
+                if self.__bdat_left == 0:
+                    self.bdat_done()
+                continue
+            lb = len(self.ac_in_buffer)
+            terminator = self.get_terminator()
+            index = self.ac_in_buffer.find(terminator)
+            if index != -1:
+                if index > 0:
+                    self.collect_incoming_data(self.ac_in_buffer[:index])
+                self.ac_in_buffer = self.ac_in_buffer[index+len(terminator):]
+                self.found_terminator()
+            else:
+                index = find_prefix_at_end(self.ac_in_buffer, terminator)
+                if index:
+                    if index != lb:
+                        self.collect_incoming_data(self.ac_in_buffer[:-index])
+                        self.ac_in_buffer = self.ac_in_buffer[-index:]
+                    break
+                else:
+                    self.collect_incoming_data(self.ac_in_buffer)
+                    self.ac_in_buffer = ''
+        self.flush()
 
     def collect_incoming_data(self, data):
         self.__line.append(data)
@@ -210,34 +606,106 @@ class MTPChannel(async_chat):
             if self.__state != self.DATA:
                 self.push('451 4.3.0 Internal confusion')
                 return
-            ## Remove extraneous carriage returns and de-transparency according
-            ## to RFC 821, Section 4.5.2.
-            data = []
-            for text in line.split('\r\n'):
-                if text and text[0] == '.':
-                    data.append(text[1:])
-                else:
-                    data.append(text)
-            self.__data = NEWLINE.join(data)
-            status = self.__server.process_message(self.__peer,
-                                                   self.__mailfrom,
-                                                   self.__mail_options,
-                                                   self.__rcpttos,
-                                                   self.__rcptopts,
-                                                   self.__data)
-            self.__rcpttos = []
-            self.__rcptopts = []
-            self.__mailfrom = None
-            self.__mail_options = []
+            self.end_data()
+
+    def new_data(self, decoder):
+        """prepares the message data buffer and its decoder"""
+        if self.__server.spoolsize is not None:
+            self.__data = Spool(self.__server.spoolsize, self.__server.spooldir)
+        else:
+            self.__data = StringIO()
+        self.__decoder = decoder(self.__data)
+        self.__size = 0
+
+    def discard_data(self):
+        """the message is bigger than maxsize, the rest of it is not stored"""
+        self.__toobig = True
+        self.__data.close()
+        self.__data = Discard()
+        self.__decoder.out = self.__data
+
+    def end_data(self):
+        """the message is complete, hands it to the server"""
+        if self.__toobig:
+            self.reset_transaction()
             self.__state = self.COMMAND
-            self.set_terminator('\r\n')
+            self.push('552 5.3.4 Error: message size exceeds fixed limit')
+            return
+        ## Data has been decoded while received
+        self.__decoder = None
+        if isinstance(self.__data, Spool):
+            self.__data.seek(0)
+        else:
+            self.__data = self.__data.getvalue()
+        self.__state = self.BUSY
+        self.__server.dispatch(self, (self.__peer,
+                                      self.__mailfrom,
+                                      self.__mail_options,
+                                      self.__rcpttos,
+                                      self.__rcptopts,
+                                      self.__data))
+
+    def bdat_done(self):
+        """a BDAT chunk has been received"""
+        self.__state = self.COMMAND
+        if self.__bdat_error is not None:
+            self.push(self.__bdat_error)
+            self.__bdat_error = None
+            if self.__toobig:
+                self.reset_transaction()
+            return
+        if self.__bdat_last:
+            self.__decoder.close()
+            self.end_data()
+        else:
+            self.push('250 2.0.0 Ok: chunk received')
+
+    def job_done(self, status):
+        """Sends the reply for the processed message
+
+        Called by the loop thread when process_message has returned.
+        status is None for success, a reply, or a list with a reply
+        (or None) for each recipient. In LMTP there is a reply for each
+        recipient, in SMTP the first error is sent"""
+        self.reset_data()
+        if self.__closed:
+            return
+        if isinstance(status, list):
+            statuses = status
+        else:
+            statuses = [ status ] * len(self.__rcpttos)
+        if not self.__server.lmtp:
+            statuses = filter(None, statuses)[:1] or [ None ]
+        self.reset_transaction()
+        self.__state = self.COMMAND
+        for status in statuses:
             if not status:
                 self.push('250 2.0.0 Ok')
             else:
                 self.push(status)
 
+    def reset_data(self):
+        """drops the message data, removing the spool file if any"""
+        if not isinstance(self.__data, str):
+            self.__data.close()
+        self.__data = ''
+        self.__decoder = None
+        self.__toobig = False
+
+    def reset_transaction(self):
+        """drops the envelope and the data"""
+        self.__mailfrom = None
+        self.__mail_options = []
+        self.__rcpttos = []
+        self.__rcptopts = []
+        self.reset_data()
+
     def close(self):
         """Close the channel and the socket"""
+        self.__closed = True
+        if self.__state != self.BUSY:
+            ## A running job still owns the data
+            self.reset_data()
         self.del_channel(self.map)
         self.socket.close()
 
@@ -247,6 +715,9 @@ class MTPChannel(async_chat):
 
     # commands implementation
     def impl_HELO(self, arg):
+        if self.__server.lmtp:
+            self.push('500 5.5.1 Error: use LHLO')
+            return
         if not arg:
             self.push('500 5.5.2 Syntax: HELO hostname')
             return
@@ -254,19 +725,36 @@ class MTPChannel(async_chat):
             self.push('501 5.5.1 Duplicate HELO')
         else:
             self.__greeting = arg
-            self.push('250-%s' % self.__fqdn)
+            self.push('250 %s' % self.__fqdn)
 
     def impl_EHLO(self, arg):
+        if self.__server.lmtp:
+            self.push('500 5.5.1 Error: use LHLO')
+            return
+        self.hello('EHLO', arg)
+
+    def impl_LHLO(self, arg):
+        if not self.__server.lmtp:
+            self.push('502 5.5.1 Error: command LHLO not implemented')
+            return
+        self.hello('LHLO', arg)
+
+    def hello(self, command, arg):
+        """EHLO and LHLO, replies with the extensions"""
         if not arg:
-            self.push('500 5.5.2 Syntax: EHLO hostname')
+            self.push('500 5.5.2 Syntax: %s hostname' % command)
             return
         if self.__greeting:
-            self.push('501 5.5.1 Duplicate EHLO')
+            self.push('501 5.5.1 Duplicate %s' % command)
         else:
             self.__greeting = arg
             self.__emtp = True
-            self.push('250-%s' % self.__fqdn)
-            self.push('250 DSN')
+            ## Multiline replies in a single write
+            self.push(CRLF.join(['250-%s' % self.__fqdn,
+                                 '250-SIZE %d' % self.__server.maxsize,
+                                 '250-PIPELINING',
+                                 '250-CHUNKING',
+                                 '250 DSN']))
 
     def impl_NOOP(self, arg):
         if arg:
@@ -276,16 +764,13 @@ class MTPChannel(async_chat):
 
     def impl_QUIT(self, dummy):
         self.push('221 2.0.0 Bye')
+        self.flush()
         self.close_when_done()
 
     def impl_RSET(self, dummy):
         self.__line = []
         self.__state = self.COMMAND
-        self.__mailfrom = None
-        self.__mail_options = []
-        self.__rcpttos = []
-        self.__rcptopts = []
-        self.__data = ''
+        self.reset_transaction()
         self.__emtp = False
         self.push('250 2.0.0 Ok')
 
@@ -297,6 +782,22 @@ class MTPChannel(async_chat):
         if self.__mailfrom:
             self.push('503 5.5.1 Error: nested MAIL command')
             return
+        ## Declared size, RFC 1870
+        size = 0
+        for option in (options or '').split():
+            if option[:5].upper() == 'SIZE=':
+                try:
+                    size = long(option[5:])
+                except ValueError:
+                    self.push('501 5.5.4 Syntax: SIZE=size')
+                    return
+        if self.__server.maxsize and size > self.__server.maxsize:
+            self.push('552 5.3.4 Error: message size exceeds fixed limit')
+            return
+        reply = self.__server.check_sender(address, size)
+        if reply:
+            self.push(reply)
+            return
         self.__mailfrom = address
         if options: self.__mail_options.append((address, options))
         self.push('250 2.0.0 Ok')
@@ -320,17 +821,55 @@ class MTPChannel(async_chat):
         if arg:
             self.push('500 5.5.2 Syntax: DATA')
             return
+        if self.__decoder is not None:
+            self.push('503 5.5.1 Error: DATA after BDAT')
+            return
         self.__state = self.DATA
-        self.set_terminator('\r\n.\r\n')
+        self.new_data(DataDecoder)
         self.push('354 End data with <CR><LF>.<CR><LF>')
 
+    def impl_BDAT(self, arg):
+        args = (arg or '').split()
+        if len(args) not in (1, 2) or not args[0].isdigit() \
+               or (len(args) == 2 and args[1].upper() != 'LAST'):
+            self.push('501 5.5.4 Syntax: BDAT chunk-size [LAST]')
+            return
+        ## The chunk is always read, the error is sent after it
+        chunk = long(args[0])
+        if not self.__rcpttos:
+            self.__bdat_error = '503 5.5.1 Error: need RCPT command'
+        else:
+            if self.__decoder is None:
+                self.new_data(BdatDecoder)
+            self.__size = self.__size + chunk
+            if self.__server.maxsize and self.__size > self.__server.maxsize:
+                self.discard_data()
+                self.__bdat_error = '552 5.3.4 Error: message size exceeds fixed limit'
+        self.__state = self.BDAT
+        self.__bdat_left = chunk
+        self.__bdat_last = len(args) == 2
+        if self.__bdat_left == 0:
+            self.bdat_done()
+
 class MTPServer(dispatcher):
     """MTPServer dispatcher class implemented as asyncore dispatcher"""
-    def __init__(self, localaddr, del_hook=None, timeout=None):
+    def __init__(self, localaddr, del_hook=None, timeout=None, poolsize=0, spoolsize=None, spooldir=None,
+                 hostname=None, maxsize=0, reuseport=False):
         """The Constructor
 
-        Creates the listening socket"""
+        Creates the listening socket, if poolsize is greater than 0
+        messages are processed by a pool of worker threads.
+        If spoolsize is not None process_message gets the data as a
+        Spool, kept in memory up to spoolsize bytes and then in a
+        temporary file in spooldir.
+        The hostname used in replies is resolved here, once, if not given.
+        Messages bigger than maxsize bytes are refused, 0 means no limit.
+        With reuseport several processes can listen on the same tcp port"""
         self.debuglevel = 0
+        self.maxsize = maxsize
+        self.set_fqdn(hostname)
+        self.spoolsize = spoolsize
+        self.spooldir = spooldir
         self.loop = loop
         self.banner = __version__
         self.del_hook = del_hook
@@ -367,6 +906,10 @@ class MTPServer(dispatcher):
             if port == 0: raise BadPort, params
             self.create_socket(AF_INET, SOCK_STREAM)
             self.set_reuse_addr()
+            if reuseport:
+                if SO_REUSEPORT is None:
+                    raise Exception, 'SO_REUSEPORT is not available on this platform'
+                self.socket.setsockopt(SOL_SOCKET, SO_REUSEPORT, 1)
             self.socket.settimeout(timeout)
             self.bind((proto, port))
             params = port
@@ -375,7 +918,23 @@ class MTPServer(dispatcher):
         self.addr = (proto, params)
         self.map = { self.socket.fileno(): self }
 
-        self.listen(5)
+        self.jobs = JobTracker()
+        self.pool = None
+        if poolsize > 0:
+            self.pool = WorkerPool(self, poolsize, self.map)
+
+        self.listen(BACKLOG)
+
+    def set_fqdn(self, hostname=None):
+        """sets the hostname used in the banner and HELO/EHLO replies
+
+        @param hostname: the name to use, if None the local fqdn is resolved"""
+        if hostname is None:
+            try:
+                hostname = gethostbyaddr(gethostbyname(gethostname()))[0]
+            except socket_error:
+                hostname = gethostname()
+        self.fqdn = hostname
 
     def writable(self):
         """Workaround for unix sockets with select/poll"""
@@ -391,19 +950,53 @@ class MTPServer(dispatcher):
             except: pass
 
     def close_all(self):
-        """closes all connections"""
+        """closes all connections and stops the workers"""
         asyncore_close_all(self.map)
+        if self.pool is not None:
+            self.pool.stop()
+
+    ## SMTP dialect, see LMTPServer
+    lmtp = False
 
     def handle_accept(self):
         """handle client connections
         gracefully shutdown if some signal has interrupted self.accept()"""
         try:
             conn, addr = self.accept()
+            if self.localaddr[1] != 0:
+                ## Replies are written whole, don't wait for the acks
+                conn.setsockopt(IPPROTO_TCP, TCP_NODELAY, 1)
             channel = MTPChannel(self, conn, addr, self.map)
             channel.debuglevel = self.debuglevel
             if self.del_hook: channel.__del__ = self.del_hook
         except: pass
 
+    def dispatch(self, channel, args):
+        """runs process_message, in a worker thread if the pool is enabled"""
+        self.jobs.begin()
+        if self.pool is None:
+            try:
+                channel.job_done(apply(self.process_message, args))
+            finally:
+                self.jobs.end()
+        else:
+            self.pool.submit(channel, args)
+
+    def check_sender(self, mailfrom, size):
+        """called at MAIL FROM time, before reading the message
+
+        @param size: the size declared by the client, 0 if unknown
+        @return: None to accept the sender or an error reply"""
+        return None
+
     # API for "doing something useful with the message"
     def process_message(self, peer, mailfrom, mail_options, rcpttos, rcptopts, data):
         raise NotImplementedError
+
+class LMTPServer(MTPServer):
+    """MTPServer speaking LMTP (RFC 2033)
+
+    Clients greet with LHLO and get a reply for each accepted recipient
+    after the message data, process_message can return a list with
+    a reply for each recipient"""
+    lmtp = True
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file pgpartition.py
+## Partition maintenance of the partitioned archive schema
+
+## create makes the partitions of mail, recipient and authorized for the
+## current year and the next ones, run it from cron: a mail of a year
+## without partition is refused. detach takes the partitions of the years
+## older than the ones to keep out of the archive, and moves them to an
+## archive schema where they can be dumped and dropped. list shows the
+## partitions with their estimated rows.
+
+from sys import argv, stderr, exit as sys_exit
+from getopt import getopt
+from ConfigParser import ConfigParser
+from time import localtime
+from archiver import E_ERR
+from backend_pgsql import Backend
+
+## Referencing tables first, they are detached before mail
+TABLES = [ 'recipient', 'authorized', 'mail' ]
+REFERENCING = TABLES[:-1]
+
+partitions_query = """
+SELECT c.relname, c.reltuples FROM pg_inherits i
+    JOIN pg_class c ON c.oid = i.inhrelid
+    JOIN pg_class p ON p.oid = i.inhparent
+    JOIN pg_namespace n ON n.oid = c.relnamespace
+WHERE p.relname = %s AND n.nspname = current_schema()
+ORDER BY c.relname;
+"""
+create_template = 'CREATE TABLE IF NOT EXISTS %(table)s_%(year)d PARTITION OF %(table)s FOR VALUES FROM (%(year)d) TO (%(next)d);'
+detach_template = 'ALTER TABLE %(table)s DETACH PARTITION %(table)s_%(year)d;'
+## A detached partition keeps its foreign key to mail as its own
+## constraint, it would stop the detach of the mail partition
+dropfk_template = """
+DO $$
+DECLARE fk record;
+BEGIN
+    FOR fk IN SELECT conname FROM pg_constraint
+              WHERE conrelid = '%(table)s_%(year)d'::regclass AND contype = 'f' LOOP
+        EXECUTE 'ALTER TABLE %(table)s_%(year)d DROP CONSTRAINT ' || quote_ident(fk.conname);
+    END LOOP;
+END $$;
+"""
+schema_template = 'CREATE SCHEMA IF NOT EXISTS %s;'
+move_template = 'ALTER TABLE %(table)s_%(year)d SET SCHEMA %(schema)s;'
+
+### Defaults
+CONFIGFILE = '/etc/archiver.conf'
+SECTION    = 'archive'
+AHEAD      = 1  # years created after the current one
+KEEP       = 10 # years kept attached, the current one included
+SCHEMA     = 'archive'
+
+def log(severity, text):
+    if severity == E_ERR:
+        print >> stderr, text
+
+def query(backend, qs, params=None):
+    """runs a query, raises the driver exceptions"""
+    conn = backend.pool.get()
+    try:
+        conn.cursor.execute(qs, params)
+        rows = []
+        if conn.cursor.description is not None:
+            rows = conn.cursor.fetchall()
+        conn.connection.commit()
+    except:
+        backend.pool.release(conn)
+        raise
+    backend.pool.put(conn)
+    return rows
+
+def partitions(backend, table):
+    """returns the partition years of table with their estimated rows"""
+    result = []
+    prefix = table + '_'
+    for name, rows in query(backend, partitions_query, (table,)):
+        if name.startswith(prefix) and name[len(prefix):].isdigit():
+            result.append((int(name[len(prefix):]), int(rows)))
+    return result
+
+def create(backend, ahead):
+    year = localtime()[0]
+    for year in range(year, year + ahead + 1):
+        ## mail first, the others reference it
+        for table in TABLES[::-1]:
+            query(backend, create_template % dict(table=table, year=year, next=year + 1))
+        print 'Partitions of %d ready' % year
+
+def detach(backend, keep, schema):
+    first = localtime()[0] - keep + 1
+    years = [ year for year, rows in partitions(backend, 'mail') if year < first ]
+    if not years:
+        print 'No partitions older than %d' % first
+        return
+    if schema:
+        query(backend, schema_template % schema)
+    for year in years:
+        ## Each year in its own transaction
+        qs = ''
+        for table in REFERENCING:
+            qs = qs + detach_template % dict(table=table, year=year)
+            qs = qs + dropfk_template % dict(table=table, year=year)
+        qs = qs + detach_template % dict(table='mail', year=year)
+        if schema:
+            for table in TABLES:
+                qs = qs + move_template % dict(table=table, year=year, schema=schema)
+        query(backend, qs)
+        if schema:
+            print 'Partitions of %d moved to %s' % (year, schema)
+        else:
+            print 'Partitions of %d detached' % year
+
+def show(backend):
+    for table in TABLES[::-1]:
+        for year, rows in partitions(backend, table):
+            print '%-12s %6d %12d' % (table, year, rows)
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'c:s:a:k:x:')
+        if len(args) != 1 or args[0] not in ('create', 'detach', 'list'):
+            raise Exception
+    except:
+        print 'Usage %s [-c config] [-s section] [-a years_ahead] create' % argv[0]
+        print '      %s [-c config] [-s section] [-k years_kept] [-x archive_schema] detach' % argv[0]
+        print '      %s [-c config] [-s section] list' % argv[0]
+        print 'An empty archive_schema leaves the detached partitions where they are'
+        sys_exit(-1)
+
+    configfile = CONFIGFILE
+    section = SECTION
+    ahead = AHEAD
+    keep = KEEP
+    schema = SCHEMA
+    for opt, value in optlist:
+        if opt == '-c': configfile = value
+        elif opt == '-s': section = value
+        elif opt == '-a': ahead = int(value)
+        elif opt == '-k': keep = int(value)
+        elif opt == '-x': schema = value
+
+    if keep < 1:
+        print 'At least the current year must be kept'
+        sys_exit(-1)
+
+    config = ConfigParser()
+    config.read(configfile)
+    backend = Backend(config, section, { 'LOG': log }, 'PGPartition: ', {})
+    try:
+        if args[0] == 'create':
+            create(backend, ahead)
+        elif args[0] == 'detach':
+            detach(backend, keep, schema)
+        else:
+            show(backend)
+    finally:
+        backend.shutdown()
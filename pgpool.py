@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file pgpool.py
+## PostgreSQL connection pool shared by the pgsql based backends
+
+__doc__ = '''Netfarm Archiver - release 2.1.0 - PostgreSQL connection pool'''
+__version__ = '2.1.0'
+__all__ = [ 'PGPool', 'PoolError', 'get_pool', 'release_pool', 'format_msg' ]
+
+from psycopg2 import connect as db_connect
+from threading import Thread, Condition, Event, Lock
+from sys import exc_info
+from time import time
+
+### Defaults
+MINSIZE   = 1
+MAXSIZE   = 4
+CHECKIDLE = 30   # seconds idle before a connection is checked
+WAIT      = 10   # seconds waiting for a free connection
+RETRYMIN  = 1    # seconds between reconnections, doubled up to RETRYMAX
+RETRYMAX  = 60
+
+prepare_template = 'PREPARE %s AS %s;'
+timeout_template = 'SET statement_timeout = %d;'
+synccommit_template = 'SET synchronous_commit = %s;'
+
+def format_msg(msg):
+    """Formats an error message from pgsql backend
+
+    removes tabs and replaces cr with commas, also trims the msg to 256 chars
+    @param msg: is the original object for error message
+    @return: formatted message"""
+    msg = str(msg)
+    if len(msg) > 256:
+        msg = msg[:256] + '...(message too long)'
+    msg = ', '.join(msg.strip().split('\n'))
+    msg = msg.replace('\t', '')
+    return msg
+
+class PoolError(Exception):
+    """PoolError The database is unreachable or no connection is free"""
+    pass
+
+class PooledConnection:
+    """A psycopg2 connection with its cursor and pool bookkeeping"""
+    def __init__(self, dsn):
+        self.connection = db_connect(dsn)
+        self.connection.set_isolation_level(0)
+        self.cursor = self.connection.cursor()
+        self.lastused = time()
+        self.prepared = {}
+        self.timeout = 0
+        self.synccommit = None
+
+    def broken(self):
+        """True if the driver has closed the connection"""
+        return getattr(self.connection, 'closed', 0) != 0
+
+    def close(self):
+        try:
+            self.cursor.close()
+        except: pass
+        try:
+            self.connection.close()
+        except: pass
+
+class Reconnector(Thread):
+    """Reopens the pool in background while the database is down
+
+    Attempts are spaced from RETRYMIN to RETRYMAX seconds, doubling each
+    time, so an outage costs one connection attempt at time instead of
+    one for each waiting session"""
+    def __init__(self, pool):
+        self.pool = pool
+        self.stopped = Event()
+        Thread.__init__(self, name='PGPool Reconnector')
+        self.setDaemon(True)
+
+    def run(self):
+        delay = RETRYMIN
+        while 1:
+            self.stopped.wait(delay)
+            if self.stopped.isSet():
+                break
+            try:
+                conn = PooledConnection(self.pool.dsn)
+            except:
+                t, val, tb = exc_info()
+                del t, tb
+                delay = min(delay * 2, RETRYMAX)
+                self.pool.log('reconnection failed, next try in %d seconds: %s' % (delay, format_msg(val)))
+                continue
+            self.pool.restored(conn)
+            break
+
+class PGPool:
+    """Thread safe pool of pgsql connections
+
+    Connections are checked out for a query and put back, up to maxsize
+    are open at time and minsize are opened on start and after an outage.
+    A connection idle for more than checkidle seconds is checked with
+    SELECT 1 before using it. When a new connection fails the pool is
+    down: checkouts fail at once with PoolError and a Reconnector thread
+    retries with backoff, when the database is back the pool is filled
+    again. Each user registers the statements it prepares, they are
+    prepared on each connection the first time it's checked out after
+    the registration. Each checkout sets its own statement_timeout and
+    synchronous_commit."""
+    def __init__(self, dsn, minsize=MINSIZE, maxsize=MAXSIZE, checkidle=CHECKIDLE, wait=WAIT, log=None):
+        self.dsn = dsn
+        self.minsize = minsize
+        self.maxsize = max(1, maxsize)
+        self.checkidle = checkidle
+        self.wait = wait
+        if log is not None:
+            self.log = log
+        self.cond = Condition()
+        self.idle = []
+        self.count = 0
+        self.statements = {}
+        self.down = False
+        self.error = None
+        self.reconnector = None
+        self.running = True
+        self.users = 0
+        self.fill()
+
+    def log(self, text):
+        pass
+
+    def fill(self):
+        """opens connections up to minsize"""
+        while self.running and self.count < self.minsize:
+            try:
+                conn = PooledConnection(self.dsn)
+            except:
+                t, val, tb = exc_info()
+                del t, tb
+                self.failed(format_msg(val))
+                return
+            self.cond.acquire()
+            self.idle.insert(0, conn)
+            self.count = self.count + 1
+            self.cond.notify()
+            self.cond.release()
+
+    def failed(self, error):
+        """the database is unreachable, starts reconnecting in background"""
+        self.cond.acquire()
+        try:
+            self.error = error
+            if self.down or not self.running:
+                return
+            self.down = True
+            self.log('connection failed, reconnecting in background: %s' % error)
+            self.reconnector = Reconnector(self)
+            self.reconnector.start()
+            self.cond.notifyAll()
+        finally:
+            self.cond.release()
+
+    def restored(self, conn):
+        """called by the Reconnector with the first new connection"""
+        self.cond.acquire()
+        if not self.running:
+            self.cond.release()
+            conn.close()
+            return
+        self.idle.append(conn)
+        self.count = self.count + 1
+        self.down = False
+        self.error = None
+        self.reconnector = None
+        self.cond.notifyAll()
+        self.cond.release()
+        self.log('connection restored')
+        self.fill()
+
+    def prepare(self, statements):
+        """registers statements to prepare on the connections, by name"""
+        self.cond.acquire()
+        self.statements.update(statements)
+        self.cond.release()
+
+    def setup(self, conn, timeout, synccommit):
+        """prepares the missing statements, sets the statement timeout and synchronous_commit"""
+        for name, statement in self.statements.items():
+            if conn.prepared.get(name) != statement:
+                if conn.prepared.has_key(name):
+                    conn.cursor.execute('DEALLOCATE %s;' % name)
+                conn.cursor.execute(prepare_template % (name, statement))
+                conn.prepared[name] = statement
+        if conn.timeout != timeout:
+            conn.cursor.execute(timeout_template % timeout)
+            conn.timeout = timeout
+        if conn.synccommit != synccommit:
+            conn.cursor.execute(synccommit_template % synccommit)
+            conn.synccommit = synccommit
+
+    def check(self, conn):
+        """checks an idle connection"""
+        try:
+            conn.cursor.execute('SELECT 1;')
+            conn.cursor.fetchone()
+            return True
+        except:
+            return False
+
+    def get(self, timeout=0, synccommit='on'):
+        """checks out a connection
+
+        raises PoolError if the pool is down, if no connection is free
+        in wait seconds or the connection cannot be set up
+        @param timeout: statement timeout in milliseconds, 0 disables it
+        @param synccommit: synchronous_commit of the transactions, on or off"""
+        deadline = time() + self.wait
+        while 1:
+            conn = None
+            self.cond.acquire()
+            try:
+                while 1:
+                    if not self.running:
+                        raise PoolError, 'pool closed'
+                    if self.down:
+                        raise PoolError, 'database unreachable, %s' % self.error
+                    if self.idle:
+                        ## Last used connection is the most likely alive
+                        conn = self.idle.pop()
+                        break
+                    if self.count < self.maxsize:
+                        self.count = self.count + 1
+                        break
+                    left = deadline - time()
+                    if left <= 0:
+                        raise PoolError, 'no free connection in %d seconds' % self.wait
+                    self.cond.wait(left)
+            finally:
+                self.cond.release()
+
+            if conn is None:
+                try:
+                    conn = PooledConnection(self.dsn)
+                except:
+                    t, val, tb = exc_info()
+                    del t, tb
+                    error = format_msg(val)
+                    self.forget()
+                    self.failed(error)
+                    raise PoolError, 'database unreachable, %s' % error
+            elif (time() - conn.lastused) > self.checkidle and not self.check(conn):
+                self.discard(conn)
+                continue
+
+            try:
+                self.setup(conn, timeout, synccommit)
+            except:
+                t, val, tb = exc_info()
+                del t, tb
+                self.discard(conn)
+                raise PoolError, 'cannot set up the connection, %s' % format_msg(val)
+            return conn
+
+    def forget(self):
+        """a connection has been closed or never opened"""
+        self.cond.acquire()
+        self.count = self.count - 1
+        self.cond.notify()
+        self.cond.release()
+
+    def discard(self, conn):
+        """closes a broken connection, the idle ones will be checked before use"""
+        conn.close()
+        self.cond.acquire()
+        for other in self.idle:
+            other.lastused = 0
+        self.cond.release()
+        self.forget()
+
+    def put(self, conn):
+        """puts back a connection after a successful query"""
+        if conn.broken() or not self.running:
+            self.discard(conn)
+            return
+        conn.lastused = time()
+        self.cond.acquire()
+        self.idle.append(conn)
+        self.cond.notify()
+        self.cond.release()
+
+    def release(self, conn):
+        """puts back a connection after a failed query
+
+        @return: True if the connection was lost, False on query errors"""
+        try:
+            conn.connection.rollback()
+        except: pass
+        if conn.broken() or not self.check(conn):
+            self.discard(conn)
+            return True
+        self.put(conn)
+        return False
+
+    def close(self):
+        """closes the idle connections, the busy ones are closed when put back"""
+        self.cond.acquire()
+        self.running = False
+        idle, self.idle = self.idle, []
+        self.count = self.count - len(idle)
+        reconnector = self.reconnector
+        self.cond.notifyAll()
+        self.cond.release()
+        if reconnector is not None:
+            reconnector.stopped.set()
+        for conn in idle:
+            conn.close()
+
+## Pools by dsn, shared by the backends of all the stages
+pools = {}
+pools_lock = Lock()
+
+def get_pool(dsn, minsize=MINSIZE, maxsize=MAXSIZE, checkidle=CHECKIDLE, wait=WAIT, log=None):
+    """returns the pool of dsn, creating it the first time
+
+    A shared pool grows to the largest sizes asked, release it with
+    release_pool when done"""
+    pools_lock.acquire()
+    try:
+        pool = pools.get(dsn)
+        if pool is None:
+            pool = PGPool(dsn, minsize, maxsize, checkidle, wait, log)
+            pools[dsn] = pool
+        else:
+            pool.minsize = max(pool.minsize, minsize)
+            pool.maxsize = max(pool.maxsize, maxsize)
+        pool.users = pool.users + 1
+        return pool
+    finally:
+        pools_lock.release()
+
+def release_pool(pool):
+    """releases a pool from get_pool, the last user closes it"""
+    pools_lock.acquire()
+    try:
+        pool.users = pool.users - 1
+        if pool.users > 0:
+            return
+        if pools.get(pool.dsn) is pool:
+            del pools[pool.dsn]
+    finally:
+        pools_lock.release()
+    pool.close()
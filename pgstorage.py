@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file pgstorage.py
+## Maintenance of the pgsql mail storage
+
+## migrate adds the data and lob columns to an old mail_storage table and
+## moves the base64 mails to data, decoding them in the database. Mails
+## are moved a range of pids at time, each range in its own transaction,
+## so it can run while the archiver is storing mails and it can be
+## stopped and run again. get writes a stored mail, whatever the column.
+
+from sys import argv, stdout, stderr, exit as sys_exit
+from getopt import getopt
+from ConfigParser import ConfigParser
+from archiver import E_ERR
+from backend_pgsql import Backend
+
+columns_query = "SELECT column_name FROM information_schema.columns WHERE table_name = 'mail_storage';"
+rule_query = "SELECT rulename FROM pg_rules WHERE rulename = 'mail_storage_lob';"
+upgrade_columns = { 'data': 'ALTER TABLE mail_storage ADD COLUMN data bytea;',
+                    'lob' : 'ALTER TABLE mail_storage ADD COLUMN lob oid;' }
+upgrade_rule = """CREATE RULE mail_storage_lob AS ON DELETE TO mail_storage
+    WHERE old.lob IS NOT NULL DO ALSO SELECT lo_unlink(old.lob);"""
+
+ranges_query = 'SELECT year, min(pid), max(pid) FROM mail_storage WHERE mail IS NOT NULL GROUP BY year ORDER BY year;'
+migrate_template = """UPDATE mail_storage SET data = decode(mail, 'base64'), mail = NULL
+    WHERE year = %s AND pid BETWEEN %s AND %s AND mail IS NOT NULL;"""
+
+### Defaults
+CONFIGFILE = '/etc/archiver.conf'
+SECTION    = 'storage'
+PIDS       = 1000 # pids for transaction
+
+def log(severity, text):
+    if severity == E_ERR:
+        print >> stderr, text
+
+def query(backend, qs, params=None):
+    """runs a query, raises the driver exceptions
+
+    @return: the rows and the rows count"""
+    conn = backend.pool.get()
+    try:
+        conn.cursor.execute(qs, params)
+        rowcount = conn.cursor.rowcount
+        rows = []
+        if conn.cursor.description is not None:
+            rows = conn.cursor.fetchall()
+        conn.connection.commit()
+    except:
+        backend.pool.release(conn)
+        raise
+    backend.pool.put(conn)
+    return rows, rowcount
+
+def upgrade(backend):
+    """adds the missing columns and rule"""
+    rows, count = query(backend, columns_query)
+    present = [ name for (name,) in rows ]
+    if not present:
+        raise Exception, 'mail_storage table not found'
+    for name, qs in upgrade_columns.items():
+        if name not in present:
+            print 'Adding column %s' % name
+            query(backend, qs)
+    rows, count = query(backend, rule_query)
+    if not rows:
+        print 'Adding rule mail_storage_lob'
+        query(backend, upgrade_rule)
+
+def migrate(backend, pids):
+    upgrade(backend)
+    ranges, count = query(backend, ranges_query)
+    total = 0
+    for year, first, last in ranges:
+        for start in xrange(first, last + 1, pids):
+            rows, count = query(backend, migrate_template, (year, start, start + pids - 1))
+            total = total + count
+            if count:
+                print '%d: pids %d-%d, %d mails' % (year, start, start + pids - 1, count)
+    print 'Migrated %d mails, VACUUM mail_storage to reclaim the space' % total
+
+if __name__ == '__main__':
+    try:
+        optlist, args = getopt(argv[1:], 'c:s:n:')
+        if len(args) == 0 or args[0] not in ('migrate', 'get') or \
+               (args[0] == 'migrate' and len(args) != 1) or \
+               (args[0] == 'get' and len(args) not in (3, 4)):
+            raise Exception
+    except:
+        print 'Usage %s [-c config] [-s section] [-n pids] migrate' % argv[0]
+        print '      %s [-c config] [-s section] get year pid [file]' % argv[0]
+        sys_exit(-1)
+
+    configfile = CONFIGFILE
+    section = SECTION
+    pids = PIDS
+    for opt, value in optlist:
+        if opt == '-c': configfile = value
+        elif opt == '-s': section = value
+        elif opt == '-n': pids = int(value)
+
+    config = ConfigParser()
+    config.read(configfile)
+    ## No statements to prepare, the columns could be still missing
+    backend = Backend(config, section, { 'LOG': log }, 'PGStorage: ', {})
+    try:
+        if args[0] == 'migrate':
+            migrate(backend, pids)
+        else:
+            if len(args) == 4:
+                fd = open(args[3], 'wb')
+            else:
+                fd = stdout
+            if not backend.retrieve(int(args[1]), int(args[2]), fd):
+                print >> stderr, 'Mail %s-%s not found' % (args[1], args[2])
+                sys_exit(1)
+            fd.close()
+    finally:
+        backend.shutdown()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file policy.py
+## Compiled whitelist and subject rules of the archive stage
+
+__doc__ = '''Netfarm Archiver - release 2.1.0 - Archiving policy'''
+__version__ = '2.1.0'
+__all__ = [ 'Policy', 'read_entries' ]
+
+import re
+from fnmatch import translate
+
+## Subject rules with this prefix are regular expressions, else substrings
+REPREFIX = 're:'
+
+def read_entries(filename):
+    """reads a list file, one entry for line, # starts a comment"""
+    entries = []
+    fd = open(filename, 'r')
+    try:
+        for line in fd:
+            line = line.split('#', 1)[0].strip()
+            if line:
+                entries.append(line)
+    finally:
+        fd.close()
+    return entries
+
+class Policy:
+    """Whitelist and subject rules, compiled once
+
+    Whitelist entries, case insensitive:
+      - postmaster         local part, any domain
+      - user@example.com   full address
+      - @example.com       any address of the domain
+      - @.example.com      any address of the domain and its subdomains
+      - anything with * or ? is a shell wildcard on the full address
+
+    Local parts, addresses and domains are looked up in dicts, the domain
+    suffixes of an address are tried one by one; wildcards are joined in
+    a single regular expression. Subject rules are substrings, or regular
+    expressions with the re: prefix, all joined in a single regular
+    expression too."""
+    def __init__(self, whitelist=[], subjects=[]):
+        self.locals = {}
+        self.addresses = {}
+        self.domains = {}
+        self.suffixes = {}
+        wildcards = []
+        for entry in whitelist:
+            entry = entry.strip().lower()
+            if not entry:
+                continue
+            if entry.find('*') != -1 or entry.find('?') != -1:
+                wildcards.append(translate(entry))
+            elif entry.startswith('@.'):
+                self.suffixes[entry[2:]] = True
+            elif entry.startswith('@'):
+                self.domains[entry[1:]] = True
+            elif entry.find('@') != -1:
+                self.addresses[entry] = True
+            else:
+                self.locals[entry] = True
+        self.wildcards = self.combine(wildcards)
+        self.count = len(self.locals) + len(self.addresses) + len(self.domains) + \
+                     len(self.suffixes) + len(wildcards)
+
+        rules = []
+        for rule in subjects:
+            if rule.startswith(REPREFIX):
+                rules.append(rule[len(REPREFIX):])
+            elif rule:
+                rules.append(re.escape(rule))
+        self.subjects = self.combine(rules)
+        self.rules = len(rules)
+
+    def combine(self, patterns):
+        """compiles the patterns in a single regular expression, None if empty"""
+        if not patterns:
+            return None
+        return re.compile('|'.join([ '(?:%s)' % pattern for pattern in patterns ]))
+
+    def whitelisted(self, addresses):
+        """returns the first whitelisted address or None"""
+        for address in addresses:
+            address = address.lower()
+            local, domain = address.split('@', 1)
+            if self.locals.has_key(local) or self.addresses.has_key(address) \
+                   or self.domains.has_key(domain):
+                return address
+            if self.suffixes:
+                pos = 0
+                while pos != -1:
+                    if self.suffixes.has_key(domain[pos:]):
+                        return address
+                    pos = domain.find('.', pos)
+                    if pos != -1:
+                        pos = pos + 1
+            if self.wildcards is not None and self.wildcards.match(address):
+                return address
+        return None
+
+    def subject(self, subject):
+        """True if the subject matches a rule"""
+        return self.subjects is not None and self.subjects.search(subject) is not None
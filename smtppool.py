@@ -0,0 +1,197 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file smtppool.py
+## Keep-alive connections to the next hop
+
+__doc__ = '''Netfarm Archiver - release 2.1.0 - Next hop connection pool'''
+__version__ = '2.1.0'
+__all__ = [ 'SMTPPool', 'StreamSMTP' ]
+
+from smtplib import SMTP, SMTPServerDisconnected, SMTPResponseException, SMTPRecipientsRefused
+from smtplib import SMTPDataError, quotedata, CRLF
+from threading import Lock
+from sys import exc_info
+from time import time
+
+### Defaults in seconds
+IDLETIMEOUT = 60
+MAXAGE      = 300
+CHECKIDLE   = 5
+
+class StreamSMTP(SMTP):
+    """smtplib.SMTP sending a mimescan.Segments mail chunk by chunk
+
+    The mail is dot stuffed and sent one chunk at time instead of
+    building the quoted copy of the whole mail, strings are sent as
+    smtplib does"""
+    def data(self, msg):
+        if isinstance(msg, str):
+            return SMTP.data(self, msg)
+        self.putcmd('data')
+        code, repl = self.getreply()
+        if code != 354:
+            raise SMTPDataError(code, repl)
+        last = ''
+        ## Chunks end with a newline, so each one starts a line
+        for chunk in msg.chunks():
+            chunk = quotedata(chunk)
+            self.send(chunk)
+            last = (last + chunk)[-2:]
+        if last != CRLF:
+            self.send(CRLF)
+        self.send('.' + CRLF)
+        return self.getreply()
+
+class SMTPPool:
+    """Pool of keep-alive smtp connections to the next hop
+
+    Connections are reused for the next messages instead of paying
+    connect, banner and EHLO each time. smtplib already sends RSET when a
+    transaction fails and a completed DATA leaves the session clean, so
+    the connection goes back to the pool as is. A connection idle for more
+    than checkidle seconds is checked with NOOP before using it, too old
+    or too idle connections are closed. If the next hop closes a reused
+    connection (421 or disconnection) the message is sent again once on a
+    fresh connection"""
+    def __init__(self, factory, host, port, size=0, idle=IDLETIMEOUT, maxage=MAXAGE, checkidle=CHECKIDLE):
+        """The constructor
+
+        @param factory: the smtplib.SMTP like class used to connect
+        @param size: max idle connections kept, 0 disables the pool"""
+        self.factory = factory
+        self.host = host
+        self.port = port
+        self.size = size
+        self.idle = idle
+        self.maxage = maxage
+        self.checkidle = checkidle
+        self.lock = Lock()
+        self.conns = []
+
+    def connect(self):
+        """opens a new connection to the next hop"""
+        conn = self.factory(self.host, self.port)
+        conn.created = conn.lastused = time()
+        conn.reused = False
+        return conn
+
+    def discard(self, conn):
+        """closes a connection without putting it back"""
+        try:
+            conn.close()
+        except: pass
+
+    def alive(self, conn, now):
+        """checks if a pooled connection can be used"""
+        if (now - conn.created) > self.maxage or (now - conn.lastused) > self.idle:
+            return False
+        if (now - conn.lastused) > self.checkidle:
+            try:
+                return conn.noop()[0] == 250
+            except:
+                return False
+        return True
+
+    def get(self):
+        """gets a connection from the pool or opens a new one
+
+        raises the factory exceptions if the connection fails"""
+        now = time()
+        while 1:
+            self.lock.acquire()
+            try:
+                if not self.conns:
+                    break
+                ## Last used connection is the most likely alive
+                conn = self.conns.pop()
+            finally:
+                self.lock.release()
+            if self.alive(conn, now):
+                conn.reused = True
+                return conn
+            self.discard(conn)
+        return self.connect()
+
+    def put(self, conn):
+        """puts back a connection after a transaction"""
+        if self.size == 0:
+            self.discard(conn)
+            return
+        conn.lastused = time()
+        self.lock.acquire()
+        try:
+            if len(self.conns) < self.size:
+                self.conns.append(conn)
+                return
+        finally:
+            self.lock.release()
+        try:
+            conn.quit()
+        except:
+            self.discard(conn)
+
+    def closed_by_peer(self, error):
+        """True if the next hop has closed the session"""
+        if isinstance(error, SMTPResponseException):
+            return error.smtp_code == 421
+        if isinstance(error, SMTPRecipientsRefused):
+            for code, msg in error.recipients.values():
+                if code == 421:
+                    return True
+        return False
+
+    def sendmail(self, conn, *args, **kw):
+        """sends a message using conn, the connection is owned by the pool afterwards
+
+        Same arguments, return value and exceptions of smtplib.SMTP.sendmail"""
+        while 1:
+            try:
+                res = conn.sendmail(*args, **kw)
+            except (SMTPRecipientsRefused, SMTPResponseException), error:
+                if not self.closed_by_peer(error):
+                    ## Refused, session has been reset
+                    t, val, tb = exc_info()
+                    self.put(conn)
+                    raise t, val, tb
+                self.discard(conn)
+                if not conn.reused:
+                    raise
+            except SMTPServerDisconnected:
+                self.discard(conn)
+                if not conn.reused:
+                    raise
+            except:
+                self.discard(conn)
+                raise
+            else:
+                self.put(conn)
+                return res
+            ## Stale pooled connection, retry once with a fresh one
+            conn = self.connect()
+
+    def close(self):
+        """closes all pooled connections"""
+        self.lock.acquire()
+        conns, self.conns = self.conns, []
+        self.lock.release()
+        for conn in conns:
+            try:
+                conn.quit()
+            except:
+                self.discard(conn)
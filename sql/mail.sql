@@ -69,6 +69,15 @@ update mail_pid set
 SELECT pid as result from mail_pid limit 1;
 $$ LANGUAGE sql;
 
+-- Reserves a block of $1 pids of the current year, returns the year and
+-- the first pid of the block; the archiver hands them out from memory
+CREATE OR REPLACE FUNCTION reserve_pids(integer) RETURNS mail_pid AS $$
+update mail_pid set
+ pid = case when year = get_curr_year() then pid + $1 else $1 end ,
+ year = get_curr_year();
+SELECT year, pid - $1 + 1 as pid from mail_pid limit 1;
+$$ LANGUAGE sql;
+
 CREATE FUNCTION get_next_mail_id() RETURNS bigint AS $$
 SELECT nextval('mail_id_sequence') as result;
 $$ LANGUAGE sql;
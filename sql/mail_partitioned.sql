@@ -0,0 +1,113 @@
+-- Partitioned mail schema, to load instead of mail.sql
+--
+-- mail, recipient and authorized are partitioned by year, a partition
+-- for each year holds the mails archived that year and their recipients
+-- and mailboxes, so indexes grow with the year and not with the whole
+-- archive, and old years are detached as a whole. Partitions are made by
+-- pgpartition.py, run pgpartition.py create after loading this file and
+-- then from cron, a mail of a year without partition is refused and
+-- retried by the MTA. The archive stage needs schema=partitioned.
+-- Needs PostgreSQL 12 or later (foreign keys to partitioned tables).
+
+-- MAIL PID
+CREATE TABLE mail_pid (
+    year smallint NOT NULL,
+    pid integer NOT NULL
+);
+
+CREATE TABLE mail (
+    mail_id integer NOT NULL,
+    year smallint NOT NULL,
+    pid integer NOT NULL,
+    message_id character varying(512) NOT NULL,
+    from_login character varying(512) NOT NULL,
+    from_domain character varying(512) NOT NULL,
+    subject character varying(512) NOT NULL,
+    mail_date date NOT NULL,
+    mail_size integer NOT NULL DEFAULT 0,
+    attachment smallint DEFAULT 0 NOT NULL,
+    media bigint DEFAULT -1,
+    PRIMARY KEY (year, mail_id),
+    UNIQUE (year, pid)
+) PARTITION BY RANGE (year);
+
+CREATE SEQUENCE mail_id_sequence
+    START WITH 1
+    INCREMENT BY 1
+    MINVALUE 1
+    MAXVALUE 9223372036854775807
+    CACHE 1;
+
+-- RECIPIENT
+CREATE TABLE recipient (
+    mail_id integer NOT NULL,
+    year smallint NOT NULL,
+    to_login character varying(512) NOT NULL,
+    to_domain character varying(512) NOT NULL,
+    FOREIGN KEY (year, mail_id) REFERENCES mail (year, mail_id)
+        ON UPDATE CASCADE ON DELETE CASCADE
+) PARTITION BY RANGE (year);
+
+-- AUTHORIZED
+CREATE TABLE authorized (
+    mail_id integer NOT NULL,
+    year smallint NOT NULL,
+    mailbox character varying(512) NOT NULL,
+    FOREIGN KEY (year, mail_id) REFERENCES mail (year, mail_id)
+        ON UPDATE CASCADE ON DELETE CASCADE
+) PARTITION BY RANGE (year);
+
+-- Indexes are made on each partition; year is the partition key, the
+-- subject and attachment ones are dropped: substring searches on subject
+-- can't use a btree and attachment has a handful of values
+CREATE INDEX message_id_index ON mail USING btree (message_id);
+CREATE INDEX from_index ON mail USING btree (from_domain, from_login);
+CREATE INDEX mail_date_index ON mail USING btree (mail_date);
+CREATE INDEX media_index ON mail USING btree (media);
+CREATE INDEX recipient_mail_id_index ON recipient USING btree (year, mail_id);
+CREATE INDEX recipient_to_index ON recipient USING btree (to_domain, to_login);
+CREATE INDEX authorized_mail_id_index ON authorized USING btree (year, mail_id);
+CREATE INDEX authorized_mailbox_index ON authorized USING btree (mailbox);
+
+CREATE FUNCTION get_curr_year() RETURNS integer AS $$
+SELECT int4(Extract(year from now())) as result from mail_pid limit 1;
+$$ LANGUAGE sql;
+
+INSERT INTO mail_pid (year, pid) VALUES (0 , 0);
+
+CREATE FUNCTION get_curr_pid() RETURNS integer AS $$
+SELECT pid as result from mail_pid limit 1;
+$$ LANGUAGE sql;
+
+CREATE FUNCTION get_new_pid() RETURNS integer AS $$
+update mail_pid set
+ pid = case when year = get_curr_year() then pid + 1 else 1 end ,
+ year = get_curr_year();
+SELECT pid as result from mail_pid limit 1;
+$$ LANGUAGE sql;
+
+-- Reserves a block of $1 pids of the current year, returns the year and
+-- the first pid of the block; the archiver hands them out from memory
+CREATE OR REPLACE FUNCTION reserve_pids(integer) RETURNS mail_pid AS $$
+update mail_pid set
+ pid = case when year = get_curr_year() then pid + $1 else $1 end ,
+ year = get_curr_year();
+SELECT year, pid - $1 + 1 as pid from mail_pid limit 1;
+$$ LANGUAGE sql;
+
+CREATE FUNCTION get_next_mail_id() RETURNS bigint AS $$
+SELECT nextval('mail_id_sequence') as result;
+$$ LANGUAGE sql;
+
+CREATE FUNCTION get_curr_mail_id() RETURNS bigint AS $$
+SELECT currval('mail_id_sequence') as result;
+$$ LANGUAGE sql;
+
+-- MAIL - RECIPIENT
+CREATE OR REPLACE VIEW mail_recipient AS
+ SELECT m.mail_id AS mail_id, m.year, m.pid, m.message_id,
+         m.from_login, m.from_domain, r.to_login, r.to_domain,
+         m.subject, m.mail_date, m.attachment, m.media
+   FROM mail as m
+   JOIN recipient as r ON m.year = r.year AND m.mail_id = r.mail_id
+ ORDER BY m.year, m.pid, r.to_login, r.to_domain;
@@ -1,8 +1,17 @@
+-- One of mail (base64, storagemode=text), data (storagemode=bytea) or
+-- lob (a large object, storagemode=bytea with lobsize) is set for each mail,
+-- pgstorage.py migrate moves base64 rows to data
 CREATE TABLE mail_storage (
     year smallint NOT NULL,
     pid integer NOT NULL,
-    mail text
+    mail text,
+    data bytea,
+    lob oid
 );
 
 CREATE INDEX index_pidb ON mail_storage USING btree (year);
 CREATE INDEX index_pidh ON mail_storage USING btree (pid);
+
+-- Large objects are not deleted with the rows referencing them
+CREATE RULE mail_storage_lob AS ON DELETE TO mail_storage
+    WHERE old.lob IS NOT NULL DO ALSO SELECT lo_unlink(old.lob);
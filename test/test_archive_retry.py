@@ -0,0 +1,128 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file test/test_archive_retry.py
+## LMTP archive stage: recipients refused by the next hop and their retry
+
+## The archive stage gets a mail on LMTP, the next hop refuses one of the
+## recipients with a temporary error and Postfix retries the mail for that
+## recipient only: the retry must reuse the archiver id of the first
+## delivery instead of archiving the mail again.
+
+from sys import path, modules
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import unittest
+from types import ModuleType
+from tempfile import mkdtemp
+from shutil import rmtree
+from ConfigParser import ConfigParser
+import archiver
+
+MAIL = '''From: sender@example.com
+To: one@example.com, two@example.com
+Subject: retry
+Message-ID: <retry.1@example.com>
+
+body
+'''
+
+class Backend(archiver.BackendBase):
+    """Archive backend keeping the rows in memory"""
+    rows = []
+
+    def __init__(self, config, stage_type, ar_globals, prefix=None):
+        pass
+
+    def process(self, data):
+        self.rows.append(data)
+        return 2007, len(self.rows), 'Ok'
+
+backend = ModuleType('backend_testrows')
+backend.Backend = Backend
+modules['backend_testrows'] = backend
+
+class NextHop:
+    """SMTPPool refusing the recipients in refused"""
+    def __init__(self):
+        self.refused = {}
+        self.sent = []
+
+    def get(self):
+        return None
+
+    def sendmail(self, server, m_from, m_to, msg, mail_options=[], rcpt_options=[]):
+        self.sent.append((m_to, str(msg)))
+        reply = {}
+        for rcpt in m_to:
+            if self.refused.has_key(rcpt):
+                reply[rcpt] = self.refused[rcpt]
+        return reply
+
+    def close(self):
+        pass
+
+class TestArchiveRetry(unittest.TestCase):
+    def setUp(self):
+        archiver.LOG = lambda level, msg: None
+        self.dir = mkdtemp()
+        config = ConfigParser()
+        config.add_section('archive')
+        config.set('archive', 'input', 'lmtp:unix:%s' % join(self.dir, 'archive.sock'))
+        config.set('archive', 'output', 'smtp:127.0.0.1:10026')
+        config.set('archive', 'backend', 'testrows')
+        config.set('archive', 'hashdb', join(self.dir, 'archive.db'))
+        config.set('archive', 'hashdbsync', 'never')
+        Backend.rows = []
+        self.stage = archiver.StageHandler(config, 'archive')
+        self.stage.outpool = self.nexthop = NextHop()
+
+    def tearDown(self):
+        self.stage.finish()
+        rmtree(self.dir)
+
+    def deliver(self, recips):
+        return self.stage.process_message(('127.0.0.1', 0), 'sender@example.com', [],
+                                          recips, [ (rcpt, '') for rcpt in recips ], MAIL)
+
+    def testPartialAcceptRetry(self):
+        self.nexthop.refused = { 'two@example.com': (450, 'mailbox busy') }
+        replies = self.deliver([ 'one@example.com', 'two@example.com' ])
+        self.assertEqual(len(replies), 2)
+        self.failUnless(replies[0].startswith('250 '), replies[0])
+        self.failUnless(replies[1].startswith('450 '), replies[1])
+
+        ## Postfix retries the refused recipient, the next hop takes it now
+        self.nexthop.refused = {}
+        reply = self.deliver([ 'two@example.com' ])
+        self.failUnless(reply.startswith('250 '), reply)
+
+        self.assertEqual(len(Backend.rows), 1)
+        first, retry = self.nexthop.sent
+        self.failUnless('X-Archiver-ID: 2007-1\n' in first[1])
+        self.failUnless('X-Archiver-ID: 2007-1\n' in retry[1])
+
+    def testFullAcceptExpunges(self):
+        reply = self.deliver([ 'one@example.com', 'two@example.com' ])
+        self.failUnless(reply.startswith('250 '), reply)
+        self.assertEqual(len(Backend.rows), 1)
+        self.assertEqual(self.stage.hashdb.get(Backend.rows[0]['hash']), None)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python
+# -*- Mode: Python; tab-width: 4 -*-
+#
+# Netfarm Mail Archiver - release 2
+#
+# Copyright (C) 2005-2007 Gianluigi Tiesi <sherpya@netfarm.it>
+# Copyright (C) 2005-2007 NetFarm S.r.l.  [http://www.netfarm.it]
+#
+# This program is free software; you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by the
+# Free Software Foundation; either version 2, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but
+# WITHOUT ANY WARRANTY; without even the implied warranty of MERCHANTIBILITY
+# or FITNESS FOR A PARTICULAR PURPOSE.  See the GNU General Public License
+# for more details.
+# ======================================================================
+## @file test/test_pgsql_lob.py
+## pgsql storage stage in bytea mode, large objects
+
+## Runs on a fake psycopg2 driver, no database is needed. Its large
+## objects take only strings, like psycopg2 lobject.write does.
+
+from sys import path, modules
+from os.path import dirname, abspath, join
+path.insert(0, join(dirname(abspath(__file__)), '..'))
+
+import unittest
+from types import ModuleType, StringType, UnicodeType
+from ConfigParser import ConfigParser
+
+class Cursor:
+    def __init__(self, connection):
+        self.connection = connection
+        self.description = None
+        self.rowcount = 0
+
+    def execute(self, qs, params=None):
+        self.connection.queries.append((qs, params))
+
+    def fetchone(self):
+        return None
+
+    def close(self):
+        pass
+
+class LargeObject:
+    def __init__(self, oid):
+        self.oid = oid
+        self.data = []
+
+    def write(self, data):
+        if not isinstance(data, (StringType, UnicodeType)):
+            raise TypeError, 'lobject.write() argument 1 must be str or unicode, not %s' % type(data).__name__
+        self.data.append(data)
+        return len(data)
+
+    def close(self):
+        pass
+
+class Connection:
+    def __init__(self):
+        self.closed = 0
+        self.queries = []
+        self.lobjects = []
+
+    def set_isolation_level(self, level):
+        pass
+
+    def cursor(self):
+        return Cursor(self)
+
+    def lobject(self, oid=0, mode='rb'):
+        lob = LargeObject(1000 + len(self.lobjects))
+        self.lobjects.append(lob)
+        return lob
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+class Binary:
+    def __init__(self, data):
+        self.data = data
+
+connections = []
+
+def connect(dsn):
+    connection = Connection()
+    connections.append(connection)
+    return connection
+
+psycopg2 = ModuleType('psycopg2')
+psycopg2.connect = connect
+psycopg2.Binary = Binary
+modules['psycopg2'] = psycopg2
+
+from archiver import BACKEND_OK
+from mimescan import Segments
+from backend_pgsql import Backend, execute_lob, execute_data
+
+HEADERS = 'From: sender@example.com\nX-Archiver-ID: 2007-1\n\n'
+BODY = 'A line of the body of a mail bigger than lobsize\n' * 1000
+
+def log(level, msg):
+    pass
+
+class TestLargeObjects(unittest.TestCase):
+    def setUp(self):
+        del connections[:]
+        config = ConfigParser()
+        config.add_section('storage')
+        config.set('storage', 'dsn', 'archiver:archiver:localhost:mail')
+        config.set('storage', 'storagemode', 'bytea')
+        config.set('storage', 'lobsize', '1024')
+        self.backend = Backend(config, 'storage', { 'LOG': log })
+
+    def tearDown(self):
+        self.backend.shutdown()
+
+    def store(self, mail):
+        return self.backend.process(dict(mail=mail, year=2007, pid=1, date=None, mid='<lob@example.com>', hash=''))
+
+    def queries(self, qs):
+        found = []
+        for connection in connections:
+            found.extend([ params for query, params in connection.queries if query == qs ])
+        return found
+
+    def lobjects(self):
+        found = []
+        for connection in connections:
+            found.extend(connection.lobjects)
+        return found
+
+    def testLargeMail(self):
+        ## Headers and body are different segments, as after add_aid
+        mail = Segments(HEADERS)
+        mail.append(BODY)
+        self.assertEqual(self.store(mail), BACKEND_OK)
+        lobs = self.lobjects()
+        self.assertEqual(len(lobs), 1)
+        self.assertEqual(''.join(lobs[0].data), HEADERS + BODY)
+        self.assertEqual(self.queries(execute_lob), [ (2007, 1, lobs[0].oid) ])
+
+    def testSmallMail(self):
+        self.assertEqual(self.store(Segments(HEADERS + 'body\n')), BACKEND_OK)
+        self.assertEqual(self.lobjects(), [])
+        params = self.queries(execute_data)
+        self.assertEqual(len(params), 1)
+        self.assertEqual(params[0][2].data, HEADERS + 'body\n')
+
+if __name__ == '__main__':
+    unittest.main()